@@ -2,43 +2,94 @@
 ########################################################################
 
 import socket
+import select
+import threading
+import time
 
 ########################################################################
 
 SOCKET_TIMEOUT = 4
 
+########################################################################
+# recv_exactly frontend to recv_into
+########################################################################
+
+# Read exactly bytecount_target bytes into a bytearray using recv_into
+# on a memoryview, so no intermediate bytes objects are created. The
+# caller may supply the buffer; otherwise a per-thread pooled buffer
+# is used, and the returned view is only valid until the next pooled
+# call on the same thread. An optional deadline (an absolute
+# time.monotonic() value) bounds the whole read without changing the
+# socket timeout. Return a status (True or False) and a memoryview of
+# the received bytes.
+
+RECV_POOL_MAX_SIZE = 1024 * 1024
+
+recv_pool = threading.local()
+
+# Wait up to timeout seconds for sock to become readable. select()
+# cannot take descriptors above FD_SETSIZE (1024), so use poll() where
+# there is one. (The same helper as in Lab3/lab3.py, which this
+# directory cannot import.)
+
+def wait_readable(sock, timeout):
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+def recv_exactly(sock, bytecount_target, buffer=None, deadline=None):
+    if buffer is None:
+        buffer = getattr(recv_pool, 'buffer', None)
+        if buffer is None or len(buffer) < bytecount_target:
+            buffer = bytearray(bytecount_target)
+            # Don't keep very large buffers around in the pool.
+            if bytecount_target <= RECV_POOL_MAX_SIZE:
+                recv_pool.buffer = buffer
+    view = memoryview(buffer)[:bytecount_target]
+    try:
+        byte_recv_count = 0 # total received bytes
+        while byte_recv_count < bytecount_target:
+            # Wait for data, but no later than the deadline.
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not wait_readable(sock, remaining):
+                    print("recv_exactly: deadline expired!")
+                    return (False, view[:0])
+            # Receive directly into the unfilled part of the buffer.
+            new_byte_count = sock.recv_into(view[byte_recv_count:])
+            # If ever the other end closes on us before we are done,
+            # give up and return a False status with zero bytes.
+            if not new_byte_count:
+                return (False, view[:0])
+            byte_recv_count += new_byte_count
+        return (True, view)
+    # If the socket has its own timeout and it expires, something went
+    # wrong. Return a False status.
+    except socket.timeout:
+        print("recv_exactly: Recv socket timeout!")
+        return (False, view[:0])
+
 ########################################################################
 # recv_bytes frontend to recv
 ########################################################################
 
 # Call recv to read bytecount_target bytes from the socket. Return a
 # status (True or False) and the received butes (in the former case).
+# This is now a thin wrapper on recv_exactly that returns a bytes
+# copy. As before, each recv gives up after SOCKET_TIMEOUT seconds,
+# and the socket is left without a timeout afterwards.
 
 def recv_bytes(sock, bytecount_target):
     # Be sure to timeout the socket if we are given the wrong
     # information.
     sock.settimeout(SOCKET_TIMEOUT)
     try:
-        byte_recv_count = 0 # total received bytes
-        recv_bytes = b''    # complete received message
-        while byte_recv_count < bytecount_target:
-            # Ask the socket for the remaining byte count.
-            new_bytes = sock.recv(bytecount_target-byte_recv_count)
-            # If ever the other end closes on us before we are done,
-            # give up and return a False status with zero bytes.
-            if not new_bytes:
-                return (False, b'')
-            byte_recv_count += len(new_bytes)
-            recv_bytes += new_bytes
-        # Turn off the socket timeout if we finish correctly.
-        sock.settimeout(None)            
-        return (True, recv_bytes)
-    # If the socket times out, something went wrong. Return a False
-    # status.
-    except socket.timeout:
-        sock.settimeout(None)        
-        print("recv_bytes: Recv socket timeout!")
-        return (False, b'')
+        status, view = recv_exactly(sock, bytecount_target)
+        return (status, bytes(view))
+    finally:
+        sock.settimeout(None)
 
 
 
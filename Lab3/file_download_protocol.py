@@ -27,7 +27,6 @@
 
 import socket
 import argparse
-import time
 
 ########################################################################
 
@@ -46,63 +45,17 @@ MSG_ENCODING = "utf-8"
 SOCKET_TIMEOUT = 4
 
 ########################################################################
-# recv_bytes函数是recv的前端
+# recv_bytes
 ########################################################################
 
 '''
 
-调用recv从套接字读取bytecount_target字节。返回一个状态 (True 或 False)
-和接收到的字节（前者情况下）。
+使用lab3.py中的recv_bytes (recv_exactly的前端), 不再复制一份。
+套接字在accept/connect之后设置一次SOCKET_TIMEOUT。
 
 '''
 
-def recv_bytes(sock, bytecount_target):
-    
-    '''
-    如果我们被给了错误的信息，请确保套接字超时。
-    '''
-    sock.settimeout(SOCKET_TIMEOUT)
-
-    '''
-    这个函数的作用是从网络连接中安全、准确地接收指定数量的字节，
-    这是网络通信中常见的需求，特别是在接收固定大小的消息或文件时。
-    '''
-    
-    try:
-        byte_recv_count = 0 
-        recv_bytes = b''
-        '''
-        这里设置了两个变量: 
-            byte_recv_count 用于追踪已经接收的字节数，
-            而 recv_bytes 用于储存接收到的字节序列。
-        '''
-        while byte_recv_count < bytecount_target:
-            new_bytes = sock.recv(bytecount_target-byte_recv_count)
-            '''
-            这行代码从套接字请求数据。sock.recv() 方法尝试接收指定数量的字节，
-            这个数量是目标字节数减去已经接收的字节数。这样可以确保不会尝试接收超过所需的数据。
-            '''
-
-            if not new_bytes:
-                return(False, b'')
-            
-            byte_recv_count += len(new_bytes)
-            recv_bytes += new_bytes
-            
-            '''
-            如果接收到了数据，将新接收的字节长度添加到 byte_recv_count,
-            并将接收到的字节追加到 recv_bytes。
-            '''
-
-        # 如果我们正确完成，关闭套接字超时。
-        sock.settimeout(None)            
-        return (True, recv_bytes)
-    
-    # 如果套接字超时，说明出现了问题。返回一个False状态。
-    except socket.timeout:
-        sock.settimeout(None)        
-        print("recv_bytes: 接收套接字超时!")
-        return (False, b'')
+from lab3 import recv_bytes
 
 
 
@@ -153,6 +106,7 @@ class Server:
     def connection_handler(self, client):
 
         connection, address = client
+        connection.settimeout(SOCKET_TIMEOUT)
         print("-" * 72)
         print("Connection received from {}.".format(address))
 
@@ -278,6 +232,7 @@ class Client:
     def connect_to_server(self):
         try:
             self.socket.connect((Server.HOSTNAME, Server.PORT))
+            self.socket.settimeout(SOCKET_TIMEOUT)
         except Exception as msg:
             print(msg)
             exit()
@@ -1,44 +1,2179 @@
 import socket
 import select
+import bisect
+import datetime
 import sys
 import threading
 import argparse
+import fnmatch
+import shlex
+import hashlib
+import math
+import mmap
+import tempfile
+import queue
+import heapq
+import collections
+import itertools
+import concurrent.futures
+import json
+import time
+import zlib
+import io
 import os
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
 
 CMD_FIELD_LEN = 1 
 FILENAME_SIZE_FIELD_LEN = 1 
 FILESIZE_FIELD_LEN = 8 
-
-CMD = {"GET": 1, "PUT": 2, "LIST": 3, "BYE": 5, "SCAN": 6, "CONNECT": 7}
+OFFSET_FIELD_LEN = 8
+LENGTH_FIELD_LEN = 8
+STATUS_FIELD_LEN = 1
+CHUNK_COUNT_FIELD_LEN = 4
+CHUNK_DIGEST_LEN = 32
+PATTERN_SIZE_FIELD_LEN = 1
+PAGE_SIZE_FIELD_LEN = 4
+ENTRY_COUNT_FIELD_LEN = 2
+MTIME_FIELD_LEN = 8
+CODEC_FIELD_LEN = 1
+LEVEL_FIELD_LEN = 1
+FRAME_SIZE_FIELD_LEN = 4
+STATS_SIZE_FIELD_LEN = 4
+BLOCK_SIZE_FIELD_LEN = 4
+WEAK_CHECKSUM_LEN = 4
+STRONG_HASH_LEN = 16
+BLOCK_INDEX_FIELD_LEN = 4
+DELTA_OP_FIELD_LEN = 1
+LITERAL_SIZE_FIELD_LEN = 4
+DIGEST_FIELD_LEN = 1
+BLAKE2B_DIGEST_LEN = 32
+RATE_FIELD_LEN = 8
+VALIDATOR_DIGEST_LEN = 32
+CHUNK_SIZE_FIELD_LEN = 4
+QUERY_SIZE_FIELD_LEN = 2
+MATCH_COUNT_FIELD_LEN = 4
+PATH_SIZE_FIELD_LEN = 2
+PATH_COUNT_FIELD_LEN = 4
+
+CMD = {"GET": 1, "PUT": 2, "LIST": 3, "BYE": 5, "SCAN": 6, "CONNECT": 7, "GETRANGE": 8,
+       "DPUT": 9, "LISTPAGE": 10, "ZGET": 11, "ZPUT": 12,
+       "STATS": 13, "RPUT": 14, "MGET": 15,
+       "VGET": 16, "VPUT": 17, "LIMIT": 18,
+       "CGET": 19, "MUX": 20, "CHUNKS": 21,
+       "SEARCH": 22, "SYNCLIST": 23, "SYNCHASH": 24,
+       "SYNCGET": 25, "SYNCPUT": 26}
+
+STATUS = {"OK": 0, "ERROR": 1, "NOT_FOUND": 2, "BAD_RANGE": 3, "UNSUPPORTED": 4, "BUSY": 5,
+          "NOT_MODIFIED": 6, "CHANGED": 7}
+
+CODEC = {"none": 0, "zlib": 1, "lzma": 2}
+
+DELTA_OP = {"END": 0, "COPY": 1, "DATA": 2}
+
+DIGEST = {"crc32": 1, "blake2b": 2, "crc32c": 3}
 
 MSG_ENCODING = "utf-8"
 SOCKET_TIMEOUT = 4
+FILE_CHUNK_SIZE = 64 * 1024
+DEDUP_CHUNK_SIZE = 1024 * 1024
+DEDUP_DIGEST_BATCH = 4096
+LIST_BATCH_SIZE = 256
+COMPRESSION_CHUNK_SIZE = 256 * 1024
+MAX_FRAME_SIZE = 2 * COMPRESSION_CHUNK_SIZE
+COMPRESSION_MIN_SIZE = 512
+COMPRESSION_MAX_RATIO = 0.9
+DELTA_MIN_BLOCK_SIZE = 2 * 1024
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+DELTA_LITERAL_SIZE = 64 * 1024
+DELTA_SCAN_LIMIT = 1024 * 1024
+DELTA_RESYNC_BLOCKS = 32
+MGET_PREFETCH_SIZE = 256 * 1024
+MGET_SEND_BUFFER_SIZE = 256 * 1024
+VERIFY_CHUNK_SIZE = 1024 * 1024
+SEND_PIECE_SIZE = 1024 * 1024
+SWARM_MIN_CHUNK_SIZE = 64 * 1024
+SWARM_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+########################################################################
+# recv_exactly: allocation-free frontend to recv_into
+########################################################################
+
+# Connections get SOCKET_TIMEOUT once, when they are accepted or
+# connected, rather than having it switched on and off around every
+# read. A caller that needs an overall limit passes a deadline (an
+# absolute time.monotonic() value) instead.
+
+RECV_POOL_MAX_SIZE = 1024 * 1024
+
+recv_pool = threading.local()
+
+def wait_readable(sock, timeout):
+
+    # select() cannot take descriptors above FD_SETSIZE (1024), which a
+    # server holding many sessions reaches, so use poll() where there
+    # is one.
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+def recv_exactly(sock, bytecount_target, buffer=None, deadline=None):
+
+    # Read exactly bytecount_target bytes into buffer with recv_into and
+    # return a status and a memoryview of the bytes read. Without a
+    # buffer, a per-thread pooled bytearray is used: the returned view
+    # is then only valid until the next pooled call on the same thread.
+    if buffer is None:
+        buffer = getattr(recv_pool, 'buffer', None)
+
+        if buffer is None or len(buffer) < bytecount_target:
+            buffer = bytearray(bytecount_target)
+            if bytecount_target <= RECV_POOL_MAX_SIZE:
+                recv_pool.buffer = buffer
+
+    view = memoryview(buffer)[:bytecount_target]
+
+    try:
+        byte_recv_count = 0
+
+        while byte_recv_count < bytecount_target:
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not wait_readable(sock, remaining):
+                    return (False, view[:0])
+
+            new_byte_count = sock.recv_into(view[byte_recv_count:])
+
+            if not new_byte_count:
+                return (False, view[:0])
+
+            byte_recv_count += new_byte_count
+
+        return (True, view)
+
+    except socket.timeout:
+        # print("recv_exactly: socket timeout!")
+        return (False, view[:0])
 
 def recv_bytes(sock, bytecount_target):
 
-    sock.settimeout(SOCKET_TIMEOUT)
+    # Drop-in replacement for the original helper, returning a bytes
+    # copy the caller can keep.
+    status, view = recv_exactly(sock, bytecount_target)
+    return (status, bytes(view))
 
+def recv_file(sock, f, bytecount_target, buffer):
+
+    # Stream bytecount_target bytes from the socket into the open file
+    # f, one chunk at a time through the same buffer, so memory use is
+    # bounded by len(buffer) whatever the file size.
     try:
-        byte_recv_count = 0 
-        recv_bytes = b''
-        
+        view = memoryview(buffer)
+        byte_recv_count = 0
+
         while byte_recv_count < bytecount_target:
-            new_bytes = sock.recv(bytecount_target-byte_recv_count)
+            new_byte_count = sock.recv_into(view, min(len(view), bytecount_target-byte_recv_count))
+
+            if not new_byte_count:
+                return False
+
+            f.write(view[:new_byte_count])
+            byte_recv_count += new_byte_count
+
+        return True
 
-            if not new_bytes:
-                return(False, b'')
-            
-            byte_recv_count += len(new_bytes)
-            recv_bytes += new_bytes
-            
-        sock.settimeout(None)            
-        return (True, recv_bytes)
-    
     except socket.timeout:
-        sock.settimeout(None)        
-        # print("recv_bytes: socket timeout!")
-        return (False, b'')
+        return False
+
+def send_buffer(sock, data):
+
+    # sendall a large in-memory body one SEND_PIECE_SIZE piece at a
+    # time. The socket timeout bounds a whole sendall call, so sending
+    # the body in one call would fail on any link slower than
+    # len(data) / SOCKET_TIMEOUT.
+    view = memoryview(data).cast('B')
+    for start in range(0, len(view), SEND_PIECE_SIZE):
+        sock.sendall(view[start:start + SEND_PIECE_SIZE])
+
+def create_temp_file(filepath):
+
+    # A hidden temporary file beside filepath, for writing a new
+    # version that is then renamed over it with os.replace. Returns an
+    # open file descriptor and the temporary path. mkstemp creates it
+    # private to the owner; the replacement gets the usual permissions.
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(filepath)}.", suffix=".part",
+                                     dir=os.path.dirname(filepath) or ".")
+    os.chmod(temp_path, 0o644)
+    return (fd, temp_path)
+
+def is_temp_file(name):
+
+    # Whether name is one of create_temp_file's temporary files. They
+    # are never listed or served.
+    return name.startswith(".") and name.endswith(".part")
+
+def sweep_temp_files(root):
+
+    # Removes the temporary files left under root by uploads that were
+    # interrupted when the server last stopped. Symbolic links are not
+    # followed. Returns how many were removed.
+    removed = 0
+    for folder, _, names in os.walk(root):
+        for name in names:
+            if is_temp_file(name):
+                try:
+                    os.remove(os.path.join(folder, name))
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+def preallocate_file(f, file_size):
+
+    # Reserve the blocks up front so the file does not fragment as it
+    # grows. posix_fallocate is not available on Windows and not
+    # supported by every filesystem, in which case we just skip it.
+    if file_size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, file_size)
+        except OSError:
+            pass
+
+class RangeWriter:
+
+    # File-like object for recv_file that writes at its own offset in a
+    # shared file descriptor, so several connections can each fill a
+    # different range of the same file. Falls back to lseek + write
+    # under a lock where os.pwrite is not available (Windows).
+    lock = threading.Lock()
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        data = memoryview(data)
+
+        while data:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, data, self.offset)
+            else:
+                with RangeWriter.lock:
+                    os.lseek(self.fd, self.offset, os.SEEK_SET)
+                    written = os.write(self.fd, data)
+
+            self.offset += written
+            data = data[written:]
+
+########################################################################
+# Compressed transfers
+########################################################################
+
+# A compressed body is sent as frames, each a 4 byte length followed by
+# that many bytes of codec output, and ends with a zero-length frame.
+# Both ends work one COMPRESSION_CHUNK_SIZE piece at a time, so
+# compressed transfers stream like the plain ones.
+
+def supported_codecs():
+
+    # Bit mask of the codecs this side can handle.
+    mask = 1 << CODEC["none"] | 1 << CODEC["zlib"]
+    if lzma is not None:
+        mask |= 1 << CODEC["lzma"]
+    return mask
+
+def choose_codec(mask, preference):
+
+    # First codec in preference that the mask allows, or none.
+    for name in preference:
+        if mask & (1 << CODEC[name]) and supported_codecs() & (1 << CODEC[name]):
+            return CODEC[name]
+    return CODEC["none"]
+
+def is_compressible(sample):
+
+    # Skip compression for data that does not shrink noticeably, such
+    # as media or archives: compressing a sample at the fastest level
+    # is a cheap predictor for the rest of the file.
+    if len(sample) < COMPRESSION_MIN_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_MAX_RATIO
+
+def make_compressor(codec, level):
+    if codec == CODEC["zlib"]:
+        return zlib.compressobj(level)
+    if codec == CODEC["lzma"]:
+        return lzma.LZMACompressor(preset=level)
+    return None
+
+# Raised by a decompressor fed corrupt data.
+DECOMPRESSION_ERRORS = (zlib.error, EOFError)
+if lzma is not None:
+    DECOMPRESSION_ERRORS += (lzma.LZMAError,)
+
+def make_decompressor(codec):
+    if codec == CODEC["zlib"]:
+        return zlib.decompressobj()
+    if codec == CODEC["lzma"]:
+        return lzma.LZMADecompressor()
+    return None
+
+def send_frames(sock, data):
+
+    # Codec output can come in bursts, so split it to keep every frame
+    # under MAX_FRAME_SIZE.
+    for start in range(0, len(data), COMPRESSION_CHUNK_SIZE):
+        frame = data[start:start + COMPRESSION_CHUNK_SIZE]
+        sock.sendall(len(frame).to_bytes(FRAME_SIZE_FIELD_LEN, byteorder='big') + frame)
+
+def send_compressed(sock, f, codec, level, first_chunk=b''):
+
+    # Compress the rest of f (after first_chunk, which the caller may
+    # already have read for is_compressible) into frames on sock.
+    # Returns the number of compressed bytes sent.
+    compressor = make_compressor(codec, level)
+    sent = 0
+    chunk = first_chunk or f.read(COMPRESSION_CHUNK_SIZE)
+
+    while chunk:
+        data = compressor.compress(chunk) if compressor else chunk
+        send_frames(sock, data)
+        sent += len(data)
+        chunk = f.read(COMPRESSION_CHUNK_SIZE)
+
+    if compressor:
+        data = compressor.flush()
+        send_frames(sock, data)
+        sent += len(data)
+
+    sock.sendall((0).to_bytes(FRAME_SIZE_FIELD_LEN, byteorder='big'))
+    return sent
+
+def recv_compressed(sock, f, codec, file_size):
+
+    # Receive frames from sock and write the decompressed data to f.
+    # Output is produced at most COMPRESSION_CHUNK_SIZE bytes at a time
+    # and must come to exactly file_size bytes. Returns True on success.
+    decompressor = make_decompressor(codec)
+    written = 0
+
+    while True:
+        status, frame_size_field = recv_exactly(sock, FRAME_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        frame_size = int.from_bytes(frame_size_field, byteorder='big')
+
+        if frame_size == 0:
+            break
+
+        if frame_size > MAX_FRAME_SIZE:
+            return False
+
+        status, frame = recv_exactly(sock, frame_size)
+
+        if not status:
+            return False
+
+        if decompressor is None:
+            pieces = [frame]
+        else:
+            pieces = decompress_pieces(decompressor, frame)
+
+        for piece in pieces:
+            written += len(piece)
+            if written > file_size:
+                return False
+            f.write(piece)
+
+    if decompressor is not None and not decompressor.eof:
+        return False
+
+    return written == file_size
+
+def decompress_pieces(decompressor, data):
+
+    # zlib keeps input it could not use in unconsumed_tail, lzma keeps
+    # it internally and asks for more with needs_input.
+    piece = decompressor.decompress(data, COMPRESSION_CHUNK_SIZE)
+    yield piece
+
+    while not decompressor.eof:
+        if hasattr(decompressor, 'unconsumed_tail'):
+            if not decompressor.unconsumed_tail:
+                return
+            piece = decompressor.decompress(decompressor.unconsumed_tail, COMPRESSION_CHUNK_SIZE)
+        else:
+            if decompressor.needs_input:
+                return
+            piece = decompressor.decompress(b'', COMPRESSION_CHUNK_SIZE)
+        yield piece
+
+########################################################################
+# Delta transfers
+########################################################################
+
+# RPUT sends only what changed in a file the server already has, in
+# the manner of rsync. The server describes its copy as a list of
+# block signatures, each a rolling weak checksum and a strong hash.
+# The client slides a window over its new file looking for blocks the
+# server already holds and sends a stream of instructions:
+#
+#   COPY  | 4 byte block index | 4 byte block count
+#   DATA  | 4 byte length | literal bytes
+#   END   | sha256 of the whole new file
+#
+# The weak checksum is Adler-32, which zlib computes in C for a fresh
+# window and which can be rolled forward one byte at a time.
+#
+# Rolling is done in Python and costs about a microsecond per byte, so
+# after DELTA_SCAN_LIMIT bytes without a match the window moves a block
+# at a time instead, with a byte-by-byte pass over every
+# DELTA_RESYNC_BLOCKS-th block to find data that has shifted.
+
+ADLER_MOD = 65521
+
+def delta_block_size(file_size):
+
+    # About sqrt(file_size), as rsync does, rounded to a whole KB.
+    block_size = (math.isqrt(file_size) // 1024) * 1024
+    return min(max(block_size, DELTA_MIN_BLOCK_SIZE), DELTA_MAX_BLOCK_SIZE)
+
+def block_signatures(f, block_size):
+
+    # Signatures of the full blocks of f, packed for the wire. A short
+    # last block gets none; the client sends it as data.
+    signatures = bytearray()
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            return signatures
+        signatures += zlib.adler32(block).to_bytes(WEAK_CHECKSUM_LEN, byteorder='big')
+        signatures += hashlib.blake2b(block, digest_size=STRONG_HASH_LEN).digest()
+
+def parse_signatures(signatures):
+
+    # weak checksum -> [(block index, strong hash), ...]
+    entry_len = WEAK_CHECKSUM_LEN + STRONG_HASH_LEN
+    index = {}
+    for i in range(len(signatures) // entry_len):
+        entry = signatures[i * entry_len:(i + 1) * entry_len]
+        weak = int.from_bytes(entry[:WEAK_CHECKSUM_LEN], byteorder='big')
+        index.setdefault(weak, []).append((i, bytes(entry[WEAK_CHECKSUM_LEN:])))
+    return index
+
+def roll_adler32(checksum, block_size, byte_out, byte_in):
+
+    # Move an Adler-32 window one byte: byte_out leaves, byte_in enters.
+    a = ((checksum & 0xffff) - byte_out + byte_in) % ADLER_MOD
+    b = ((checksum >> 16) - block_size * byte_out + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+def compute_delta(data, block_size, signature_index):
+
+    # Yield ("COPY", first block, count) and ("DATA", bytes) instructions
+    # that rebuild data from the blocks in signature_index. data must
+    # support slicing and indexing by position (bytes or mmap).
+    data_size = len(data)
+    position = 0
+    literal_start = 0
+    weak = None
+    copy_start = copy_count = 0
+    last_match = 0
+    probes = 0
+    scan_until = 0
+
+    while position + block_size <= data_size:
+
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+
+        candidates = signature_index.get(weak)
+        if candidates:
+            strong = hashlib.blake2b(data[position:position + block_size], digest_size=STRONG_HASH_LEN).digest()
+            matches = [i for i, block_strong in candidates if block_strong == strong]
+
+            if matches:
+                # Prefer the block that continues the current copy run.
+                block = copy_start + copy_count if copy_start + copy_count in matches else matches[0]
+
+                if literal_start < position:
+                    if copy_count:
+                        yield ("COPY", copy_start, copy_count)
+                        copy_count = 0
+                    yield ("DATA", data[literal_start:position])
+
+                if copy_count and block == copy_start + copy_count:
+                    copy_count += 1
+                else:
+                    if copy_count:
+                        yield ("COPY", copy_start, copy_count)
+                    copy_start, copy_count = block, 1
+
+                position += block_size
+                literal_start = last_match = position
+                weak = None
+                continue
+
+        if position - last_match >= DELTA_SCAN_LIMIT and position >= scan_until:
+            probes += 1
+            if probes % DELTA_RESYNC_BLOCKS:
+                position += block_size
+                weak = None
+            else:
+                scan_until = position + block_size
+
+        if weak is not None:
+            if position + block_size < data_size:
+                weak = roll_adler32(weak, block_size, data[position], data[position + block_size])
+            position += 1
+
+        if position - literal_start >= DELTA_LITERAL_SIZE:
+            if copy_count:
+                yield ("COPY", copy_start, copy_count)
+                copy_count = 0
+            yield ("DATA", data[literal_start:position])
+            literal_start = position
+
+    if copy_count:
+        yield ("COPY", copy_start, copy_count)
+    for start in range(literal_start, data_size, DELTA_LITERAL_SIZE):
+        yield ("DATA", data[start:min(start + DELTA_LITERAL_SIZE, data_size)])
+
+class HashingWriter:
+
+    # File-like object for recv_file that hashes what it writes.
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        self.f.write(data)
+
+class DrainingWriter:
+
+    # File-like object for recv_file that writes to f until a write
+    # fails, keeps that error and then discards the rest, so a local
+    # error does not leave a body read in part. f may be None, with
+    # error already set.
+    def __init__(self, f):
+        self.f = f
+        self.error = None
+
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.f.write(data)
+            except OSError as e:
+                self.error = e
+
+########################################################################
+# Integrity checks
+########################################################################
+
+# VGET and VPUT send the body in VERIFY_CHUNK_SIZE pieces and follow it
+# with a digest trailer that the sender computes as the chunks go out
+# and the receiver as they come in, so neither side reads the file a
+# second time. CRC32 (zlib) and BLAKE2b are always available; CRC32C
+# needs the optional crc32c module.
+
+class RunningChecksum:
+
+    # hashlib-style wrapper for checksum functions called as
+    # function(data, previous_value), such as zlib.crc32.
+    digest_size = 4
+
+    def __init__(self, function):
+        self.function = function
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(RunningChecksum.digest_size, byteorder='big')
+
+def make_digest(algorithm):
+
+    # New digest object for an algorithm id, or None if this side does
+    # not support it.
+    if algorithm == DIGEST["crc32"]:
+        return RunningChecksum(zlib.crc32)
+    if algorithm == DIGEST["blake2b"]:
+        return hashlib.blake2b(digest_size=BLAKE2B_DIGEST_LEN)
+    if algorithm == DIGEST["crc32c"] and crc32c is not None:
+        return RunningChecksum(crc32c.crc32c)
+    return None
+
+def send_with_digest(sock, f, count, digest):
+
+    # Send count bytes of f, then the digest of what was sent.
+    buffer = bytearray(VERIFY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = count
+
+    while remaining:
+        read_count = f.readinto(view[:min(VERIFY_CHUNK_SIZE, remaining)])
+        if not read_count:
+            raise OSError("file shrank while it was being sent")
+        digest.update(view[:read_count])
+        sock.sendall(view[:read_count])
+        remaining -= read_count
+
+    sock.sendall(digest.digest())
+
+def file_digest(path):
+
+    # SHA-256 of a whole local file, for when it was not computed while
+    # the file was transferred.
+    digest = hashlib.sha256()
+    buffer = bytearray(VERIFY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while read_count := f.readinto(buffer):
+            digest.update(view[:read_count])
+    return digest.digest()
+
+def read_range_validator(path):
+
+    # The (file size, mtime in ns) saved by save_range_validator, or
+    # None if there is none or it cannot be read.
+    try:
+        with open(path, 'rb') as f:
+            fields = f.read(FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
+    except OSError:
+        return None
+
+    if len(fields) != FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:
+        return None
+
+    return (int.from_bytes(fields[:FILESIZE_FIELD_LEN], byteorder='big'),
+            int.from_bytes(fields[FILESIZE_FIELD_LEN:], byteorder='big'))
+
+def save_range_validator(path, file_size, mtime_ns):
+
+    # Record which version of a remote file a partial download is a
+    # prefix of, in the form of GETRANGE's If-Range fields.
+    with open(path, 'wb') as f:
+        f.write(file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big'))
+
+def remove_range_validator(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def recv_with_digest(sock, f, count, digest):
+
+    # Receive count bytes into f and then the sender's trailer.
+    # Returns None if the connection failed, else whether the trailer
+    # matched.
+    if not recv_file(sock, HashingWriter(f, digest), count, bytearray(VERIFY_CHUNK_SIZE)):
+        return None
+
+    status, trailer = recv_bytes(sock, digest.digest_size)
+
+    if not status:
+        return None
+
+    return trailer == digest.digest()
+
+########################################################################
+# Directory sync
+########################################################################
+
+# SYNC makes a folder tree on one side match a tree on the other, in
+# either direction, moving only the files that differ:
+#
+#   1. SYNCLIST returns the server's manifest of a folder in the share
+#      folder: the path, size and mtime of every regular file under it.
+#      The client builds the manifest of its own folder the same way.
+#   2. A file the destination lacks, or has with another size, is
+#      copied. One with the same size and mtime is taken to be the
+#      same, as rsync does by default. Only for the rest, same size
+#      but another mtime, are SHA-256 digests compared, the server's
+#      from SYNCHASH, so a tree that was touched but not changed is
+#      not copied again.
+#   3. SYNCGET and SYNCPUT copy the files in batches. The client keeps
+#      several batches in flight, so a tree of small files is not
+#      copied at one round trip per file.
+#
+# A copy takes the mtime of its source, so that the next SYNC finds the
+# two equal without reading either. So does a local file that SYNC GET
+# finds the same by digest; a server file found the same by SYNC PUT
+# keeps its mtime, and its digest is cached. Nothing is ever deleted. Paths are
+# relative to the folder being synced and "/"-separated, and are sent
+# with a 2 byte size, so unlike names in the other commands they are
+# not limited to 255 bytes.
+
+def split_sync_path(path):
+
+    # The parts of a SYNC path. Every part must be a plain name, not
+    # empty, "." or "..", so that joined to a folder the path cannot
+    # leave it. Raises ValueError.
+    parts = path.split("/")
+    for part in parts:
+        if (part in ("", ".", "..") or "\\" in part or "\0" in part
+                or os.path.isabs(part) or os.path.splitdrive(part)[0]):
+            raise ValueError(f"bad path {path!r}")
+    return parts
+
+def join_sync_path(folder, path):
+    return f"{folder}/{path}" if folder else path
+
+def is_share_name(name):
+
+    # Whether name is a plain file name, a one-part SYNC path, that
+    # joined to a folder stays directly inside it.
+    try:
+        return len(split_sync_path(name)) == 1
+    except ValueError:
+        return False
+
+def tree_manifest(root, skip=()):
+
+    # {path: (size, mtime in ns)} for every regular file under root.
+    # Symbolic links are not followed, and top-level names in skip,
+    # the hidden temporary files of uploads in progress and folders
+    # that cannot be read are left out. Raises OSError if root itself
+    # cannot be read.
+    manifest = {}
+    pending = [(root, "")]
+
+    while pending:
+        folder, prefix = pending.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            if not prefix:
+                raise
+            continue
+
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if (not prefix and name in skip) or is_temp_file(name):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, prefix + name + "/"))
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    manifest[prefix + name] = (stat.st_size, stat.st_mtime_ns)
+
+    return manifest
+
+def encode_manifest(manifest):
+
+    # Entries of path size | path | 8 byte size | 8 byte mtime (ns), in
+    # path order. A name that is not valid UTF-8 cannot be sent and is
+    # left out.
+    body = bytearray()
+    for path in sorted(manifest):
+        try:
+            path_bytes = path.encode(MSG_ENCODING)
+        except UnicodeEncodeError:
+            continue
+        file_size, mtime_ns = manifest[path]
+        body += len(path_bytes).to_bytes(PATH_SIZE_FIELD_LEN, byteorder='big')
+        body += path_bytes
+        body += file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+        body += mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+    return body
+
+def parse_manifest(body):
+
+    # The inverse of encode_manifest. Every path is checked with
+    # split_sync_path, so a manifest from the server cannot name a file
+    # outside the folder it is synced into. Raises ValueError.
+    manifest = {}
+    position = 0
+
+    while position < len(body):
+        path_size = int.from_bytes(body[position:position + PATH_SIZE_FIELD_LEN], byteorder='big')
+        position += PATH_SIZE_FIELD_LEN
+        path = bytes(body[position:position + path_size]).decode(MSG_ENCODING)
+        position += path_size
+        fields = body[position:position + FILESIZE_FIELD_LEN + MTIME_FIELD_LEN]
+        position += FILESIZE_FIELD_LEN + MTIME_FIELD_LEN
+        if len(fields) != FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:
+            raise ValueError("manifest cut short")
+        split_sync_path(path)
+        manifest[path] = (int.from_bytes(fields[:FILESIZE_FIELD_LEN], byteorder='big'),
+                          int.from_bytes(fields[FILESIZE_FIELD_LEN:], byteorder='big'))
+
+    return manifest
+
+def sync_plan(source, destination):
+
+    # Compare two manifests. Returns the paths to copy, because the
+    # destination lacks them or has them with another size, and the
+    # paths whose size matches but mtime does not, whose contents must
+    # be compared. Both are in path order.
+    copy = []
+    compare = []
+
+    for path in sorted(source):
+        theirs = destination.get(path)
+        if theirs is None or theirs[0] != source[path][0]:
+            copy.append(path)
+        elif theirs[1] != source[path][1]:
+            compare.append(path)
+
+    return (copy, compare)
+
+########################################################################
+# Server-side storage, caches and statistics
+########################################################################
+
+# Uploads are written to a temporary file beside their final name (see
+# create_temp_file) and renamed over it once complete, so nobody ever
+# sees a partial file. DURABILITY_LEVELS says what else is done before
+# the upload is acknowledged:
+#   none   nothing: a crash may lose recent uploads, or leave a file
+#          under its final name whose data never reached the disk.
+#   file   the file's data is synced before the rename, and its folder
+#          after it.
+#   batch  the same, but the folder syncs are group-committed: uploads
+#          queue for a flusher thread, which syncs each folder once for
+#          all the renames in it. A batch starts as soon as the
+#          previous one is done, or after a delay, to gather more.
+# The data syncs are left to the uploading threads in both cases, so
+# that the kernel can merge those of concurrent uploads into one
+# journal commit.
+DURABILITY_LEVELS = ("none", "file", "batch")
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def sync_folder(path):
+
+    # Make renames in the folder durable. Windows cannot open a folder,
+    # and NTFS journals renames anyway.
+    if os.name == 'nt':
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DurableWrite:
+
+    # An upload being committed, renamed to path. Once done is set,
+    # error is the OSError that stopped it, if any.
+    def __init__(self, path):
+        self.path = path
+        self.error = None
+        self.done = threading.Event()
+
+class DurabilityScheduler:
+
+    # Commits uploads at one of the DURABILITY_LEVELS. submit takes a
+    # file that is still open, closes it and renames it into place;
+    # wait returns once the uploads given are durable. A caller with
+    # several files to commit, like DPUT, submits them all and then
+    # waits once.
+    def __init__(self, level, delay=0):
+        if level not in DURABILITY_LEVELS:
+            raise ValueError(f"unknown durability level {level!r}")
+
+        self.level = level
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.pending = []
+        self.batches = 0
+        self.files = 0
+        self.largest_batch = 0
+
+        if level == "batch":
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, f, temp_path, path):
+        write = DurableWrite(path)
+
+        try:
+            try:
+                f.flush()
+                if self.level != "none":
+                    fdatasync(f.fileno())
+            finally:
+                f.close()
+            os.replace(temp_path, path)
+        except OSError as e:
+            write.error = e
+            write.done.set()
+            return write
+
+        if self.level == "batch":
+            with self.condition:
+                self.pending.append(write)
+                self.condition.notify()
+        else:
+            self.sync_folders([write])
+
+        return write
+
+    def wait(self, writes):
+
+        # Raises the first error among writes.
+        for write in writes:
+            write.done.wait()
+
+        for write in writes:
+            if write.error is not None:
+                raise write.error
+
+    def commit(self, f, temp_path, path):
+        self.wait([self.submit(f, temp_path, path)])
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+            if self.delay:
+                time.sleep(self.delay)
+
+            with self.condition:
+                batch, self.pending = self.pending, []
+
+            self.sync_folders(batch)
+
+    def sync_folders(self, writes):
+
+        # Sync the folder of each of writes, once per folder, and mark
+        # them done.
+        if self.level != "none":
+            folders = {}
+            for write in writes:
+                folders.setdefault(os.path.dirname(write.path), []).append(write)
+
+            for folder, folder_writes in folders.items():
+                try:
+                    sync_folder(folder)
+                except OSError as e:
+                    for write in folder_writes:
+                        write.error = e
+
+        with self.condition:
+            self.batches += 1
+            self.files += len(writes)
+            self.largest_batch = max(self.largest_batch, len(writes))
+
+        for write in writes:
+            write.done.set()
+
+    def snapshot(self):
+        with self.condition:
+            return {"level": self.level, "delay_ms": self.delay * 1000, "batches": self.batches,
+                    "files": self.files, "largest_batch": self.largest_batch}
+
+class ChunkStore:
+
+    # Content-addressed backend for the share folder. Files are split
+    # into DEDUP_CHUNK_SIZE chunks, each kept once under
+    # chunks/<2 hex digits>/<sha256>, and every filename gets a JSON
+    # manifest with its size and list of chunk hashes. Identical
+    # chunks across uploads are therefore stored only once.
+    # Unreferenced chunks are not garbage collected.
+
+    def __init__(self, root, durability):
+        self.durability = durability
+        self.chunk_dir = os.path.join(root, "chunks")
+        self.manifest_dir = os.path.join(root, "manifests")
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def chunk_path(self, digest):
+        digest_hex = digest.hex()
+        return os.path.join(self.chunk_dir, digest_hex[:2], digest_hex)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    def put_chunk(self, digest, data, writes):
+
+        # Returns False if the data does not match its hash. Chunks are
+        # written to a temporary name and renamed, so concurrent
+        # uploads of the same chunk are harmless. The chunk is submitted
+        # for commit and the pending write appended to writes, for the
+        # caller to wait on before writing a manifest that uses it.
+        if hashlib.sha256(data).digest() != digest:
+            return False
+
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return True
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        f = open(temp_path, 'wb')
+        f.write(data)
+        writes.append(self.durability.submit(f, temp_path, path))
+        return True
+
+    def manifest_path(self, filename):
+
+        # Raises ValueError for a name that would lead out of the
+        # manifests folder.
+        if not is_share_name(filename):
+            raise ValueError(f"bad name {filename!r}")
+        return os.path.join(self.manifest_dir, filename)
+
+    def write_manifest(self, filename, file_size, digests):
+        path = self.manifest_path(filename)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        f = open(temp_path, 'w', encoding='utf-8')
+        json.dump({"size": file_size, "chunks": [digest.hex() for digest in digests]}, f)
+        self.durability.commit(f, temp_path, path)
+
+    def read_manifest(self, filename):
+        try:
+            with open(self.manifest_path(filename), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return (manifest["size"], [bytes.fromhex(digest) for digest in manifest["chunks"]])
+
+    def remove_manifest(self, filename):
+        try:
+            os.remove(self.manifest_path(filename))
+        except (OSError, ValueError):
+            pass
+
+    def names(self):
+        return [name for name in os.listdir(self.manifest_dir) if not name.endswith(".tmp")]
+
+    def open(self, filename):
+
+        # Returns a buffered reader over the file's chunks and its size.
+        # The reader has no fileno, so socket.sendfile falls back to
+        # reading it block by block.
+        manifest = self.read_manifest(filename)
+        if manifest is None:
+            raise FileNotFoundError(filename)
+
+        file_size, digests = manifest
+        return (io.BufferedReader(ChunkReader(self, file_size, digests), DEDUP_CHUNK_SIZE), file_size)
+
+class ChunkReader(io.RawIOBase):
+
+    # Seekable raw reader that presents a manifest's chunks as one file.
+
+    def __init__(self, store, file_size, digests):
+        self.store = store
+        self.file_size = file_size
+        self.digests = digests
+        self.position = 0
+        self.chunk_index = None
+        self.chunk_file = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.file_size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.file_size:
+            return 0
+
+        chunk_index, chunk_offset = divmod(self.position, DEDUP_CHUNK_SIZE)
+
+        if chunk_index != self.chunk_index:
+            if self.chunk_file:
+                self.chunk_file.close()
+            self.chunk_file = open(self.store.chunk_path(self.digests[chunk_index]), 'rb')
+            self.chunk_index = chunk_index
+
+        self.chunk_file.seek(chunk_offset)
+        count = self.chunk_file.readinto(memoryview(b)[:DEDUP_CHUNK_SIZE - chunk_offset])
+        self.position += count
+        return count
+
+    def close(self):
+        if self.chunk_file:
+            self.chunk_file.close()
+            self.chunk_file = None
+        super().close()
+
+class ListingCache:
+
+    # Pre-encoded LIST response (size field followed by the names). It
+    # is rebuilt only when the mtime of one of the watched folders
+    # changes; uploads handled by this server are appended in place.
+    #
+    # An mtime that is younger than MTIME_GRANULARITY when the folder
+    # is scanned is not trusted, since another change within the same
+    # clock tick would leave it unchanged; the next LIST rescans. After
+    # one of our own uploads the new mtime is taken as is, so a foreign
+    # change in that same tick shows up only with the next change.
+    MTIME_GRANULARITY = 1
+
+    def __init__(self, list_names, folders):
+        self.list_names = list_names
+        self.folders = folders
+        self.lock = threading.Lock()
+        self.mtimes = None
+        self.names = set()
+        self.buffer = bytearray()
+        self.response_bytes = None
+
+    def folder_mtimes(self):
+        return [os.stat(folder).st_mtime_ns for folder in self.folders]
+
+    def trusted_mtimes(self):
+        mtimes = self.folder_mtimes()
+        if time.time_ns() - max(mtimes) < ListingCache.MTIME_GRANULARITY * 10**9:
+            return None
+        return mtimes
+
+    def response(self):
+        with self.lock:
+            if self.mtimes is None or self.folder_mtimes() != self.mtimes:
+                self.rebuild()
+
+            if self.response_bytes is None:
+                self.response_bytes = bytes(self.buffer)
+
+            return self.response_bytes
+
+    def rebuild(self):
+        mtimes = self.trusted_mtimes()
+        names = self.list_names()
+        file_list_bytes = '\n'.join(names).encode(MSG_ENCODING)
+
+        self.names = set(names)
+        self.buffer = bytearray(len(file_list_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+        self.buffer += file_list_bytes
+        self.response_bytes = None
+        self.mtimes = mtimes
+
+    def add(self, name):
+
+        # Called after this server has stored name. If the cache was up
+        # to date before, it is brought up to date again without a
+        # rescan: the name is appended and the size field rewritten.
+        with self.lock:
+            if self.mtimes is None or name in self.names:
+                return
+
+            if len(self.buffer) > FILESIZE_FIELD_LEN:
+                self.buffer += b'\n'
+            self.buffer += name.encode(MSG_ENCODING)
+            self.buffer[:FILESIZE_FIELD_LEN] = (len(self.buffer) - FILESIZE_FIELD_LEN).to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+
+            self.names.add(name)
+            self.response_bytes = None
+            self.mtimes = self.folder_mtimes()
+
+# A SEARCH query is a list of terms, all of which a file must match:
+#
+#   prefix:TEXT     name starts with TEXT
+#   TEXT            name contains TEXT (also contains:TEXT)
+#   ext:EXT         extension, without the dot; case is ignored
+#   size>N          size compared with N bytes; also <, >=, <=, =, and
+#                   suffixes K, M, G (powers of 1024), e.g. size>1G
+#   mtime>WHEN      modified after WHEN, an ISO date or date and time
+#                   in the server's local time, or Unix seconds
+#
+# Terms are separated by spaces; quote a term that contains one.
+# Matching is case-sensitive, like RLISTP.
+
+QUERY_COMPARISONS = (">=", "<=", ">", "<", "=")
+
+def parse_query(text):
+
+    # Returns the query as a dict of prefixes and contains (lists), ext
+    # (a set, or None for any), and size and mtime (inclusive [low,
+    # high] bounds, mtime in ns). Raises ValueError for a malformed
+    # query.
+    query = {"prefixes": [], "contains": [], "ext": None, "size": [0, 2**64 - 1], "mtime": [0, 2**64 - 1]}
+
+    for term in shlex.split(text):
+        if "\n" in term:
+            raise ValueError("names do not contain newlines")
+
+        field, _, value = term.partition(":")
+        if field == "prefix" and value:
+            query["prefixes"].append(value)
+            continue
+        if field == "contains" and value:
+            query["contains"].append(value)
+            continue
+        if field == "ext" and value:
+            extensions = {value.lower().lstrip(".")}
+            query["ext"] = extensions if query["ext"] is None else query["ext"] & extensions
+            continue
+
+        for field in ("size", "mtime"):
+            if not term.startswith(field):
+                continue
+            comparison = next((c for c in QUERY_COMPARISONS if term.startswith(c, len(field))), None)
+            if comparison is None:
+                raise ValueError(f"{field} needs one of {' '.join(QUERY_COMPARISONS)}: {term}")
+            value = term[len(field) + len(comparison):]
+
+            try:
+                if field == "size":
+                    bound = parse_size(value)
+                else:
+                    try:
+                        seconds = float(value)
+                    except ValueError:
+                        seconds = datetime.datetime.fromisoformat(value).timestamp()
+                    bound = int(seconds * 10**9)
+            except ValueError:
+                raise ValueError(f"cannot read {field} {value!r}: {term}")
+
+            low, high = query[field]
+            if comparison in (">", ">="):
+                low = max(low, bound + (comparison == ">"))
+            if comparison in ("<", "<="):
+                high = min(high, bound - (comparison == "<"))
+            if comparison == "=":
+                low, high = max(low, bound), min(high, bound)
+            query[field] = [low, high]
+            break
+        else:
+            query["contains"].append(term)
+
+    return query
+
+def file_extension(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+class Catalog:
+
+    # Index of the share folder for SEARCH: the names in sorted order,
+    # the same names ordered by size and by mtime, and the names with
+    # each extension. A query starts from whichever of its terms the
+    # indexes narrow down most, found by bisection, and checks only
+    # those names against the rest. A substring on its own is found by
+    # str.find over all the names joined, built on first use after a
+    # change.
+    #
+    # The folder is scanned at start-up and rescanned on the same terms
+    # as ListingCache, when a folder's mtime shows a change this server
+    # did not make; uploads are applied in place by update(). Files
+    # rewritten in place by someone else keep their old size and mtime
+    # until the next rescan.
+    def __init__(self, scan, folders):
+        self.scan = scan
+        self.folders = folders
+        self.lock = threading.Lock()
+        self.mtimes = None
+        self.entries = {}
+        self.names = []
+        self.by_size = []
+        self.by_mtime = []
+        self.by_extension = {}
+        self.joined = None
+        self.offsets = None
+
+    def folder_mtimes(self):
+        return [os.stat(folder).st_mtime_ns for folder in self.folders]
+
+    def refresh(self):
+        with self.lock:
+            if self.mtimes is None or self.folder_mtimes() != self.mtimes:
+                self.rebuild()
+
+    def rebuild(self):
+        mtimes = self.folder_mtimes()
+        if mtimes and time.time_ns() - max(mtimes) < ListingCache.MTIME_GRANULARITY * 10**9:
+            mtimes = None
+
+        self.entries = {name: (file_size, mtime_ns) for name, file_size, mtime_ns in self.scan()}
+        self.names = sorted(self.entries)
+        self.by_size = sorted((file_size, name) for name, (file_size, _) in self.entries.items())
+        self.by_mtime = sorted((mtime_ns, name) for name, (_, mtime_ns) in self.entries.items())
+        self.by_extension = {}
+        for name in self.names:
+            self.by_extension.setdefault(file_extension(name), set()).add(name)
+        self.joined = None
+        self.mtimes = mtimes
+
+    def update(self, name, file_size, mtime_ns):
+
+        # Called after this server has stored name. As with
+        # ListingCache.add, a catalog that was up to date stays so.
+        with self.lock:
+            if self.mtimes is None:
+                return
+
+            old = self.entries.get(name)
+            if old is None:
+                bisect.insort(self.names, name)
+                self.by_extension.setdefault(file_extension(name), set()).add(name)
+                self.joined = None
+            else:
+                del self.by_size[bisect.bisect_left(self.by_size, (old[0], name))]
+                del self.by_mtime[bisect.bisect_left(self.by_mtime, (old[1], name))]
+
+            self.entries[name] = (file_size, mtime_ns)
+            bisect.insort(self.by_size, (file_size, name))
+            bisect.insort(self.by_mtime, (mtime_ns, name))
+            self.mtimes = self.folder_mtimes()
+
+    def search(self, query):
+
+        # (name, size, mtime_ns) of every file matching a parsed query,
+        # in name order.
+        self.refresh()
+
+        prefix = max(query["prefixes"], key=len, default="")
+        if not all(prefix.startswith(text) for text in query["prefixes"]):
+            return []
+
+        size_low, size_high = query["size"]
+        mtime_low, mtime_high = query["mtime"]
+        contains = query["contains"]
+
+        with self.lock:
+            low = bisect.bisect_left(self.names, prefix)
+            high = bisect.bisect_left(self.names, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else len(self.names)
+            candidates = self.names[low:high]
+            in_name_order = True
+
+            for index, (bound_low, bound_high) in ((self.by_size, query["size"]), (self.by_mtime, query["mtime"])):
+                low = bisect.bisect_left(index, (bound_low,))
+                high = bisect.bisect_left(index, (bound_high + 1,))
+                if high - low < len(candidates):
+                    candidates = [name for _, name in index[low:high]]
+                    in_name_order = False
+
+            with_extension = None
+            if query["ext"] is not None:
+                with_extension = set().union(*(self.by_extension.get(ext, ()) for ext in query["ext"]))
+                if len(with_extension) < len(candidates):
+                    candidates = with_extension
+                    in_name_order = False
+
+            if contains and len(candidates) == len(self.names):
+                candidates = self.find_substring(contains[0])
+                in_name_order = True
+
+            entries = self.entries
+            results = []
+            for name in candidates:
+                file_size, mtime_ns = entries[name]
+                if (size_low <= file_size <= size_high and mtime_low <= mtime_ns <= mtime_high
+                        and name.startswith(prefix)
+                        and (with_extension is None or name in with_extension)
+                        and (not contains or all(text in name for text in contains))):
+                    results.append((name, file_size, mtime_ns))
+
+        if not in_name_order:
+            results.sort()
+        return results
+
+    def find_substring(self, text):
+
+        # The names containing text. Names hold no newlines, so a match
+        # in the joined string lies within one name.
+        if self.joined is None:
+            self.joined = "\n".join(self.names)
+            self.offsets = list(itertools.accumulate((len(name) + 1 for name in self.names[:-1]), initial=0))
+
+        names = []
+        position = self.joined.find(text)
+        while position != -1:
+            index = bisect.bisect_right(self.offsets, position) - 1
+            names.append(self.names[index])
+            if index + 1 == len(self.names):
+                break
+            position = self.joined.find(text, self.offsets[index + 1])
+        return names
+
+class FileCache:
+
+    # LRU cache of share files for GET, bounded by max_bytes. A file of
+    # up to small_file_size bytes is kept as its complete GET response
+    # (size field and body); a larger one as a read-only mmap, so GET
+    # neither reopens nor copies it. An entry is used only while the
+    # inode, size and mtime from a fresh os.stat still match.
+    #
+    # A mapping must not see its file truncated, so the server writes
+    # uploads to a temporary file and renames it into place. Windows
+    # does not allow that rename while the file is mapped, so there
+    # only small files are cached.
+    MMAP_FILES = os.name != 'nt'
+
+    def __init__(self, folder, max_bytes, small_file_size):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.small_file_size = small_file_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, filename):
+
+        # Returns (file size, mtime in ns, body, GET response or None),
+        # or None if the file is not a plain file in the folder or is
+        # not cached (too big, or a large file on Windows). body
+        # supports the buffer protocol; callers must not hold on to it.
+        if is_temp_file(filename) or not is_share_name(filename):
+            return None
+
+        try:
+            stat = os.stat(os.path.join(self.folder, filename))
+        except (OSError, ValueError):
+            return None
+
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == key:
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        if stat.st_size > self.max_bytes // 4 or (stat.st_size > self.small_file_size and not FileCache.MMAP_FILES):
+            return None
+
+        value = self.load(filename, key)
+
+        if value is not None:
+            self.store(filename, key, value)
+
+        return value
+
+    def load(self, filename, key):
+        try:
+            with open(os.path.join(self.folder, filename), 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != key:
+                    return None
+
+                file_size_field = stat.st_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+
+                if stat.st_size <= self.small_file_size:
+                    response = file_size_field + f.read(stat.st_size)
+                    return (stat.st_size, stat.st_mtime_ns, memoryview(response)[FILESIZE_FIELD_LEN:], response)
+
+                return (stat.st_size, stat.st_mtime_ns, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), None)
+
+        except (OSError, ValueError):
+            return None
+
+    def store(self, filename, key, value):
+
+        # Evicted mappings are not closed: a GET may still be sending
+        # from one, and it is unmapped once the last reference is gone.
+        with self.lock:
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.size -= old[1][0]
+                self.invalidations += 1
+
+            self.entries[filename] = (key, value)
+            self.size += value[0]
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted[0]
+                self.evictions += 1
+
+    def invalidate(self, filename):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.size -= entry[1][0]
+                self.invalidations += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+def check_validator(validator, file_size, mtime_ns):
+
+    # Compare a CGET validator (size, server mtime, digest of the
+    # client's copy) with a share file. Returns True or False when the
+    # size and mtime settle it, or None when the digests have to be
+    # compared. Equal size and mtime are taken to mean the file is
+    # unchanged, as in rsync's quick check. A validator with a zero
+    # digest, sent when the client has no copy, never matches.
+    client_size = int.from_bytes(validator[:FILESIZE_FIELD_LEN], byteorder='big')
+    client_mtime_ns = int.from_bytes(validator[FILESIZE_FIELD_LEN:FILESIZE_FIELD_LEN + MTIME_FIELD_LEN],
+                                     byteorder='big')
+
+    if client_size != file_size or not any(validator[FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:]):
+        return False
+
+    if client_mtime_ns == mtime_ns:
+        return True
+
+    return None
+
+def check_range(validator, offset, file_size, mtime_ns):
+
+    # The status of a GETRANGE reply. validator is the request's
+    # If-Range fields: the size and mtime of the version the client's
+    # bytes before offset came from, both 0 when it has none. A file
+    # that no longer matches them is CHANGED, and the client has to
+    # start again from 0.
+    client_size = int.from_bytes(validator[:FILESIZE_FIELD_LEN], byteorder='big')
+    client_mtime_ns = int.from_bytes(validator[FILESIZE_FIELD_LEN:], byteorder='big')
+
+    if (client_size or client_mtime_ns) and (client_size, client_mtime_ns) != (file_size, mtime_ns):
+        return "CHANGED"
+
+    if offset > file_size:
+        return "BAD_RANGE"
+
+    return "OK"
+
+class DigestCache:
+
+    # SHA-256 digests of share files for CGET, and of their chunks for
+    # CHUNKS, remembered with the size and mtime they were computed
+    # for, so that a file that has since changed is never matched
+    # against a stale digest.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.chunk_entries = {}
+
+    def digest(self, filename, f, file_size, mtime_ns):
+        with self.lock:
+            entry = self.entries.get(filename)
+        if entry is not None and entry[:2] == (file_size, mtime_ns):
+            return entry[2]
+
+        digest = hashlib.sha256()
+        buffer = bytearray(FILE_CHUNK_SIZE)
+        view = memoryview(buffer)
+        f.seek(0)
+        while read_count := f.readinto(buffer):
+            digest.update(view[:read_count])
+        f.seek(0)
+
+        with self.lock:
+            self.entries[filename] = (file_size, mtime_ns, digest.digest())
+        return digest.digest()
+
+    def chunk_digests(self, filename, f, file_size, mtime_ns, chunk_size):
+
+        # Digests of each chunk_size piece of the file, the last one
+        # possibly shorter. The whole-file digest comes out of the same
+        # read and is remembered for CGET.
+        key = (filename, chunk_size)
+        with self.lock:
+            entry = self.chunk_entries.get(key)
+        if entry is not None and entry[:2] == (file_size, mtime_ns):
+            return entry[2]
+
+        digests = []
+        whole = hashlib.sha256()
+        buffer = bytearray(FILE_CHUNK_SIZE)
+        view = memoryview(buffer)
+        f.seek(0)
+        remaining = file_size
+        while remaining:
+            digest = hashlib.sha256()
+            chunk_remaining = min(chunk_size, remaining)
+            while chunk_remaining:
+                read_count = f.readinto(view[:min(len(buffer), chunk_remaining)])
+                if not read_count:
+                    raise OSError(f"{filename} is shorter than {file_size} bytes")
+                digest.update(view[:read_count])
+                whole.update(view[:read_count])
+                chunk_remaining -= read_count
+                remaining -= read_count
+            digests.append(digest.digest())
+        f.seek(0)
+
+        with self.lock:
+            self.chunk_entries[key] = (file_size, mtime_ns, digests)
+            self.entries[filename] = (file_size, mtime_ns, whole.digest())
+        return digests
+
+    def invalidate(self, filename):
+        with self.lock:
+            self.entries.pop(filename, None)
+            for key in [key for key in self.chunk_entries if key[0] == filename]:
+                del self.chunk_entries[key]
+
+class PoolStats:
+
+    # Counters for the worker pool. A connection is queued from the
+    # moment it is admitted until a worker picks it up; the time it
+    # spent there is its wait time. The last WAIT_SAMPLES wait times
+    # are kept for percentiles.
+    WAIT_SAMPLES = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.active = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits = collections.deque(maxlen=PoolStats.WAIT_SAMPLES)
+
+    def admitted(self):
+        with self.lock:
+            self.accepted += 1
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def refused(self):
+        with self.lock:
+            self.rejected += 1
+
+    def started(self, wait):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.waits.append(wait)
+
+    def finished(self):
+        with self.lock:
+            self.active -= 1
+
+    def snapshot(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            started = self.accepted - self.queued
+
+            def percentile(p):
+                return waits[min(len(waits) - 1, int(len(waits) * p))] if waits else 0.0
+
+            return {"accepted": self.accepted,
+                    "rejected": self.rejected,
+                    "queued": self.queued,
+                    "max_queued": self.max_queued,
+                    "active": self.active,
+                    "wait_mean_ms": round(1000 * self.wait_total / started, 3) if started else 0.0,
+                    "wait_p50_ms": round(1000 * percentile(0.50), 3),
+                    "wait_p95_ms": round(1000 * percentile(0.95), 3),
+                    "wait_max_ms": round(1000 * self.wait_max, 3)}
+
+########################################################################
+# Bandwidth shaping
+########################################################################
+
+# With a rate limit set, every send on a client connection is paced by
+# a global token bucket and by one per client host. Sends are cut into
+# SHAPING_CHUNK_SIZE pieces and transfers take turns at the global
+# bucket a piece at a time, in the order they asked, so a small GET
+# waits behind at most one piece of each bulk transfer instead of
+# behind whole files. Limits can be changed while the server runs.
+
+SHAPING_BURST_SECONDS = 0.1
+
+def parse_size(text):
+
+    # "512", "64K", "16M" or "1G" -> bytes.
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    text = text.strip().upper().rstrip("B")
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+class TokenBucket:
+
+    # rate bytes per second (0 for unlimited), holding at most burst
+    # bytes of credit. take() never refuses: it charges the bucket,
+    # letting it go into debt, and returns how long the caller must
+    # wait before sending. Concurrent callers thus queue up behind one
+    # another's debt.
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count):
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self.refill()
+            self.tokens -= count
+            return max(0.0, -self.tokens / self.rate)
+
+class BandwidthShaper:
+
+    def __init__(self, global_rate, client_rate, chunk_size):
+        self.lock = threading.Lock()
+        self.chunk_size = chunk_size
+        self.global_rate = global_rate
+        self.client_rate = client_rate
+        self.global_bucket = TokenBucket(global_rate, self.burst(global_rate))
+        # host -> [TokenBucket, open connections]
+        self.clients = {}
+        # Events of the transfers waiting for the global bucket; the
+        # one at the front is set.
+        self.turns = collections.deque()
+        self.shaped_bytes = 0
+        self.throttled_seconds = 0.0
+
+    def burst(self, rate):
+        return max(self.chunk_size, int(rate * SHAPING_BURST_SECONDS))
+
+    def active(self):
+        return bool(self.global_rate or self.client_rate)
+
+    def set_limits(self, global_rate, client_rate):
+        with self.lock:
+            self.global_rate = global_rate
+            self.client_rate = client_rate
+            self.global_bucket.configure(global_rate, self.burst(global_rate))
+            for bucket, _ in self.clients.values():
+                bucket.configure(client_rate, self.burst(client_rate))
+
+    def connected(self, host):
+        with self.lock:
+            entry = self.clients.get(host)
+            if entry is None:
+                entry = self.clients[host] = [TokenBucket(self.client_rate, self.burst(self.client_rate)), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def disconnected(self, host):
+        with self.lock:
+            entry = self.clients[host]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.clients[host]
+
+    def send(self, sock, data, client_bucket):
+
+        # sendall, a paced piece at a time.
+        view = memoryview(data).cast('B')
+
+        for start in range(0, len(view), self.chunk_size):
+            piece = view[start:start + self.chunk_size]
+            self.pace(len(piece), client_bucket)
+            sock.sendall(piece)
+
+    def pace(self, count, client_bucket):
+
+        # The client's own limit is waited out without holding a turn,
+        # so a throttled client does not hold up anyone else.
+        waited = client_bucket.take(count)
+        if waited:
+            time.sleep(waited)
+
+        turn = threading.Event()
+        with self.lock:
+            self.turns.append(turn)
+            if len(self.turns) == 1:
+                turn.set()
+        turn.wait()
+
+        delay = 0.0
+        try:
+            delay = self.global_bucket.take(count)
+            if delay:
+                time.sleep(delay)
+        finally:
+            with self.lock:
+                self.turns.popleft()
+                if self.turns:
+                    self.turns[0].set()
+                self.shaped_bytes += count
+                self.throttled_seconds += waited + delay
+
+    def snapshot(self):
+        with self.lock:
+            return {"global_rate": self.global_rate,
+                    "client_rate": self.client_rate,
+                    "clients": len(self.clients),
+                    "waiting_transfers": len(self.turns),
+                    "shaped_bytes": self.shaped_bytes,
+                    "throttled_seconds": round(self.throttled_seconds, 3)}
+
+class ShapedSocket:
+
+    # Stands in for a client connection so that the sendall and
+    # sendfile calls of every command handler go through the shaper.
+    # Everything else is passed straight to the socket, as are sends
+    # while no limit is set.
+    def __init__(self, sock, shaper, host):
+        self.sock = sock
+        self.shaper = shaper
+        self.client_bucket = shaper.connected(host)
+        self.host = host
+        # The methods every command uses, bound here rather than
+        # found through __getattr__ each time.
+        self.recv_into = sock.recv_into
+        self.fileno = sock.fileno
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        if not self.shaper.active():
+            return self.sock.sendall(data)
+        self.shaper.send(self.sock, data, self.client_bucket)
+
+    def sendfile(self, file, offset=0, count=None):
+        if not self.shaper.active():
+            return self.sock.sendfile(file, offset, count)
+
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        file.seek(offset)
+        buffer = bytearray(self.shaper.chunk_size)
+        view = memoryview(buffer)
+        sent = 0
+
+        while sent < count:
+            read_count = file.readinto(view[:min(len(view), count - sent)])
+            if not read_count:
+                break
+            self.shaper.send(self.sock, view[:read_count], self.client_bucket)
+            sent += read_count
+
+        return sent
+
+    def close(self):
+        if self.host is not None:
+            self.shaper.disconnected(self.host)
+            self.host = None
+        self.sock.close()
+
+########################################################################
+# Multiplexed sessions
+########################################################################
+
+# After MUX, a connection carries frames instead of single commands:
+#
+#   4 byte stream id | 1 byte frame type | 4 byte length | payload
+#
+# The client opens a stream with an empty DATA frame on the next odd
+# stream id; ids only ever increase. Each stream carries one command
+# exchange, written and read exactly as on a plain connection. Each
+# side sends END when it closes the stream and forgets it; DATA that
+# arrives for a forgotten stream is answered with RESET, which makes
+# the sender's writes fail.
+#
+# Flow control is per stream: a side may have at most MUX_WINDOW_SIZE
+# bytes of DATA unread by the other, which returns credit with WINDOW
+# (a 4 byte increment) as it reads. A large GET therefore never holds
+# more than a window in front of a LIST sent after it. The window
+# trades one against the other: a stream moves at most a window per
+# round trip, and a LIST may wait behind a window of queued GET data.
+
+MUX_FRAME = {"DATA": 0, "END": 1, "WINDOW": 2, "RESET": 3}
+
+STREAM_ID_FIELD_LEN = 4
+FRAME_TYPE_FIELD_LEN = 1
+WINDOW_FIELD_LEN = 4
+MUX_HEADER_LEN = STREAM_ID_FIELD_LEN + FRAME_TYPE_FIELD_LEN + FRAME_SIZE_FIELD_LEN
+MUX_FRAME_SIZE = 65536
+MUX_WINDOW_SIZE = 1048576
+
+class MuxStream:
+
+    # One stream of a MuxConnection, usable wherever the command
+    # handlers and Client methods expect a connected socket.
+    def __init__(self, mux, stream_id):
+        self.mux = mux
+        self.stream_id = stream_id
+        self.condition = threading.Condition()
+        self.timeout = SOCKET_TIMEOUT
+        # Received payloads not yet read, and the offset into the first.
+        self.chunks = collections.deque()
+        self.chunk_offset = 0
+        # Bytes the peer may still send, and bytes read but not yet
+        # credited back to it.
+        self.recv_window = MUX_WINDOW_SIZE
+        self.unacknowledged = 0
+        self.send_window = MUX_WINDOW_SIZE
+        self.eof = False
+        self.reset = False
+        self.closed = False
+
+    # Called by the MuxConnection reader.
+
+    def feed(self, payload):
+        with self.condition:
+            if len(payload) > self.recv_window:
+                return False
+            self.recv_window -= len(payload)
+            if payload and not self.closed:
+                self.chunks.append(payload)
+            self.condition.notify_all()
+            return True
+
+    def feed_eof(self):
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    def feed_reset(self):
+        with self.condition:
+            self.reset = True
+            self.condition.notify_all()
+
+    def grant(self, increment):
+        with self.condition:
+            self.send_window += increment
+            self.condition.notify_all()
+
+    # Socket interface.
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.chunks or self.eof or self.reset, self.timeout):
+                raise socket.timeout("timed out")
+
+            count = 0
+            while self.chunks and count < len(view):
+                chunk = self.chunks[0]
+                piece = min(len(chunk) - self.chunk_offset, len(view) - count)
+                view[count:count + piece] = chunk[self.chunk_offset:self.chunk_offset + piece]
+                count += piece
+                self.chunk_offset += piece
+                if self.chunk_offset == len(chunk):
+                    self.chunks.popleft()
+                    self.chunk_offset = 0
+
+            credit = 0
+            self.unacknowledged += count
+            if self.unacknowledged >= MUX_WINDOW_SIZE // 2 and not self.eof:
+                credit = self.unacknowledged
+                self.recv_window += credit
+                self.unacknowledged = 0
+
+        if credit:
+            self.mux.send_frame(self.stream_id, "WINDOW", credit.to_bytes(WINDOW_FIELD_LEN, byteorder='big'))
+        return count
+
+    def recv(self, bufsize):
+        buffer = bytearray(bufsize)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        sent = 0
+
+        while sent < len(view):
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.send_window > 0 or self.reset or self.closed,
+                                               self.timeout):
+                    raise socket.timeout("timed out")
+                if self.reset or self.closed:
+                    raise ConnectionResetError("stream was reset")
+                count = min(self.send_window, MUX_FRAME_SIZE, len(view) - sent)
+                self.send_window -= count
+
+            self.mux.send_frame(self.stream_id, "DATA", view[sent:sent + count])
+            sent += count
+
+    def sendfile(self, file, offset=0, count=None):
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        file.seek(offset)
+        buffer = bytearray(MUX_FRAME_SIZE)
+        view = memoryview(buffer)
+        sent = 0
+
+        while sent < count:
+            read_count = file.readinto(view[:min(len(view), count - sent)])
+            if not read_count:
+                break
+            self.sendall(view[:read_count])
+            sent += read_count
+
+        return sent
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.chunks.clear()
+
+        self.mux.release(self)
+        if not self.reset:
+            try:
+                self.mux.send_frame(self.stream_id, "END")
+            except OSError:
+                pass
+
+class MuxConnection:
+
+    # Both ends of a multiplexed session. run() reads frames and hands
+    # them to the streams; it never waits on a stream, which flow
+    # control keeps from buffering more than a window each. On the
+    # server, on_stream is called with each stream the client opens.
+    def __init__(self, sock, on_stream=None, max_streams=0):
+        self.sock = sock
+        self.on_stream = on_stream
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.streams = {}
+        self.next_stream_id = 1
+        self.last_peer_stream_id = 0
+        self.closed = False
+
+    def send_frame(self, stream_id, frame_type, payload=b''):
+        frame = bytearray(stream_id.to_bytes(STREAM_ID_FIELD_LEN, byteorder='big'))
+        frame += MUX_FRAME[frame_type].to_bytes(FRAME_TYPE_FIELD_LEN, byteorder='big')
+        frame += len(payload).to_bytes(FRAME_SIZE_FIELD_LEN, byteorder='big')
+        frame += payload
+        with self.write_lock:
+            self.sock.sendall(frame)
+
+    def open_stream(self):
+
+        # The opening frame is sent under the lock so that streams
+        # opened by different threads reach the peer in id order.
+        with self.lock:
+            stream = MuxStream(self, self.next_stream_id)
+            self.streams[stream.stream_id] = stream
+            self.next_stream_id += 2
+            self.send_frame(stream.stream_id, "DATA")
+            return stream
+
+    def release(self, stream):
+        with self.lock:
+            self.streams.pop(stream.stream_id, None)
+
+    def run(self, idle_timeout=None):
+        try:
+            while True:
+                deadline = time.monotonic() + idle_timeout if idle_timeout else None
+                status, header = recv_exactly(self.sock, MUX_HEADER_LEN, bytearray(MUX_HEADER_LEN), deadline)
+                if not status:
+                    return
+
+                stream_id = int.from_bytes(header[:STREAM_ID_FIELD_LEN], byteorder='big')
+                frame_type = header[STREAM_ID_FIELD_LEN]
+                length = int.from_bytes(header[STREAM_ID_FIELD_LEN + FRAME_TYPE_FIELD_LEN:], byteorder='big')
+
+                if length > MUX_FRAME_SIZE:
+                    print(f"Oversized frame on stream {stream_id}, closing the session.")
+                    return
+
+                status, payload = recv_exactly(self.sock, length, bytearray(length))
+                if not status:
+                    return
+
+                self.dispatch(stream_id, frame_type, payload)
+        except OSError:
+            return
+        finally:
+            self.close()
+
+    def dispatch(self, stream_id, frame_type, payload):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            opened = False
+            if (stream is None and self.on_stream is not None and frame_type == MUX_FRAME["DATA"]
+                    and stream_id > self.last_peer_stream_id):
+                self.last_peer_stream_id = stream_id
+                if len(self.streams) < self.max_streams:
+                    stream = self.streams[stream_id] = MuxStream(self, stream_id)
+                    opened = True
+
+        if stream is None:
+            # A frame for a stream already closed here, or for one
+            # refused because too many are open.
+            if frame_type == MUX_FRAME["DATA"]:
+                self.send_frame(stream_id, "RESET")
+            return
+
+        if frame_type == MUX_FRAME["DATA"]:
+            if not stream.feed(payload):
+                print(f"Stream {stream_id} overran its window, resetting it.")
+                stream.feed_reset()
+                self.send_frame(stream_id, "RESET")
+        elif frame_type == MUX_FRAME["END"]:
+            stream.feed_eof()
+        elif frame_type == MUX_FRAME["WINDOW"]:
+            stream.grant(int.from_bytes(payload, byteorder='big'))
+        elif frame_type == MUX_FRAME["RESET"]:
+            stream.feed_reset()
+
+        if opened:
+            self.on_stream(stream)
+
+    def close(self):
+
+        # The connection is gone: wake every stream still waiting on it.
+        with self.lock:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.feed_reset()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
 
 class Server:
     
@@ -50,6 +2185,78 @@ class Server:
 
     FILE_NOT_FOUND_MSG = "Error: Requested file is not available!"
     REMOTE_FOLDER_LIST = "D:/McMaster/4DN4/lab3/server_send"
+
+    # Serve GET from disk with sendfile instead of reading the whole
+    # file into memory. Set to False to use the original text path.
+    GET_ZERO_COPY = True
+
+    # A connection stays open for further commands until BYE, or until
+    # it has been idle this many seconds.
+    SESSION_IDLE_TIMEOUT = 60
+
+    # Keep DPUT uploads in a content-addressed chunk store inside the
+    # share folder instead of as plain files.
+    DEDUP_STORE = False
+    STORE_FOLDER_NAME = ".store"
+
+    # The largest file a DPUT may announce. Its chunk hashes are held in
+    # memory until the manifest is written, 32 bytes per
+    # DEDUP_CHUNK_SIZE of file.
+    MAX_DEDUP_FILE_SIZE = 64 * 1024 * 1024 * 1024
+
+    # Answer LIST from a cached, pre-encoded response that is rebuilt
+    # only when the share folder changes.
+    LIST_CACHE = True
+
+    # Keep a catalog of the share folder in memory for SEARCH, built
+    # at start-up, instead of scanning the folder for every query.
+    CATALOG = True
+
+    # Codecs ZGET may use, best first, when the client can decode
+    # more than one.
+    COMPRESSION_PREFERENCE = ["zlib", "lzma"]
+
+    # How connections are served: "thread" starts a thread for every
+    # connection; "pool" runs them on POOL_WORKERS threads and queues
+    # at most POOL_QUEUE_SIZE more. Either way every connection starts
+    # with an admission status byte: OK, or in pool mode BUSY followed
+    # by a close when the queue is full.
+    EXECUTOR = "thread"
+    POOL_WORKERS = 16
+    POOL_QUEUE_SIZE = 64
+    LISTEN_BACKLOG = 128
+
+    # Files MGET may have opened or read ahead of the one being sent.
+    MGET_READ_AHEAD = 8
+
+    # Serve GET and ranged GET of frequently requested files from an
+    # LRU cache of FILE_CACHE_SIZE bytes: files up to
+    # FILE_CACHE_SMALL_FILE_SIZE as bytes, larger ones memory-mapped.
+    FILE_CACHE = True
+    FILE_CACHE_SIZE = 256 * 1024 * 1024
+    FILE_CACHE_SMALL_FILE_SIZE = 64 * 1024
+
+    # Bandwidth limits in bytes per second, 0 for none: RATE_LIMIT for
+    # the server as a whole, CLIENT_RATE_LIMIT for each client host.
+    # LIMIT changes both at run time, but only from LIMIT_ALLOWED_HOSTS.
+    RATE_LIMIT = 0
+    CLIENT_RATE_LIMIT = 0
+    SHAPING_CHUNK_SIZE = 64 * 1024
+    LIMIT_ALLOWED_HOSTS = ["127.0.0.1", "::1"]
+
+    # Streams a multiplexed session may have open at once, each served
+    # by its own thread.
+    MUX_MAX_STREAMS = 64
+
+    # How uploads are committed, one of DURABILITY_LEVELS, and for
+    # "batch" how long the flusher waits to gather more uploads into a
+    # batch; at 0 a batch is whatever arrived during the last one.
+    # "file" and "batch" cost every upload a data sync and a folder
+    # sync, and batching only the folder syncs has not measured faster
+    # than "file" (lab3_benchmark.py durability), so by default uploads
+    # are only renamed into place.
+    DURABILITY = "none"
+    DURABILITY_BATCH_MS = 0
     MSG_ENCODING = "utf-8"
     MESSAGE =  "Lifeng's File Sharing Service"
     MESSAGE_ENCODED = MESSAGE.encode('utf-8')
@@ -58,29 +2265,116 @@ class Server:
 
     def __init__(self):
         self.thread_list = []
+
+        removed = sweep_temp_files(Server.REMOTE_FOLDER_LIST)
+        if removed:
+            print(f"Removed {removed} temporary files left by interrupted uploads.")
+
+        self.pool_stats = PoolStats()
+        self.executor = None
+        if Server.EXECUTOR == "pool":
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=Server.POOL_WORKERS)
+            self.admission = threading.BoundedSemaphore(Server.POOL_WORKERS + Server.POOL_QUEUE_SIZE)
+
+        self.durability = DurabilityScheduler(Server.DURABILITY, Server.DURABILITY_BATCH_MS / 1000)
+
+        self.chunk_store = None
+        if Server.DEDUP_STORE:
+            self.chunk_store = ChunkStore(os.path.join(Server.REMOTE_FOLDER_LIST, Server.STORE_FOLDER_NAME),
+                                          self.durability)
+
+        self.digest_cache = DigestCache()
+
+        self.file_cache = None
+        if Server.FILE_CACHE:
+            self.file_cache = FileCache(Server.REMOTE_FOLDER_LIST, Server.FILE_CACHE_SIZE,
+                                        Server.FILE_CACHE_SMALL_FILE_SIZE)
+
+        self.shaper = BandwidthShaper(Server.RATE_LIMIT, Server.CLIENT_RATE_LIMIT, Server.SHAPING_CHUNK_SIZE)
+
+        folders = [Server.REMOTE_FOLDER_LIST]
+        if self.chunk_store is not None:
+            folders.append(self.chunk_store.manifest_dir)
+
+        self.listing_cache = None
+        if Server.LIST_CACHE:
+            self.listing_cache = ListingCache(self.list_share_files, folders)
+
+        self.catalog = None
+        if Server.CATALOG:
+            self.catalog = Catalog(self.scan_share_files, folders)
+            self.catalog.refresh()
+
         self.create_listen_sockets()
         #self.process_connections_forever()
 
     def create_listen_sockets(self):
 
         udp_thread = threading.Thread(target=self.start_udp_server)
+        udp_thread.daemon = True
         udp_thread.start()
         self.start_tcp_server()
 
     # Start the TCP server for file sharing
     def start_tcp_server(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind(('', self.FILE_SHARING_PORT))
-        server_socket.listen(5)
-        server_socket.setblocking(0) 
+        server_socket.listen(Server.LISTEN_BACKLOG)
         print(f"Listening for file sharing connections on port {self.FILE_SHARING_PORT}.")
         
         while True:
             client_socket, addr = server_socket.accept()
+            client_socket.settimeout(SOCKET_TIMEOUT)
+            # Responses go out as a header write followed by the body. On
+            # a session connection Nagle would hold the body back until
+            # the client's delayed ACK for the header.
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             print(f"Connection received from {addr[0]} on port {addr[1]}.")
-            client_thread = threading.Thread(target=self.handle_tcp_client, args=(client_socket,))
+
+            if self.executor is not None:
+                self.submit_tcp_client(client_socket, addr)
+                continue
+
+            if not self.send_status(client_socket, "OK"):
+                client_socket.close()
+                continue
+
+            self.pool_stats.admitted()
+            client_thread = threading.Thread(target=self.run_tcp_client, args=(client_socket, addr, time.monotonic()))
+            client_thread.daemon = True
             client_thread.start()
 
+    def submit_tcp_client(self, client_socket, addr):
+
+        # Admission control: a slot is held from accept until the
+        # connection is closed, so at most POOL_QUEUE_SIZE connections
+        # wait for a worker. Beyond that the client gets BUSY at once
+        # rather than waiting an unbounded time.
+        if not self.admission.acquire(blocking=False):
+            self.pool_stats.refused()
+            print(f"Server busy, rejecting {addr}.")
+            self.send_status(client_socket, "BUSY")
+            client_socket.close()
+            return
+
+        if not self.send_status(client_socket, "OK"):
+            self.admission.release()
+            client_socket.close()
+            return
+
+        self.pool_stats.admitted()
+        self.executor.submit(self.run_tcp_client, client_socket, addr, time.monotonic())
+
+    def run_tcp_client(self, client_socket, addr, queued_at):
+        self.pool_stats.started(time.monotonic() - queued_at)
+        try:
+            self.handle_tcp_client((client_socket, addr))
+        finally:
+            self.pool_stats.finished()
+            if self.executor is not None:
+                self.admission.release()
+
     # Start the UDP server for service discovery
     def start_udp_server(self):
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -91,7 +2385,7 @@ class Server:
         while True:
             data, addr = udp_socket.recvfrom(1024)
             if data.decode('utf-8') == "SERVICE DISCOVERY":
-                response = self.SERVICE_NAME.encode('utf-8')
+                response = discovery_response(self.broadcast_msg, self.FILE_SHARING_PORT)
                 udp_socket.sendto(response, addr)
 
         '''
@@ -162,457 +2456,3883 @@ class Server:
             print(msg)
             sys.exit(1)
 
-    def handle_tcp_client(self, client):
+    def open_share_file(self, filename):
 
-        connection, address = client
+        # Returns an open binary file and its size. Plain files in the
+        # share folder take precedence over the chunk store. Raises
+        # FileNotFoundError if the file is in neither.
+        f, file_size, _ = self.open_share_file_stat(filename)
+        return (f, file_size)
 
-        print("\n")
+    def open_share_file_stat(self, filename):
 
-        status, cmd_field = recv_bytes(connection, CMD_FIELD_LEN)
+        # open_share_file, plus the file's mtime in nanoseconds. For the
+        # chunk store that is the manifest's, read before it is opened,
+        # so the mtime is never newer than the content. Only plain
+        # names in the share folder are served.
+        if is_temp_file(filename) or not is_share_name(filename):
+            raise FileNotFoundError(filename)
 
-        '''
-        if not status:
-            print("Status false, closing connection ...")
-            connection.close()
-            return
-        '''
+        try:
+            f = open(os.path.join(Server.REMOTE_FOLDER_LIST, filename), 'rb')
+            stat = os.fstat(f.fileno())
+            return (f, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            if self.chunk_store is None:
+                raise
+            try:
+                mtime_ns = os.stat(self.chunk_store.manifest_path(filename)).st_mtime_ns
+            except ValueError:
+                raise FileNotFoundError(filename)
+            f, file_size = self.chunk_store.open(filename)
+            return (f, file_size, mtime_ns)
+
+    def send_file(self, connection, filename):
+
+        # Binary-safe GET: the size field comes from fstat and the body
+        # is handed to the kernel with sendfile, so memory use does not
+        # grow with the file size. Cached files skip the open.
+        if self.file_cache is not None:
+            cached = self.file_cache.lookup(filename)
+
+            if cached is not None:
+                file_size, _, body, response = cached
+                if response is not None:
+                    connection.sendall(response)
+                else:
+                    connection.sendall(file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+                    send_buffer(connection, body)
+                return
 
-        cmd = int.from_bytes(cmd_field, byteorder='big')
+        f, file_size = self.open_share_file(filename)
 
-        if cmd == CMD["LIST"]:
-            try:
-                
-                print("User try from server end: File Listing")
+        with f:
+            file_size_field = file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
 
-                files = os.listdir('D:/McMaster/4DN4/Lab3/server_send')
-                file_list_str = '\n'.join(files)
+            connection.sendall(file_size_field)
+            if file_size:
+                connection.sendfile(f, 0, file_size)
 
-                file_list_bytes = file_list_str.encode(MSG_ENCODING)
-                file_list_size = len(file_list_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+        print("File size: ", file_size_field.hex(), "\n")
 
-                connection.sendall(file_list_size + file_list_bytes)
-                print(f"File Listing sent to {address}")
+    def send_file_text(self, connection, filepath):
 
-            except Exception as e:
+        # Original GET path: decode the whole file as text and send it
+        # re-encoded in a single packet.
+        file = open(filepath, 'r', encoding='utf-8').read()
 
-                print(f"Sending file_listing wrong: {e}")
+        file_bytes = file.encode(MSG_ENCODING)
+        file_size_bytes = len(file_bytes)
+        file_size_field = file_size_bytes.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
 
-        elif cmd == CMD["GET"]:
+        pkt = file_size_field + file_bytes
 
-            print("User attempts to download file from server to client")
+        connection.sendall(pkt)
+        print("Sending packet...")
+        print("File size: ", file_size_field.hex(), "\n")
 
-            status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+    def recv_file(self, connection, filepath, file_size, receive=None):
 
-            if not status:
-                print("Failed to retrieve the size of the file to be downloaded, closing connection ...")            
-                connection.close()
-                return
+        # Streaming PUT: the upload goes to disk in FILE_CHUNK_SIZE
+        # pieces, into a temporary file that replaces filepath only once
+        # it is complete, and is committed at the DURABILITY level
+        # before this returns. A GET never sees a half-written file and
+        # a cached mapping of the old file is never truncated under it.
+        # If the client stalls or disconnects, or the file cannot be
+        # saved, the temporary file is removed. receive(f), if given,
+        # reads the body instead of the plain byte stream and returns a
+        # status.
+        #
+        # Returns (received, saved). A file that cannot be saved (no
+        # space, something in the way of the rename) is still read to
+        # the end, so received is False only when the connection can no
+        # longer be used.
+        writer = DrainingWriter(None)
+        temp_path = None
 
-            filename_size_bytes = int.from_bytes(filename_size_field, byteorder='big')
+        try:
+            fd, temp_path = create_temp_file(filepath)
+            writer.f = os.fdopen(fd, 'wb')
+            preallocate_file(writer.f, file_size)
+        except OSError as e:
+            writer.error = e
+
+        # Local write errors are kept by writer, so an OSError here is
+        # the connection's.
+        try:
+            if receive is None:
+                received = recv_file(connection, writer, file_size, bytearray(FILE_CHUNK_SIZE))
+            else:
+                received = receive(writer)
+        except OSError:
+            received = False
+
+        saved = False
+        if writer.f is not None:
+            try:
+                if received and writer.error is None:
+                    self.durability.commit(writer.f, temp_path, filepath)
+                    saved = True
+                else:
+                    writer.f.close()
+            except OSError as e:
+                writer.error = e
+
+        if not saved:
+            if writer.f is not None:
+                try:
+                    writer.f.close()
+                except OSError:
+                    pass
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+        if received and not saved:
+            print(f"Error saving file: {writer.error}")
+
+        return (received, saved)
 
-            if not filename_size_bytes:
-                print("Failed to retrieve the size of the file to be downloaded, closing connection ...")
-                connection.close()
-                return
-            
-            print('Size of the filename (in bytes): ', filename_size_bytes)
+    def handle_tcp_client(self, client):
 
-            status, filename_bytes = recv_bytes(connection, filename_size_bytes)
+        connection, address = client
+        connection = ShapedSocket(connection, self.shaper, address[0])
+
+        # Session mode: one connection carries any number of commands.
+        # It ends when the client sends BYE or closes its end, when a
+        # command fails, or after SESSION_IDLE_TIMEOUT seconds with no
+        # new command. A connection reset, or a name or pattern that is
+        # not valid UTF-8, ends the session the same way rather than
+        # the thread.
+        try:
+            while True:
 
-            if not status:
-                print("Failed to retrieve the filename to be downloaded, closing connection ...")            
-                connection.close()
-                return
-            
-            if not filename_bytes:
-                print("Failed to retrieve the filename to be downloaded, closing connection ...")
-                connection.close()
-                return
+                print("\n")
 
-            filename = filename_bytes.decode(MSG_ENCODING)
-            print('Filename requested by client: ', filename)
+                status, cmd_field = recv_exactly(connection, CMD_FIELD_LEN,
+                                                 deadline=time.monotonic() + Server.SESSION_IDLE_TIMEOUT)
 
-            try:
-                file = open(os.path.join('D:/McMaster/4DN4/Lab3/server_send', filename), 'r', encoding='utf-8').read()
+                if not status:
+                    print(f"Session with {address} ended, closing connection ...")
+                    break
 
-            except FileNotFoundError:
-                print(Server.FILE_NOT_FOUND_MSG)
-                connection.close()                   
-                return
+                cmd = int.from_bytes(cmd_field, byteorder='big')
 
-            file_bytes = file.encode(MSG_ENCODING)
-            file_size_bytes = len(file_bytes)
-            file_size_field = file_size_bytes.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                if not self.handle_command(connection, address, cmd):
+                    break
 
-            pkt = file_size_field + file_bytes
-            
-            try:
-                connection.sendall(pkt)
-                print("Sending packet...")
-                print("Sending file: ", filename)
-                print("File size: ", file_size_field.hex(), "\n")
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Session with {address} failed: {e}, closing connection ...")
 
-            except socket.error:
-                print("Closing client connection ...")
-                connection.close()
-                return
-            
-            finally:
-                connection.close()
-                return
-            
-        elif cmd == CMD["PUT"]:
+        finally:
+            connection.close()
 
-            print("User attempts to upload file from client to server")
+    def handle_command(self, connection, address, cmd):
 
-            status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+        # Returns True if the connection can carry another command.
+        if cmd == CMD["LIST"]:
+            return self.handle_list(connection, address)
 
-            if not status:
-                print("Failed to retrieve the size of the filename to be uploaded, closing connection ...")
-                connection.close()
-                return
-            
-            filename_size = int.from_bytes(filename_size_field, byteorder='big')
-            status, filename_bytes = recv_bytes(connection, filename_size)
+        elif cmd == CMD["GET"]:
+            return self.handle_get(connection, address)
 
-            if not status:
-                print("Failed to retrieve the filename to be uploaded, closing connection ...")
-                connection.close()
-                return
+        elif cmd == CMD["PUT"]:
+            return self.handle_put(connection, address)
 
-            filename = filename_bytes.decode(MSG_ENCODING)
+        elif cmd == CMD["GETRANGE"]:
+            return self.handle_get_range(connection, address)
 
-            print('Filename uploaded by client: ', filename)
+        elif cmd == CMD["DPUT"]:
+            return self.handle_dedup_put(connection, address)
 
-            status, file_size_bytes = recv_bytes(connection, FILESIZE_FIELD_LEN)
+        elif cmd == CMD["LISTPAGE"]:
+            return self.handle_list_page(connection, address)
 
-            if not status:
-                print("Failed to retrieve the size of the file to be uploaded, closing connection ...")
-                connection.close()
-                return
+        elif cmd == CMD["ZGET"]:
+            return self.handle_compressed_get(connection, address)
 
-            file_size = int.from_bytes(file_size_bytes, byteorder='big')  
-            print('File size received by server: ', file_size)
+        elif cmd == CMD["ZPUT"]:
+            return self.handle_compressed_put(connection, address)
 
-            status, file_data = recv_bytes(connection, file_size)
-            if not status:
-                print("Failed to retrieve the file data to be uploaded, closing connection ...")
-                connection.close()
-                return
+        elif cmd == CMD["STATS"]:
+            return self.handle_stats(connection, address)
 
-            try:
-                with open(os.path.join('D:/McMaster/4DN4/Lab3/server_send', filename), 'wb') as f:
-                    f.write(file_data)
-                print("File successfully uploaded to server and saved.")
-            except Exception as e:
-                print(f"Error saving file: {e}")            
-                
-        elif cmd == CMD["BYE"]:
+        elif cmd == CMD["RPUT"]:
+            return self.handle_delta_put(connection, address)
 
-            print("Received BYE command from client")
-            connection.sendall("Connection closed".encode('utf-8'))
+        elif cmd == CMD["MGET"]:
+            return self.handle_multi_get(connection, address)
+
+        elif cmd == CMD["VGET"]:
+            return self.handle_verified_get(connection, address)
+
+        elif cmd == CMD["VPUT"]:
+            return self.handle_verified_put(connection, address)
+
+        elif cmd == CMD["LIMIT"]:
+            return self.handle_limit(connection, address)
+
+        elif cmd == CMD["CGET"]:
+            return self.handle_conditional_get(connection, address)
+
+        elif cmd == CMD["MUX"]:
+            return self.handle_mux(connection, address)
+
+        elif cmd == CMD["CHUNKS"]:
+            return self.handle_chunks(connection, address)
+
+        elif cmd == CMD["SEARCH"]:
+            return self.handle_search(connection, address)
+
+        elif cmd == CMD["SYNCLIST"]:
+            return self.handle_sync_list(connection, address)
+
+        elif cmd == CMD["SYNCHASH"]:
+            return self.handle_sync_hash(connection, address)
+
+        elif cmd == CMD["SYNCGET"]:
+            return self.handle_sync_get(connection, address)
+
+        elif cmd == CMD["SYNCPUT"]:
+            return self.handle_sync_put(connection, address)
+
+        elif cmd == CMD["BYE"]:
+
+            print("Received BYE command from client")
+            try:
+                connection.sendall("Connection closed".encode('utf-8'))
+            except socket.error:
+                pass
+            return False
 
         elif cmd == CMD["CONNECT"]:
 
             print(f"Listening for file sharing connections on port {Server.FILE_SHARING_PORT}")
+            return True
 
         elif cmd == CMD["SCAN"]:
 
             print("scan")
+            return True
 
         else:
             print("Unknown command")
-            connection.close()
+            return False
 
+    def handle_list(self, connection, address):
 
-#################################################################################
+        try:
             
+            print("User try from server end: File Listing")
 
-class Client:
+            if self.listing_cache is not None:
+                connection.sendall(self.listing_cache.response())
+            else:
+                file_list_str = '\n'.join(self.list_share_files())
 
-    SERVER_HOSTNAME = "localhost"
-    RECV_BUFFER_SIZE = 1024
-    local_Client_File_LIST = "D:/McMaster/4DN4/Lab3/client_recv"
-    DOWNLOADED_FILE_NAME = "D:/McMaster/4DN4/lab3/client_recv/filedownload_3_server.txt"
-    UPLOADED_FILE_NAME = "D:/McMaster/4DN4/Lab3/client_recv/upload_file_1_client.txt"
-    MSG_ENCODING = "utf-8"
-    MESSAGE =  "SERVICE DISCOVERY"
-    MESSAGE_ENCODED = MESSAGE.encode('utf-8')
-    BROADCAST_ADDRESS = "255.255.255.255"
-    SDP = 30000
-    ADDRESS_PORT = (BROADCAST_ADDRESS, SDP)
+                file_list_bytes = file_list_str.encode(MSG_ENCODING)
+                file_list_size = len(file_list_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
 
-    def __init__(self):
-        #self.send_service_discovery_request()
-        self.connect_to_server()
-        self.send_console_input_forever()
+                connection.sendall(file_list_size + file_list_bytes)
+
+            print(f"File Listing sent to {address}")
+            return True
+
+        except Exception as e:
+
+            print(f"Sending file_listing wrong: {e}")
+            return False
+
+    def handle_list_page(self, connection, address):
+
+        # Paginated, filtered LIST:
+        #   request:  cmd | pattern size | glob pattern | cursor size | cursor | 4 byte page size
+        #   response: batches of  2 byte entry count | entries
+        #             where entry = name size | name | 8 byte size | 8 byte mtime (ns)
+        #             then        0 entry count | next cursor size | next cursor
+        # Entries are sorted by name, and the cursor is the last name
+        # already sent, empty to start and when there is no next page,
+        # so files added or removed between pages do not shift the ones
+        # still to come. An empty pattern matches everything and a page
+        # size of 0 sends every remaining entry. With a page size, only
+        # a page's worth of entries is held while the folder is
+        # scanned. They are sent LIST_BATCH_SIZE to a batch.
+        print("User try from server end: Paginated File Listing")
+
+        status, pattern_size_field = recv_bytes(connection, PATTERN_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        status, pattern_bytes = recv_bytes(connection, int.from_bytes(pattern_size_field, byteorder='big'))
+
+        if not status:
+            return False
+
+        status, cursor_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+
+        if status:
+            status, cursor_bytes = recv_bytes(connection, int.from_bytes(cursor_size_field, byteorder='big'))
+
+        if status:
+            status, page_size_field = recv_bytes(connection, PAGE_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        pattern = pattern_bytes.decode(MSG_ENCODING) or "*"
+        cursor = cursor_bytes.decode(MSG_ENCODING, errors='replace')
+        page_size = int.from_bytes(page_size_field, byteorder='big')
+
+        sent = 0
+        batch = bytearray()
+        batch_count = 0
+        next_cursor = b""
+
+        try:
+            entries = (entry for entry in self.scan_share_files()
+                       if entry[0] > cursor and fnmatch.fnmatchcase(entry[0], pattern))
+
+            if page_size:
+                page = heapq.nsmallest(page_size + 1, entries)
+                if len(page) > page_size:
+                    page = page[:page_size]
+                    next_cursor = page[-1][0].encode(MSG_ENCODING)
+            else:
+                page = sorted(entries)
+
+            for name, file_size, mtime_ns in page:
+                name_bytes = name.encode(MSG_ENCODING)
+                batch += len(name_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+                batch += name_bytes
+                batch += file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                batch += mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                batch_count += 1
+                sent += 1
+
+                if batch_count == LIST_BATCH_SIZE:
+                    connection.sendall(batch_count.to_bytes(ENTRY_COUNT_FIELD_LEN, byteorder='big') + batch)
+                    batch = bytearray()
+                    batch_count = 0
+
+            if batch_count:
+                connection.sendall(batch_count.to_bytes(ENTRY_COUNT_FIELD_LEN, byteorder='big') + batch)
+
+            connection.sendall((0).to_bytes(ENTRY_COUNT_FIELD_LEN, byteorder='big')
+                               + len(next_cursor).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+                               + next_cursor)
+
+        except socket.error:
+            return False
+
+        print(f"Sent {sent} entries matching {pattern!r} to {address}")
+        return True
+
+    def handle_search(self, connection, address):
+
+        # SEARCH, see parse_query:
+        #   request:  cmd | 2 byte query size | query | 4 byte limit
+        #   response: OK | 4 byte match count | 8 byte body size | body
+        #             where body = entries for the first limit matches in
+        #             name order (all of them for a limit of 0), each
+        #             name size | name | 8 byte size | 8 byte mtime (ns)
+        #         or: ERROR for a malformed query
+        # Without a catalog the share folder is scanned for every query.
+        status, query_size_field = recv_bytes(connection, QUERY_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        status, query_fields = recv_bytes(connection, int.from_bytes(query_size_field, byteorder='big')
+                                          + PAGE_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        limit = int.from_bytes(query_fields[-PAGE_SIZE_FIELD_LEN:], byteorder='big')
+
+        try:
+            text = query_fields[:-PAGE_SIZE_FIELD_LEN].decode(MSG_ENCODING)
+            query = parse_query(text)
+        except ValueError as e:
+            print(f"Bad SEARCH query: {e}")
+            return self.send_status(connection, "ERROR")
+
+        if self.catalog is not None:
+            results = self.catalog.search(query)
+        else:
+            catalog = Catalog(self.scan_share_files, [])
+            catalog.rebuild()
+            results = catalog.search(query)
+
+        body = bytearray()
+        for name, file_size, mtime_ns in results[:limit or None]:
+            name_bytes = name.encode(MSG_ENCODING)
+            body += len(name_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+            body += name_bytes
+            body += file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+            body += mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+
+        try:
+            connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                               + len(results).to_bytes(MATCH_COUNT_FIELD_LEN, byteorder='big')
+                               + len(body).to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+            send_buffer(connection, body)
+        except socket.error:
+            return False
+
+        print(f"SEARCH {text!r} from {address}: {len(results)} matches")
+        return True
+
+    def scan_share_files(self):
+
+        # Yields (name, size, mtime in ns) for every file in the share
+        # folder, then for stored files that have no plain file of the
+        # same name.
+        with os.scandir(Server.REMOTE_FOLDER_LIST) as entries:
+            for entry in entries:
+                if len(entry.name.encode(MSG_ENCODING)) > 255 or is_temp_file(entry.name):
+                    continue
+                if entry.is_file():
+                    stat = entry.stat()
+                    yield (entry.name, stat.st_size, stat.st_mtime_ns)
+
+        if self.chunk_store is not None:
+            with os.scandir(self.chunk_store.manifest_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".tmp") or os.path.exists(os.path.join(Server.REMOTE_FOLDER_LIST, entry.name)):
+                        continue
+                    manifest = self.chunk_store.read_manifest(entry.name)
+                    if manifest is not None:
+                        yield (entry.name, manifest[0], entry.stat().st_mtime_ns)
+
+    def list_share_files(self):
+
+        files = [name for name in os.listdir(Server.REMOTE_FOLDER_LIST) if not is_temp_file(name)]
+
+        if self.chunk_store is not None:
+            files = sorted((set(files) - {Server.STORE_FOLDER_NAME}) | set(self.chunk_store.names()))
+
+        return files
+
+    def file_stored(self, filename):
+
+        # Called whenever an upload has been saved under filename, which
+        # for SYNCPUT may be a path into a subfolder. LIST and the
+        # catalog only cover the top level.
+        if self.file_cache is not None:
+            self.file_cache.invalidate(filename)
+
+        self.digest_cache.invalidate(filename)
+
+        if "/" in filename:
+            return
+
+        if self.listing_cache is not None:
+            self.listing_cache.add(filename)
+
+        if self.catalog is not None:
+            try:
+                f, file_size, mtime_ns = self.open_share_file_stat(filename)
+                f.close()
+            except FileNotFoundError:
+                return
+            self.catalog.update(filename, file_size, mtime_ns)
+
+    def handle_get(self, connection, address):
+
+        print("User attempts to download file from server to client")
+
+        status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+
+        if not status:
+            print("Failed to retrieve the size of the file to be downloaded, closing connection ...")            
+            return False
+
+        filename_size_bytes = int.from_bytes(filename_size_field, byteorder='big')
+
+        if not filename_size_bytes:
+            print("Failed to retrieve the size of the file to be downloaded, closing connection ...")
+            return False
         
+        print('Size of the filename (in bytes): ', filename_size_bytes)
 
-    def connect_to_server(self):
+        status, filename_bytes = recv_bytes(connection, filename_size_bytes)
+
+        if not status:
+            print("Failed to retrieve the filename to be downloaded, closing connection ...")            
+            return False
+        
+        if not filename_bytes:
+            print("Failed to retrieve the filename to be downloaded, closing connection ...")
+            return False
+
+        filename = filename_bytes.decode(MSG_ENCODING)
+        print('Filename requested by client: ', filename)
+
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+
+        # A missing file is still reported by closing the connection, as
+        # the GET response has no status field. Only plain names in the
+        # share folder are served.
+        try:
+            if is_temp_file(filename) or not is_share_name(filename):
+                raise FileNotFoundError(filename)
+
+            if Server.GET_ZERO_COPY:
+                self.send_file(connection, filename)
+            else:
+                self.send_file_text(connection, filepath)
+            print("Sending file: ", filename)
+            return True
+
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return False
+
+        except socket.error:
+            print("Closing client connection ...")
+            return False
+        
+    def handle_put(self, connection, address):
+
+        print("User attempts to upload file from client to server")
+
+        status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+
+        if not status:
+            print("Failed to retrieve the size of the filename to be uploaded, closing connection ...")
+            return False
+        
+        filename_size = int.from_bytes(filename_size_field, byteorder='big')
+        status, filename_bytes = recv_bytes(connection, filename_size)
+
+        if not status:
+            print("Failed to retrieve the filename to be uploaded, closing connection ...")
+            return False
+
+        filename = filename_bytes.decode(MSG_ENCODING)
+
+        print('Filename uploaded by client: ', filename)
+
+        status, file_size_bytes = recv_bytes(connection, FILESIZE_FIELD_LEN)
+
+        if not status:
+            print("Failed to retrieve the size of the file to be uploaded, closing connection ...")
+            return False
+
+        file_size = int.from_bytes(file_size_bytes, byteorder='big')  
+        print('File size received by server: ', file_size)
+
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+
+        received, saved = self.recv_file(connection, filepath, file_size)
+
+        if not received:
+            print("Failed to retrieve the file data to be uploaded, closing connection ...")
+            return False
+
+        if not saved:
+            return self.send_status(connection, "ERROR")
+
+        print("File successfully uploaded to server and saved.")
+
+        # The plain file now supersedes any stored version.
+        if self.chunk_store is not None:
+            self.chunk_store.remove_manifest(filename)
+
+        self.file_stored(filename)
+
+        return self.send_status(connection, "OK")
+
+    def handle_get_range(self, connection, address):
+
+        # Ranged GET:
+        #   request:  cmd | filename size | filename | 8 byte offset | 8 byte length
+        #             | 8 byte file size | 8 byte mtime
+        #   response: status | 8 byte file size | 8 byte mtime | 8 byte range length | range
+        # A length of 0 asks for everything from offset to the end of
+        # the file. The last two request fields are an If-Range
+        # validator, see check_range: when the file has changed the
+        # status is CHANGED and the range is empty. Errors are reported
+        # in the status field and leave the session open.
+        print("User attempts to download part of a file from server to client")
+
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            print("Failed to retrieve the filename to be downloaded, closing connection ...")
+            return False
+
+        status, range_fields = recv_bytes(connection, OFFSET_FIELD_LEN + LENGTH_FIELD_LEN
+                                          + FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
+
+        if not status:
+            print("Failed to retrieve the range to be downloaded, closing connection ...")
+            return False
+
+        offset = int.from_bytes(range_fields[:OFFSET_FIELD_LEN], byteorder='big')
+        length = int.from_bytes(range_fields[OFFSET_FIELD_LEN:OFFSET_FIELD_LEN + LENGTH_FIELD_LEN], byteorder='big')
+        validator = range_fields[OFFSET_FIELD_LEN + LENGTH_FIELD_LEN:]
+        print(f"Range requested by client: {filename}, offset {offset}, length {length}")
+
+        cached = self.file_cache.lookup(filename) if self.file_cache is not None else None
+
+        if cached is not None:
+            file_size, mtime_ns, body, _ = cached
+            response = check_range(validator, offset, file_size, mtime_ns)
+
+            if response == "BAD_RANGE":
+                return self.send_status(connection, "BAD_RANGE")
+
+            range_length = 0
+            if response == "OK":
+                range_length = min(length, file_size - offset) if length else file_size - offset
+
+            try:
+                connection.sendall(STATUS[response].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                   + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                                   + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                                   + range_length.to_bytes(LENGTH_FIELD_LEN, byteorder='big'))
+                send_buffer(connection, memoryview(body)[offset:offset + range_length])
+            except socket.error:
+                return False
+
+            return True
+
+        try:
+            f, file_size, mtime_ns = self.open_share_file_stat(filename)
+
+            with f:
+                response = check_range(validator, offset, file_size, mtime_ns)
+
+                if response == "BAD_RANGE":
+                    print("Requested range starts past the end of the file.")
+                    return self.send_status(connection, "BAD_RANGE")
+
+                range_length = 0
+                if response == "OK":
+                    range_length = file_size - offset
+                    if length:
+                        range_length = min(length, range_length)
+                else:
+                    print(f"{filename} has changed since the client's partial download.")
+
+                connection.sendall(STATUS[response].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                   + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                                   + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                                   + range_length.to_bytes(LENGTH_FIELD_LEN, byteorder='big'))
+                if range_length:
+                    connection.sendfile(f, offset, range_length)
+
+            print(f"Sent {range_length} bytes of {filename} from offset {offset}")
+            return True
+
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return self.send_status(connection, "NOT_FOUND")
+
+        except socket.error:
+            print("Closing client connection ...")
+            return False
+
+    def handle_dedup_put(self, connection, address):
+
+        # Deduplicating PUT:
+        #   request:  cmd | filename size | filename | 8 byte file size
+        #             | 4 byte chunk count | 32 byte SHA-256 per chunk
+        #   response: status | bitmap of the chunks the server is missing
+        #   request:  the missing chunks, in order
+        #   response: status
+        # Chunks are DEDUP_CHUNK_SIZE bytes, except for the last one.
+        print("User attempts to upload file from client to server with deduplication")
+
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            print("Failed to retrieve the filename to be uploaded, closing connection ...")
+            return False
+
+        status, header = recv_bytes(connection, FILESIZE_FIELD_LEN + CHUNK_COUNT_FIELD_LEN)
+
+        if not status:
+            print("Failed to retrieve the size of the file to be uploaded, closing connection ...")
+            return False
+
+        file_size = int.from_bytes(header[:FILESIZE_FIELD_LEN], byteorder='big')
+        chunk_count = int.from_bytes(header[FILESIZE_FIELD_LEN:], byteorder='big')
+
+        if chunk_count != -(-file_size // DEDUP_CHUNK_SIZE):
+            print("Chunk count does not match the file size, closing connection ...")
+            return False
+
+        # The hashes are not read, so the session cannot continue.
+        if file_size > Server.MAX_DEDUP_FILE_SIZE:
+            print(f"File of {file_size} bytes is over MAX_DEDUP_FILE_SIZE, closing connection ...")
+            self.send_status(connection, "ERROR")
+            return False
+
+        # The hashes are read DEDUP_DIGEST_BATCH at a time, so memory
+        # only grows as they actually arrive.
+        digests = []
+        while len(digests) < chunk_count:
+            batch = min(DEDUP_DIGEST_BATCH, chunk_count - len(digests))
+            status, digest_bytes = recv_bytes(connection, batch * CHUNK_DIGEST_LEN)
+
+            if not status:
+                print("Failed to retrieve the chunk hashes, closing connection ...")
+                return False
+
+            digests.extend(digest_bytes[i:i + CHUNK_DIGEST_LEN] for i in range(0, len(digest_bytes), CHUNK_DIGEST_LEN))
+
+        if self.chunk_store is None:
+            print("Deduplicating store is not enabled.")
+            return self.send_status(connection, "UNSUPPORTED")
+
+        # The name becomes the manifest's path, so it may only name a
+        # file in the share folder itself, and not a hidden one like the
+        # store.
+        if not is_share_name(filename) or filename.startswith("."):
+            print(f"Bad filename {filename!r}.")
+            return self.send_status(connection, "ERROR")
+
+        missing = bytearray((chunk_count + 7) // 8)
+        missing_indexes = []
+        requested = set()
+        for index, digest in enumerate(digests):
+            if digest not in requested and not self.chunk_store.has_chunk(digest):
+                missing[index // 8] |= 0x80 >> (index % 8)
+                missing_indexes.append(index)
+                requested.add(digest)
+
+        print(f"{chunk_count - len(missing_indexes)} of {chunk_count} chunks are already stored")
+
+        try:
+            connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big') + missing)
+        except socket.error:
+            return False
+
+        buffer = bytearray(DEDUP_CHUNK_SIZE)
+        all_chunks_valid = True
+        writes = []
+
+        try:
+            for index in missing_indexes:
+                chunk_size = min(DEDUP_CHUNK_SIZE, file_size - index * DEDUP_CHUNK_SIZE)
+                status, chunk = recv_exactly(connection, chunk_size, buffer)
+
+                if not status:
+                    print("Failed to retrieve the chunk data, closing connection ...")
+                    return False
+
+                if not self.chunk_store.put_chunk(digests[index], chunk, writes):
+                    all_chunks_valid = False
+
+            # The chunks must be on disk before a manifest refers to them.
+            self.durability.wait(writes)
+
+            if not all_chunks_valid:
+                print("Chunk data did not match its hash.")
+                return self.send_status(connection, "ERROR")
+
+            self.chunk_store.write_manifest(filename, file_size, digests)
+
+        except OSError as e:
+            print(f"Error saving file: {e}")
+            return self.send_status(connection, "ERROR")
+
+        # The stored version now supersedes any plain file.
+        try:
+            os.remove(os.path.join(Server.REMOTE_FOLDER_LIST, filename))
+        except OSError:
+            pass
+
+        self.file_stored(filename)
+
+        print(f"File stored: {len(missing_indexes)} new chunks received.")
+        return self.send_status(connection, "OK")
+
+    def handle_compressed_get(self, connection, address):
+
+        # ZGET: the client sends a mask of the codecs it can decode and
+        # a compression level. The reply is a status, the codec chosen
+        # and the uncompressed size, then the body as compressed frames.
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, options = recv_bytes(connection, CODEC_FIELD_LEN + LEVEL_FIELD_LEN)
+
+        if not status:
+            return False
+
+        codec_mask = options[0]
+        level = min(max(options[1], 1), 9)
+
+        try:
+            f, file_size = self.open_share_file(filename)
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return self.send_status(connection, "NOT_FOUND")
+
+        with f:
+            first_chunk = f.read(COMPRESSION_CHUNK_SIZE)
+
+            codec = CODEC["none"]
+            if is_compressible(first_chunk):
+                codec = choose_codec(codec_mask, Server.COMPRESSION_PREFERENCE)
+
+            header = (STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                      + codec.to_bytes(CODEC_FIELD_LEN, byteorder='big')
+                      + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+
+            try:
+                connection.sendall(header)
+                sent = send_compressed(connection, f, codec, level, first_chunk)
+            except socket.error:
+                print("Closing client connection ...")
+                return False
+
+        print(f"Sending file: {filename} ({file_size} bytes as {sent} bytes, codec {codec})")
+        return True
+
+    def handle_compressed_put(self, connection, address):
+
+        # ZPUT: the client names the codec and the uncompressed size and
+        # waits for OK before sending the frames, so an unsupported
+        # codec can be refused without losing the session.
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, header = recv_bytes(connection, CODEC_FIELD_LEN + FILESIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        codec = header[0]
+        file_size = int.from_bytes(header[CODEC_FIELD_LEN:], byteorder='big')
+
+        if not supported_codecs() & (1 << codec):
+            return self.send_status(connection, "UNSUPPORTED")
+
+        if not self.send_status(connection, "OK"):
+            return False
+
+        def receive(f):
+            try:
+                return recv_compressed(connection, f, codec, file_size)
+            except DECOMPRESSION_ERRORS as e:
+                print(f"Error saving file: {e}")
+                return False
+
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+
+        received, saved = self.recv_file(connection, filepath, file_size, receive)
+
+        if not received:
+            print("Failed to retrieve the file data to be uploaded, closing connection ...")
+            return False
+
+        if not saved:
+            return self.send_status(connection, "ERROR")
+
+        print("File successfully uploaded to server and saved.")
+
+        if self.chunk_store is not None:
+            self.chunk_store.remove_manifest(filename)
+
+        self.file_stored(filename)
+
+        return self.send_status(connection, "OK")
+
+    def handle_delta_put(self, connection, address):
+
+        # RPUT:
+        #   request:  cmd | filename size | filename | 8 byte new size
+        #   response: status | 4 byte block size | 4 byte block count |
+        #             block signatures
+        # followed by the client's delta instructions and a final
+        # status. NOT_FOUND means there is no copy to patch, and the
+        # client falls back to PUT. The new file is built in a temporary
+        # file beside the old one and renamed over it once its size and
+        # hash check out, so readers see either the old or the new file.
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, file_size_field = recv_bytes(connection, FILESIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        file_size = int.from_bytes(file_size_field, byteorder='big')
+
+        try:
+            old_file, old_size = self.open_share_file(filename)
+        except FileNotFoundError:
+            return self.send_status(connection, "NOT_FOUND")
+
+        with old_file:
+            block_size = delta_block_size(old_size)
+            signatures = block_signatures(old_file, block_size)
+            block_count = len(signatures) // (WEAK_CHECKSUM_LEN + STRONG_HASH_LEN)
+
+            try:
+                connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                   + block_size.to_bytes(BLOCK_SIZE_FIELD_LEN, byteorder='big')
+                                   + block_count.to_bytes(CHUNK_COUNT_FIELD_LEN, byteorder='big')
+                                   + signatures)
+            except socket.error:
+                return False
+
+            print(f"Sent {block_count} block signatures of {block_size} bytes for {filename}")
+
+            # As in recv_file, a file that cannot be saved still has its
+            # delta read to the end, and gets ERROR.
+            filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+            writer = DrainingWriter(None)
+            temp_path = None
+
+            try:
+                fd, temp_path = create_temp_file(filepath)
+                writer.f = os.fdopen(fd, 'wb')
+            except OSError as e:
+                writer.error = e
+
+            try:
+                status = self.apply_delta(connection, old_file, block_size, block_count, writer, file_size)
+            except OSError as e:
+                print(f"Error rebuilding file: {e}")
+                status = None
+
+            saved = False
+            if writer.f is not None:
+                try:
+                    if status and writer.error is None:
+                        self.durability.commit(writer.f, temp_path, filepath)
+                        saved = True
+                    else:
+                        writer.f.close()
+                except OSError as e:
+                    writer.error = e
+
+        if not saved:
+            if writer.f is not None:
+                try:
+                    writer.f.close()
+                except OSError:
+                    pass
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+        if status and not saved:
+            print(f"Error saving file: {writer.error}")
+            return self.send_status(connection, "ERROR")
+
+        if status is None:
+            print("Failed to retrieve the delta to be uploaded, closing connection ...")
+            return False
+
+        if not status:
+            print("Delta did not rebuild the file, keeping the old copy.")
+            return self.send_status(connection, "ERROR")
+
+        print(f"File {filename} rebuilt from the delta and saved.")
+
+        if self.chunk_store is not None:
+            self.chunk_store.remove_manifest(filename)
+
+        self.file_stored(filename)
+
+        return self.send_status(connection, "OK")
+
+    def apply_delta(self, connection, old_file, block_size, block_count, f, file_size):
+
+        # Rebuild the new file into f. Returns True if it matches the
+        # client's size and hash, False if it does not (the stream is
+        # still in step), and None if the connection failed or sent a
+        # malformed instruction. A COPY from an old file that has been
+        # cut short since its signatures were sent copies less than it
+        # asks for, so the result does not match.
+        digest = hashlib.sha256()
+        writer = HashingWriter(f, digest)
+        buffer = bytearray(FILE_CHUNK_SIZE)
+        written = 0
+
+        while True:
+            status, op_field = recv_bytes(connection, DELTA_OP_FIELD_LEN)
+
+            if not status:
+                return None
+
+            op = op_field[0]
+
+            if op == DELTA_OP["COPY"]:
+                status, copy_fields = recv_bytes(connection, 2 * BLOCK_INDEX_FIELD_LEN)
+
+                if not status:
+                    return None
+
+                first = int.from_bytes(copy_fields[:BLOCK_INDEX_FIELD_LEN], byteorder='big')
+                count = int.from_bytes(copy_fields[BLOCK_INDEX_FIELD_LEN:], byteorder='big')
+
+                if first + count > block_count:
+                    return None
+
+                old_file.seek(first * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = old_file.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    writer.write(data)
+                    remaining -= len(data)
+                    written += len(data)
+
+            elif op == DELTA_OP["DATA"]:
+                status, length_field = recv_bytes(connection, LITERAL_SIZE_FIELD_LEN)
+
+                if not status:
+                    return None
+
+                length = int.from_bytes(length_field, byteorder='big')
+
+                if not recv_file(connection, writer, length, buffer):
+                    return None
+                written += length
+
+            elif op == DELTA_OP["END"]:
+                status, expected = recv_bytes(connection, CHUNK_DIGEST_LEN)
+
+                if not status:
+                    return None
+
+                return written == file_size and digest.digest() == expected
+
+            else:
+                return None
+
+    def handle_multi_get(self, connection, address):
+
+        # MGET:
+        #   request:  cmd | 2 byte pattern count | patterns, each
+        #             pattern size | glob pattern or filename
+        #   response: status | records | 0 name size
+        #             where record = name size | name | status
+        #                            [| 8 byte file size | file]
+        # A pattern without wildcards names a file directly and gets a
+        # NOT_FOUND record if it does not exist. Records are sent back
+        # to back while a read-ahead thread opens and reads the files
+        # that come next.
+        status, count_field = recv_bytes(connection, ENTRY_COUNT_FIELD_LEN)
+
+        if not status:
+            return False
+
+        patterns = []
+        for _ in range(int.from_bytes(count_field, byteorder='big')):
+            status, pattern_size_field = recv_bytes(connection, PATTERN_SIZE_FIELD_LEN)
+
+            if not status:
+                return False
+
+            status, pattern_bytes = recv_bytes(connection, pattern_size_field[0])
+
+            if not status:
+                return False
+
+            patterns.append(pattern_bytes.decode(MSG_ENCODING))
+
+        names = self.match_share_files(patterns)
+        print(f"Sending {len(names)} files to {address}")
+
+        return self.send_files(connection, names)
+
+    def match_share_files(self, patterns):
+
+        # Expand patterns in order, without repeating a name. Other
+        # names are passed on as they are: open_share_file_stat answers
+        # one that is not a file in the share folder as not found.
+        share_files = None
+        names = []
+
+        for pattern in patterns:
+            if any(c in pattern for c in "*?["):
+                if share_files is None:
+                    share_files = sorted(name for name, _, _ in self.scan_share_files())
+                names.extend(fnmatch.filter(share_files, pattern))
+            else:
+                names.append(pattern)
+
+        return list(dict.fromkeys(names))
+
+    def send_files(self, connection, names, sync=False):
+
+        # Small records are gathered into one send of up to
+        # MGET_SEND_BUFFER_SIZE; larger files go out with sendfile.
+        # For SYNCGET, names are SYNC paths and the records are those of
+        # handle_sync_get.
+        open_file = self.open_sync_file if sync else self.open_share_file_stat
+        files = queue.Queue(maxsize=Server.MGET_READ_AHEAD)
+        cancelled = threading.Event()
+        threading.Thread(target=self.read_ahead, args=(names, files, cancelled, open_file), daemon=True).start()
+
+        pending = bytearray() if sync else bytearray(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+
+        try:
+            while True:
+                entry = files.get()
+
+                if entry is None:
+                    break
+
+                if entry is False:
+                    print("Failed to read the files to be sent, closing connection ...")
+                    return False
+
+                name, f, body, file_size, mtime_ns = entry
+                if not sync:
+                    name_bytes = name.encode(MSG_ENCODING)
+                    pending += len(name_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big') + name_bytes
+
+                if f is None and body is None:
+                    pending += STATUS["NOT_FOUND"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                    continue
+
+                pending += STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                pending += file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                if sync:
+                    pending += mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+
+                if body is not None:
+                    pending += body
+                    if len(pending) >= MGET_SEND_BUFFER_SIZE:
+                        connection.sendall(pending)
+                        pending = bytearray()
+                else:
+                    with f:
+                        connection.sendall(pending)
+                        pending = bytearray()
+                        connection.sendfile(f, 0, file_size)
+
+            if not sync:
+                pending += (0).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+            connection.sendall(pending)
+            return True
+
+        except socket.error:
+            print("Closing client connection ...")
+            return False
+
+        finally:
+            cancelled.set()
+            while True:
+                try:
+                    entry = files.get_nowait()
+                except queue.Empty:
+                    break
+                if entry and entry[1] is not None:
+                    entry[1].close()
+
+    def read_ahead(self, names, files, cancelled, open_file):
+
+        # Producer for send_files: queues (name, file, body, size, mtime)
+        # for each name, opened with open_file, at most MGET_READ_AHEAD
+        # ahead of the sender, then None. Files up to MGET_PREFETCH_SIZE
+        # are read into body; for larger ones the kernel is asked to
+        # start reading them in. If anything but a file that cannot be
+        # opened goes wrong, the queue ends with False instead, so the
+        # sender is never left waiting.
+        def queue_entry(entry):
+            # False if the sender has gone.
+            while True:
+                try:
+                    files.put(entry, timeout=1)
+                    return True
+                except queue.Full:
+                    if cancelled.is_set():
+                        return False
+
+        end = False
+        try:
+            for name in names:
+                if cancelled.is_set():
+                    return
+
+                entry = (name, None, None, 0, 0)
+                try:
+                    f, file_size, mtime_ns = open_file(name)
+                    if file_size <= MGET_PREFETCH_SIZE:
+                        with f:
+                            body = f.read(file_size)
+                        # A file cut short since it was opened would not
+                        # fill its record.
+                        if len(body) == file_size:
+                            entry = (name, None, body, file_size, mtime_ns)
+                    else:
+                        if hasattr(os, 'posix_fadvise') and hasattr(f, 'fileno'):
+                            try:
+                                os.posix_fadvise(f.fileno(), 0, file_size, os.POSIX_FADV_WILLNEED)
+                            except (OSError, io.UnsupportedOperation):
+                                pass
+                        entry = (name, f, None, file_size, mtime_ns)
+                except (OSError, ValueError):
+                    pass
+
+                if not queue_entry(entry):
+                    if entry[1] is not None:
+                        entry[1].close()
+                    return
+
+            end = None
+
+        finally:
+            if not cancelled.is_set():
+                queue_entry(end)
+
+    def handle_verified_get(self, connection, address):
+
+        # VGET:
+        #   request:  cmd | filename size | filename | digest algorithm
+        #   response: status [| 8 byte file size | file | digest]
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, algorithm_field = recv_bytes(connection, DIGEST_FIELD_LEN)
+
+        if not status:
+            return False
+
+        digest = make_digest(algorithm_field[0])
+
+        if digest is None:
+            return self.send_status(connection, "UNSUPPORTED")
+
+        try:
+            f, file_size = self.open_share_file(filename)
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return self.send_status(connection, "NOT_FOUND")
+
+        try:
+            with f:
+                connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                   + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+                send_with_digest(connection, f, file_size, digest)
+        except OSError as e:
+            print(f"Closing client connection: {e}")
+            return False
+
+        print(f"Sending file: {filename} with digest {digest.digest().hex()}")
+        return True
+
+    def handle_verified_put(self, connection, address):
+
+        # VPUT:
+        #   request:  cmd | filename size | filename | digest algorithm |
+        #             8 byte file size
+        #   reply:    status (OK, or UNSUPPORTED for an unknown algorithm)
+        #   then:     file | digest
+        #   reply:    status (OK, or ERROR if the digest did not match)
+        # A file that fails the check is discarded and the session
+        # stays open, so the client can send it again.
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, header = recv_bytes(connection, DIGEST_FIELD_LEN + FILESIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        digest = make_digest(header[0])
+        file_size = int.from_bytes(header[DIGEST_FIELD_LEN:], byteorder='big')
+
+        if digest is None:
+            return self.send_status(connection, "UNSUPPORTED")
+
+        if not self.send_status(connection, "OK"):
+            return False
+
+        matched = []
+
+        def receive(f):
+            matched.append(recv_with_digest(connection, f, file_size, digest))
+            return bool(matched[0])
+
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+
+        received, saved = self.recv_file(connection, filepath, file_size, receive)
+
+        if matched and matched[0] is False:
+            print(f"Digest mismatch for {filename}, discarding the upload.")
+            return self.send_status(connection, "ERROR")
+
+        if not received:
+            print("Failed to retrieve the file data to be uploaded, closing connection ...")
+            return False
+
+        if not saved:
+            return self.send_status(connection, "ERROR")
+
+        print(f"File successfully uploaded to server and saved, digest {digest.digest().hex()}.")
+
+        if self.chunk_store is not None:
+            self.chunk_store.remove_manifest(filename)
+
+        self.file_stored(filename)
+
+        return self.send_status(connection, "OK")
+
+    def stats(self):
+
+        # Server counters for STATS, as a JSON-serialisable dict.
+        stats = {"executor": Server.EXECUTOR, "pool": self.pool_stats.snapshot()}
+        if self.file_cache is not None:
+            stats["file_cache"] = self.file_cache.snapshot()
+        stats["shaping"] = self.shaper.snapshot()
+        stats["durability"] = self.durability.snapshot()
+        if self.executor is not None:
+            stats["pool"]["workers"] = Server.POOL_WORKERS
+            stats["pool"]["queue_size"] = Server.POOL_QUEUE_SIZE
+        return stats
+
+    def handle_conditional_get(self, connection, address):
+
+        # CGET:
+        #   request:  cmd | filename size | filename |
+        #             8 byte size | 8 byte mtime (ns) | 32 byte SHA-256
+        #   response: NOT_MODIFIED | 8 byte mtime
+        #         or: OK | 8 byte mtime | 8 byte file size | file
+        #         or: NOT_FOUND
+        # The validator describes the client's copy as it was served;
+        # see check_validator. If only the mtime differs, the file's
+        # digest decides, so a file touched or rewritten with the same
+        # content is not sent again. Either way the current mtime goes
+        # back for the client to keep.
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, validator = recv_bytes(connection, FILESIZE_FIELD_LEN + MTIME_FIELD_LEN + VALIDATOR_DIGEST_LEN)
+
+        if not status:
+            return False
+
+        try:
+            f, file_size, mtime_ns = self.open_share_file_stat(filename)
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return self.send_status(connection, "NOT_FOUND")
+
+        try:
+            with f:
+                matched = check_validator(validator, file_size, mtime_ns)
+                if matched is None:
+                    matched = (self.digest_cache.digest(filename, f, file_size, mtime_ns)
+                               == validator[FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:])
+
+                if matched:
+                    connection.sendall(STATUS["NOT_MODIFIED"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                       + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big'))
+                    print(f"{filename} not modified.")
+                    return True
+
+                connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                                   + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                                   + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+                if file_size:
+                    connection.sendfile(f, 0, file_size)
+
+        except OSError as e:
+            print(f"Closing client connection: {e}")
+            return False
+
+        print("Sending file: ", filename)
+        return True
+
+    def handle_chunks(self, connection, address):
+
+        # CHUNKS, for swarm downloads:
+        #   request:  cmd | filename size | filename | 4 byte chunk size
+        #   response: OK | 8 byte file size | 4 byte chunk count |
+        #             32 byte SHA-256 of each chunk
+        #         or: NOT_FOUND, or BAD_RANGE for a chunk size outside
+        #             SWARM_MIN_CHUNK_SIZE .. SWARM_MAX_CHUNK_SIZE
+        status, filename = self.recv_filename(connection)
+
+        if not status:
+            return False
+
+        status, chunk_size_field = recv_bytes(connection, CHUNK_SIZE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        chunk_size = int.from_bytes(chunk_size_field, byteorder='big')
+
+        if not SWARM_MIN_CHUNK_SIZE <= chunk_size <= SWARM_MAX_CHUNK_SIZE:
+            return self.send_status(connection, "BAD_RANGE")
+
+        try:
+            f, file_size, mtime_ns = self.open_share_file_stat(filename)
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return self.send_status(connection, "NOT_FOUND")
+
+        try:
+            with f:
+                digests = self.digest_cache.chunk_digests(filename, f, file_size, mtime_ns, chunk_size)
+
+            connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                               + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                               + len(digests).to_bytes(CHUNK_COUNT_FIELD_LEN, byteorder='big')
+                               + b''.join(digests))
+
+        except OSError as e:
+            print(f"Closing client connection: {e}")
+            return False
+
+        print(f"Sent {len(digests)} chunk digests of {filename}")
+        return True
+
+    def sync_path(self, path):
+
+        # Where a SYNC path is in the share folder. It may not lead into
+        # the chunk store, or out of the share folder through a
+        # symbolic link. Raises ValueError.
+        parts = split_sync_path(path)
+
+        if parts[0] == Server.STORE_FOLDER_NAME:
+            raise ValueError(f"bad path {path!r}")
+
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, *parts)
+        root = os.path.realpath(Server.REMOTE_FOLDER_LIST)
+
+        if os.path.commonpath([root, os.path.realpath(filepath)]) != root:
+            raise ValueError(f"bad path {path!r}")
+
+        return filepath
+
+    def open_sync_file(self, path):
+
+        # open_share_file_stat for a SYNC path, without the chunk store.
+        f = open(self.sync_path(path), 'rb')
+        stat = os.fstat(f.fileno())
+        return (f, stat.st_size, stat.st_mtime_ns)
+
+    def recv_sync_paths(self, connection, count):
+
+        # count paths, each 2 byte path size | path. Returns a status and
+        # the paths. One that is not valid UTF-8 cannot name a file sent
+        # by SYNCLIST; it is decoded with replacement characters and then
+        # simply not found.
+        paths = []
+
+        for _ in range(count):
+            status, path_size_field = recv_bytes(connection, PATH_SIZE_FIELD_LEN)
+
+            if not status:
+                return (False, paths)
+
+            status, path_bytes = recv_bytes(connection, int.from_bytes(path_size_field, byteorder='big'))
+
+            if not status:
+                return (False, paths)
+
+            paths.append(path_bytes.decode(MSG_ENCODING, errors='replace'))
+
+        return (True, paths)
+
+    def recv_sync_path_list(self, connection):
+
+        # 4 byte path count | paths
+        status, count_field = recv_bytes(connection, PATH_COUNT_FIELD_LEN)
+
+        if not status:
+            return (False, [])
+
+        return self.recv_sync_paths(connection, int.from_bytes(count_field, byteorder='big'))
+
+    def handle_sync_list(self, connection, address):
+
+        # SYNCLIST, see "Directory sync":
+        #   request:  cmd | 2 byte path size | path of a folder, empty
+        #             for the whole share folder
+        #   response: OK | 8 byte body size | body
+        #             where body = an entry for every file under the
+        #             folder, 2 byte path size | path relative to the
+        #             folder | 8 byte size | 8 byte mtime (ns)
+        #         or: NOT_FOUND if there is no such folder
+        #         or: ERROR for a bad path
+        status, paths = self.recv_sync_paths(connection, 1)
+
+        if not status:
+            return False
+
+        folder = paths[0]
+
+        try:
+            if folder:
+                manifest = tree_manifest(self.sync_path(folder))
+            else:
+                manifest = tree_manifest(Server.REMOTE_FOLDER_LIST, skip={Server.STORE_FOLDER_NAME})
+        except ValueError as e:
+            print(f"SYNCLIST: {e}")
+            return self.send_status(connection, "ERROR")
+        except (FileNotFoundError, NotADirectoryError):
+            return self.send_status(connection, "NOT_FOUND")
+        except OSError as e:
+            print(f"SYNCLIST: {e}")
+            return self.send_status(connection, "ERROR")
+
+        body = encode_manifest(manifest)
+
+        try:
+            connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                               + len(body).to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+            send_buffer(connection, body)
+        except socket.error:
+            return False
+
+        print(f"SYNCLIST {folder!r} from {address}: {len(manifest)} files")
+        return True
+
+    def handle_sync_hash(self, connection, address):
+
+        # SYNCHASH:
+        #   request:  cmd | 4 byte path count | paths, each 2 byte path
+        #             size | path
+        #   response: OK | 32 byte SHA-256 of each file, all zeros for
+        #             one that is missing or cannot be read
+        status, paths = self.recv_sync_path_list(connection)
+
+        if not status:
+            return False
+
+        digests = bytearray(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+
+        for path in paths:
+            try:
+                f, file_size, mtime_ns = self.open_sync_file(path)
+                with f:
+                    digests += self.digest_cache.digest(path, f, file_size, mtime_ns)
+            except (OSError, ValueError):
+                digests += bytes(VALIDATOR_DIGEST_LEN)
+
+        try:
+            send_buffer(connection, digests)
+        except socket.error:
+            return False
+
+        print(f"Sent digests of {len(paths)} files to {address}")
+        return True
+
+    def handle_sync_get(self, connection, address):
+
+        # SYNCGET:
+        #   request:  cmd | 4 byte path count | paths, each 2 byte path
+        #             size | path
+        #   response: a record for each path, in order,
+        #             OK | 8 byte size | 8 byte mtime (ns) | file
+        #             or NOT_FOUND for a file that is missing or a bad
+        #             path
+        # The records are sent by send_files, as for MGET, so a client
+        # may send the next SYNCGET before this one is answered.
+        status, paths = self.recv_sync_path_list(connection)
+
+        if not status:
+            return False
+
+        return self.send_files(connection, paths, sync=True)
+
+    def handle_sync_put(self, connection, address):
+
+        # SYNCPUT:
+        #   request:  cmd | 4 byte file count | files, each 2 byte path
+        #             size | path | 8 byte size | 8 byte mtime (ns) | file
+        #   response: a status for each file, in order, once all of them
+        #             have been received
+        # Each file is saved like a PUT, with the folders it needs, and
+        # takes the given mtime. A file that cannot be saved, for a bad
+        # path or because something else is in the way, is read and
+        # discarded, and gets ERROR.
+        status, count_field = recv_bytes(connection, PATH_COUNT_FIELD_LEN)
+
+        if not status:
+            return False
+
+        statuses = bytearray()
+
+        for _ in range(int.from_bytes(count_field, byteorder='big')):
+            status, paths = self.recv_sync_paths(connection, 1)
+
+            if status:
+                status, fields = recv_bytes(connection, FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
+
+            if not status:
+                return False
+
+            path = paths[0]
+            file_size = int.from_bytes(fields[:FILESIZE_FIELD_LEN], byteorder='big')
+            mtime_ns = int.from_bytes(fields[FILESIZE_FIELD_LEN:], byteorder='big')
+
+            try:
+                filepath = self.sync_path(path)
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                received, saved = self.recv_file(connection, filepath, file_size)
+            except (OSError, ValueError) as e:
+                print(f"SYNCPUT {path!r}: {e}")
+                with open(os.devnull, 'wb') as f:
+                    received = recv_file(connection, f, file_size, bytearray(FILE_CHUNK_SIZE))
+                saved = False
+
+            if not received:
+                print("Failed to retrieve the file data to be uploaded, closing connection ...")
+                return False
+
+            if not saved:
+                statuses.append(STATUS["ERROR"])
+                continue
+
+            try:
+                os.utime(filepath, ns=(mtime_ns, mtime_ns))
+            except OSError:
+                pass
+
+            if self.chunk_store is not None and "/" not in path:
+                self.chunk_store.remove_manifest(path)
+
+            self.file_stored(path)
+            statuses.append(STATUS["OK"])
+
+        try:
+            connection.sendall(statuses)
+        except socket.error:
+            return False
+
+        print(f"Received {statuses.count(STATUS['OK'])} of {len(statuses)} files from {address}")
+        return True
+
+    def handle_mux(self, connection, address):
+
+        # MUX: reply OK, then treat the connection as a MuxConnection.
+        # Each stream the client opens carries one command, run through
+        # handle_command on its own thread, so a LIST is not held up
+        # behind a large GET. The session ends with the connection.
+        if isinstance(connection, MuxStream):
+            return self.send_status(connection, "UNSUPPORTED")
+
+        if not self.send_status(connection, "OK"):
+            return False
+
+        def on_stream(stream):
+            threading.Thread(target=self.run_stream, args=(stream, address), daemon=True).start()
+
+        print(f"Session with {address} is now multiplexed.")
+        MuxConnection(connection, on_stream, Server.MUX_MAX_STREAMS).run(Server.SESSION_IDLE_TIMEOUT)
+        return False
+
+    def run_stream(self, stream, address):
+        try:
+            status, cmd_field = recv_exactly(stream, CMD_FIELD_LEN)
+            if status:
+                self.handle_command(stream, address, cmd_field[0])
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Stream {stream.stream_id} failed: {e}")
+        finally:
+            stream.close()
+
+    def handle_limit(self, connection, address):
+
+        # LIMIT: 8 byte global rate | 8 byte per-client rate, in bytes
+        # per second, 0 for unlimited. Replies OK, or ERROR when the
+        # request does not come from one of LIMIT_ALLOWED_HOSTS.
+        status, rates = recv_bytes(connection, 2 * RATE_FIELD_LEN)
+
+        if not status:
+            return False
+
+        if address[0] not in Server.LIMIT_ALLOWED_HOSTS:
+            print(f"Refusing LIMIT from {address[0]}.")
+            return self.send_status(connection, "ERROR")
+
+        global_rate = int.from_bytes(rates[:RATE_FIELD_LEN], byteorder='big')
+        client_rate = int.from_bytes(rates[RATE_FIELD_LEN:], byteorder='big')
+        self.shaper.set_limits(global_rate, client_rate)
+        print(f"Rate limits set to {global_rate} B/s overall and {client_rate} B/s per client.")
+
+        return self.send_status(connection, "OK")
+
+    def handle_stats(self, connection, address):
+
+        # STATS: status, 4 byte length, then the counters as JSON.
+        stats_bytes = json.dumps(self.stats()).encode(MSG_ENCODING)
+
+        try:
+            connection.sendall(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                               + len(stats_bytes).to_bytes(STATS_SIZE_FIELD_LEN, byteorder='big')
+                               + stats_bytes)
+            return True
+        except socket.error:
+            return False
+
+    def recv_filename(self, connection):
+
+        status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
+
+        if not status:
+            return (False, "")
+
+        filename_size = int.from_bytes(filename_size_field, byteorder='big')
+
+        if not filename_size:
+            return (False, "")
+
+        status, filename_bytes = recv_bytes(connection, filename_size)
+
+        if not status:
+            return (False, "")
+
+        try:
+            return (True, filename_bytes.decode(MSG_ENCODING))
+        except UnicodeDecodeError:
+            print("Filename is not valid UTF-8, closing connection ...")
+            return (False, "")
+
+    def send_status(self, connection, status):
+
+        # Returns True if the status was sent and the session can go on.
+        try:
+            connection.sendall(STATUS[status].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+            return True
+        except socket.error:
+            return False
+
+
+########################################################################
+# Service discovery and swarm downloads
+########################################################################
+
+# A server answers SERVICE DISCOVERY with its service name followed by
+# " on port " and its file sharing port, so that servers need not all
+# listen on the same port. A reply without the suffix means the
+# default port.
+
+DISCOVERY_PORT_SEPARATOR = " on port "
+
+def discovery_response(service_name, port):
+    return f"{service_name}{DISCOVERY_PORT_SEPARATOR}{port}".encode(MSG_ENCODING)
+
+def parse_discovery_response(data, default_port):
+
+    # (service name, port) from a discovery reply, or None if it is not
+    # one.
+    try:
+        message = data.decode(MSG_ENCODING)
+    except UnicodeDecodeError:
+        return None
+
+    name, separator, port = message.rpartition(DISCOVERY_PORT_SEPARATOR)
+    if separator and port.isdigit():
+        return (name, int(port))
+    return (message, default_port)
+
+class DiscoveryCache:
+
+    # The servers a scan found, nearest first, with the RTT measured to
+    # each, in a JSON file that is replaced whole on every scan. They
+    # are trusted for ttl seconds after the scan; the wall clock is used
+    # since the file outlives the process.
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+
+        # [((host, port), service name, rtt)], or [] if the cache is
+        # missing, unreadable or has expired.
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if not 0 <= time.time() - cache["scanned_at"] <= self.ttl:
+                return []
+            return [((server["host"], server["port"]), server["name"], server["rtt"])
+                    for server in cache["servers"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def store(self, servers):
+        cache = {"scanned_at": time.time(),
+                 "servers": [{"host": host, "port": port, "name": name, "rtt": rtt}
+                             for (host, port), name, rtt in servers]}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, self.path)
+
+# SWARM downloads one file from every server that has it. CHUNKS gives
+# each server's digests of the file in chunk_size pieces; the version
+# most servers agree on is fetched, and a chunk can come from any
+# server whose digest for it matches. Each server's connection takes
+# the next chunk it can serve as soon as it finishes the last, so the
+# faster servers end up fetching more of the file. A chunk is checked
+# against its digest before it is written; a server that sends a bad
+# chunk or fails is dropped, and its chunk goes back to the others.
+# When no chunk is left to start, an idle server also fetches a chunk
+# still in flight on another, and the first copy to arrive is kept, so
+# the last chunks are not left waiting on the slowest server.
+
+class ChunkBuffer:
+
+    # File-like object for get_file_range that fills a preallocated
+    # buffer, so a chunk can be verified before it is written out.
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.count = 0
+
+    def write(self, data):
+        data_size = len(data)
+        if self.count + data_size > len(self.view):
+            raise OSError("more data than the chunk holds")
+        self.view[self.count:self.count + data_size] = data
+        self.count += data_size
+
+class SwarmPeer:
+
+    # One server taking part in a swarm download, on its own session
+    # connection, with its CHUNKS answer and what it has fetched.
+    def __init__(self, address, sock, file_size, digests):
+        self.address = address
+        self.sock = sock
+        self.file_size = file_size
+        self.digests = digests
+        self.chunks = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = None
+
+class SwarmSchedule:
+
+    # Which chunks are still to be fetched, in flight (and on how many
+    # peers) or done. All state is guarded by condition, which is
+    # notified whenever a chunk completes or comes back, and when a
+    # peer leaves.
+    def __init__(self, file_size, chunk_size, digests, fd, peer_count):
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.digests = digests
+        self.fd = fd
+        self.condition = threading.Condition()
+        self.pending = list(range(len(digests)))
+        self.in_flight = {}
+        self.done = set()
+        self.peers_left = peer_count
+
+    def complete(self):
+        return len(self.done) == len(self.digests)
+
+    def chunk_range(self, index):
+        offset = index * self.chunk_size
+        return (offset, min(self.chunk_size, self.file_size - offset))
+
+    def serves(self, peer, index):
+        return index < len(peer.digests) and peer.digests[index] == self.digests[index]
+
+    def next_chunk(self, peer):
+
+        # The next chunk for peer to fetch, or None when there is
+        # nothing more it can do. Waits while its only options are
+        # chunks in flight elsewhere, any of which may yet fail.
+        with self.condition:
+            while not self.complete():
+                for position, index in enumerate(self.pending):
+                    if self.serves(peer, index):
+                        del self.pending[position]
+                        self.in_flight[index] = 1
+                        return index
+
+                for index, fetchers in self.in_flight.items():
+                    if fetchers == 1 and self.serves(peer, index):
+                        self.in_flight[index] = 2
+                        return index
+
+                if not self.in_flight:
+                    return None
+                self.condition.wait()
+
+        return None
+
+    def chunk_done(self, index, data):
+
+        # Write a verified chunk, unless another peer got there first.
+        with self.condition:
+            if index not in self.done:
+                RangeWriter(self.fd, index * self.chunk_size).write(data)
+                self.done.add(index)
+                self.in_flight.pop(index, None)
+                self.condition.notify_all()
+
+    def chunk_failed(self, index):
+
+        # Put a chunk back unless it is done or still in flight on
+        # another peer.
+        with self.condition:
+            if index in self.done or index not in self.in_flight:
+                return
+            self.in_flight[index] -= 1
+            if not self.in_flight[index]:
+                del self.in_flight[index]
+                bisect.insort(self.pending, index)
+            self.condition.notify_all()
+
+    def peer_left(self):
+        with self.condition:
+            self.peers_left -= 1
+            self.condition.notify_all()
+
+    def wait(self):
+
+        # Block until every chunk is done or no peer is left to fetch
+        # one. Returns whether the download is complete.
+        with self.condition:
+            while not self.complete() and self.peers_left:
+                self.condition.wait()
+            return self.complete()
+
+########################################################################
+# Client-side metadata cache
+########################################################################
+
+class MetadataCache:
+
+    # What the client knows about the files GET has downloaded: for
+    # each name, the size, the file's mtime on the server and the
+    # SHA-256 digest of the copy received, together with the local
+    # copy's mtime. An entry is only used while the local file still
+    # has that size and mtime, so a file edited or replaced locally is
+    # fetched again in full.
+    #
+    # Entries are kept in a JSON-lines file, one line appended per
+    # update, so that recording a download costs one small write. The
+    # file is rewritten when it is loaded with more than twice as many
+    # lines as entries.
+    #
+    # One cache is shared by the MUX stream threads and the swarm
+    # workers, so updates to the entries and the file are made under a
+    # lock. Entries are replaced, never changed, so validator reads
+    # without it.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        line_count = 0
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line_count += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+                    self.entries[entry["name"]] = entry
+        except FileNotFoundError:
+            pass
+
+        if line_count > 2 * len(self.entries):
+            self.compact()
+
+    def validator(self, name):
+
+        # (size, server mtime, digest) for the local copy of name, or
+        # None if there is no trustworthy entry for it.
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(name)
+        except OSError:
+            return None
+
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["local_mtime_ns"]:
+            return None
+
+        return (entry["size"], entry["mtime_ns"], bytes.fromhex(entry["digest"]))
+
+    def record(self, name, file_size, mtime_ns, digest):
+        entry = {"name": name, "size": file_size, "mtime_ns": mtime_ns, "digest": digest.hex(),
+                 "local_mtime_ns": os.stat(name).st_mtime_ns}
+        with self.lock:
+            self.entries[name] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        temp_path = self.path + ".tmp"
+        with self.lock:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, self.path)
+
+#################################################################################
+            
+
+class Client:
+
+    SERVER_HOSTNAME = "localhost"
+    RECV_BUFFER_SIZE = 1024
+    local_Client_File_LIST = "D:/McMaster/4DN4/Lab3/client_recv"
+    DOWNLOADED_FILE_NAME = "D:/McMaster/4DN4/lab3/client_recv/filedownload_3_server.txt"
+    UPLOADED_FILE_NAME = "D:/McMaster/4DN4/Lab3/client_recv/upload_file_1_client.txt"
+    MSG_ENCODING = "utf-8"
+    MESSAGE =  "SERVICE DISCOVERY"
+    MESSAGE_ENCODED = MESSAGE.encode('utf-8')
+    BROADCAST_ADDRESS = "255.255.255.255"
+    SDP = 30000
+    ADDRESS_PORT = (BROADCAST_ADDRESS, SDP)
+
+    # Keep one connection open across commands instead of connecting
+    # again for every LIST/GET/PUT.
+    SESSION_MODE = True
+
+    # Entries per page for RLISTP, and the most matches SEARCH shows.
+    LIST_PAGE_SIZE = 1000
+    SEARCH_LIMIT = 1000
+
+    # Download into <filename>.part with ranged GETs, so an interrupted
+    # download continues from the bytes already on disk the next time
+    # the file is requested. The size and mtime of the remote file are
+    # kept in <filename>.part.validator, and the download starts again
+    # if the file has changed on the server since.
+    RESUME_DOWNLOADS = True
+    PARTIAL_SUFFIX = ".part"
+    PARTIAL_VALIDATOR_SUFFIX = ".validator"
+
+    # PGET splits a file into PARALLEL_CHUNK_SIZE ranges and fetches
+    # them over this many connections at once.
+    PARALLEL_CONNECTIONS = 4
+    PARALLEL_CHUNK_SIZE = 8 * 1024 * 1024
+
+    # Codecs offered by ZGET and tried, in order, by ZPUT, and the
+    # compression level (1-9) asked for. Higher levels only pay off on
+    # links much slower than the compressor.
+    COMPRESSION_CODECS = ["zlib", "lzma"]
+    COMPRESSION_LEVEL = 1
+
+    # Digest used by VGET and VPUT, and how many times a transfer whose
+    # digest does not match is repeated.
+    VERIFY_ALGORITHM = "crc32c" if crc32c is not None else "crc32"
+    VERIFY_RETRIES = 2
+
+    # GET remembers what it downloaded in METADATA_CACHE_FILE, in the
+    # download folder, and asks the server with CGET to send a file
+    # only if it differs from the local copy.
+    CONDITIONAL_GET = True
+    METADATA_CACHE_FILE = ".lab3_metadata"
+
+    # SCAN collects discovery replies for SCAN_TIMEOUT seconds, times
+    # DISCOVERY_PROBES TCP connects to each server that replied and
+    # ranks them by the fastest. The ranking is kept in
+    # DISCOVERY_CACHE_FILE, and for DISCOVERY_CACHE_TTL seconds after
+    # the scan the client connects to the nearest server instead of
+    # SERVER_HOSTNAME, without broadcasting again.
+    SCAN_TIMEOUT = 1.0
+    DISCOVERY_PROBES = 3
+    USE_DISCOVERY_CACHE = True
+    DISCOVERY_CACHE_FILE = ".lab3_servers"
+    DISCOVERY_CACHE_TTL = 600
+
+    # SWARM downloads from every server found in SWARM_CHUNK_SIZE
+    # chunks, and gives a server this long to digest the file before
+    # it answers.
+    SWARM_CHUNK_SIZE = 4 * 1024 * 1024
+    SWARM_DIGEST_TIMEOUT = 60
+
+    # SYNC copies files in batches of at most SYNC_BATCH_FILES files,
+    # and for SYNC PUT SYNC_BATCH_BYTES bytes, sending up to
+    # SYNC_PIPELINE_DEPTH batches ahead of the server's replies. The
+    # server is given SYNC_REPLY_TIMEOUT seconds to walk its tree,
+    # digest files or take in a batch before it answers.
+    SYNC_BATCH_FILES = 256
+    SYNC_BATCH_BYTES = 4 * 1024 * 1024
+    SYNC_PIPELINE_DEPTH = 4
+    SYNC_REPLY_TIMEOUT = 60
+
+    def __init__(self):
+        self.connect_to_server()
+        self.send_console_input_forever()
+        
+
+    def connect_to_server(self):
+
+        # The first time, try the servers in the discovery cache, nearest
+        # first. The one that answers is kept for the rest of the run,
+        # and also used by the extra connections of PGET and MUX. Without
+        # one, connect to SERVER_HOSTNAME.
+        if getattr(self, 'server_address', None) is None and Client.USE_DISCOVERY_CACHE:
+            for address, name, rtt in self.discovery_cache().load():
+                try:
+                    self.socket = self.open_connection(address)
+                except OSError:
+                    continue
+                self.server_address = address
+                print(f"Connected to {name} at {address[0]}:{address[1]}, "
+                      f"the nearest server found by SCAN ({rtt * 1000:.1f} ms).")
+                return
+
+        try:
+
+            self.socket = self.open_connection()
+        
+        except Exception as e:
+
+            print(f"Cannot connect to the server: {e}")
+            sys.exit(1)
+
+    def open_connection(self, address=None):
+
+        # The server answers every new connection with OK, or with BUSY
+        # and a close when its worker pool's queue is full. address
+        # defaults to the server connect_to_server chose.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.connect(address or getattr(self, 'server_address', None)
+                     or (Client.SERVER_HOSTNAME, Server.FILE_SHARING_PORT))
+        sock.settimeout(SOCKET_TIMEOUT)
+
+        status, status_field = recv_bytes(sock, STATUS_FIELD_LEN)
+        if not status or int.from_bytes(status_field, byteorder='big') != STATUS["OK"]:
+            sock.close()
+            raise ConnectionError("the server is busy, try again later")
+
+        return sock
+
+    def ensure_connected(self):
+
+        # Reuse the session connection unless it has been closed, either
+        # by us after a failed command or by the server after an error
+        # or idle timeout. An idle session socket that is readable means
+        # the server has closed its end.
+        if self.socket.fileno() != -1:
+            if not wait_readable(self.socket, 0):
+                return
+            self.socket.close()
+
+        self.connect_to_server()
+
+    def discovery_cache(self):
+        return DiscoveryCache(Client.DISCOVERY_CACHE_FILE, Client.DISCOVERY_CACHE_TTL)
+
+    def send_service_discovery_request(self):
+
+        # Find the servers on the network, nearest first, and remember
+        # them, for SWARM and in the discovery cache for later runs.
+        self.servers = self.discover_servers()
+        if self.servers:
+            self.discovery_cache().store(self.servers)
+        return self.servers
+
+    def known_servers(self):
+
+        # The servers the last scan found, if it is recent enough, or
+        # else those a new scan finds.
+        if getattr(self, 'servers', None):
+            return self.servers
+
+        if Client.USE_DISCOVERY_CACHE:
+            self.servers = self.discovery_cache().load()
+            if self.servers:
+                return self.servers
+
+        return self.send_service_discovery_request()
+
+    def get_console_input(self):
+        while True:
+            self.input_text = input("Input: ")
+            self.command_parts = self.input_text.strip().split(' ')
+            if self.input_text != "":
+                break
+    
+    def send_console_input_forever(self):
+        should_exit = False 
+
+        while not should_exit:  
+
+            try:
+
+                self.get_console_input()
+
+                if Client.SESSION_MODE:
+                    self.ensure_connected()
+                else:
+                    self.connect_to_server() 
+
+                if self.command_parts[0].upper() == "GET" and len(self.command_parts) == 2:
+                    download_filename = self.command_parts[1]
+                    self.get_file(download_filename)
+
+                elif self.command_parts[0].upper() == "PGET" and len(self.command_parts) in (2, 3):
+                    download_filename = self.command_parts[1]
+                    try:
+                        connections = int(self.command_parts[2]) if len(self.command_parts) == 3 else Client.PARALLEL_CONNECTIONS
+                    except ValueError:
+                        connections = 0
+                    if connections > 0:
+                        self.get_file_parallel(download_filename, connections)
+                    else:
+                        print("Usage: PGET <file> [connections], with a positive number of connections.")
+
+                elif self.input_text.upper() == "RLIST":
+                    self.remote_list_files()
+
+                elif self.command_parts[0].upper() == "RLISTP" and len(self.command_parts) <= 2:
+                    pattern = self.command_parts[1] if len(self.command_parts) == 2 else ""
+                    self.remote_list_pages(pattern)
+
+                elif self.command_parts[0].upper() == "SEARCH" and len(self.command_parts) >= 2:
+                    self.search(self.input_text.strip()[len("SEARCH"):].strip())
+
+                elif self.input_text.upper() == "LLIST":
+                    self.local_list_files()
+
+                elif self.command_parts[0].upper() == "PUT" and len(self.command_parts) == 2:
+                    upload_filename = self.command_parts[1]
+                    self.put_files(upload_filename)
+
+                elif self.command_parts[0].upper() == "DPUT" and len(self.command_parts) == 2:
+                    upload_filename = self.command_parts[1]
+                    self.put_file_dedup(upload_filename)
+
+                elif self.command_parts[0].upper() == "ZGET" and (len(self.command_parts) == 2 or
+                                                                    len(self.command_parts) == 3 and self.command_parts[2] in CODEC):
+                    download_filename = self.command_parts[1]
+                    codec_name = self.command_parts[2] if len(self.command_parts) == 3 else None
+                    self.get_file_compressed(download_filename, codec_name)
+
+                elif self.command_parts[0].upper() == "ZPUT" and len(self.command_parts) == 2:
+                    upload_filename = self.command_parts[1]
+                    self.put_file_compressed(upload_filename)
+
+                elif self.command_parts[0].upper() == "VGET" and len(self.command_parts) in (2, 3):
+                    algorithm = self.command_parts[2] if len(self.command_parts) == 3 else None
+                    self.get_file_verified(self.command_parts[1], algorithm)
+
+                elif self.command_parts[0].upper() == "VPUT" and len(self.command_parts) in (2, 3):
+                    algorithm = self.command_parts[2] if len(self.command_parts) == 3 else None
+                    self.put_file_verified(self.command_parts[1], algorithm)
+
+                elif self.command_parts[0].upper() == "MGET" and len(self.command_parts) >= 2:
+                    self.get_files(self.command_parts[1:])
+
+                elif self.command_parts[0].upper() == "RPUT" and len(self.command_parts) == 2:
+                    upload_filename = self.command_parts[1]
+                    self.put_file_delta(upload_filename)
+
+                elif self.input_text.upper() == "STATS":
+                    self.server_stats()
+
+                elif (self.command_parts[0].upper() == "SYNC" and len(self.command_parts) in (3, 4)
+                        and self.command_parts[1].upper() in ("GET", "PUT")):
+                    remote_dir = self.command_parts[3].strip("/") if len(self.command_parts) == 4 else ""
+                    self.sync(self.command_parts[1].upper(), self.command_parts[2], remote_dir)
+
+                elif self.command_parts[0].upper() == "SWARM" and len(self.command_parts) == 2:
+                    self.get_file_swarm(self.command_parts[1])
+
+                elif self.command_parts[0].upper() == "MUX" and len(self.command_parts) >= 2:
+                    commands = " ".join(self.command_parts[1:]).split(";")
+                    self.run_multiplexed([command.split() for command in commands if command.strip()])
+
+                elif self.command_parts[0].upper() == "LIMIT" and len(self.command_parts) == 3:
+                    try:
+                        rates = [parse_size(part) for part in self.command_parts[1:]]
+                    except ValueError:
+                        print("Usage: LIMIT <global rate> <per-client rate>, e.g. LIMIT 10M 2M; 0 for none.")
+                    else:
+                        self.set_limits(*rates)
+
+                elif self.input_text.upper() == "BYE":
+                    self.bye()  
+                    should_exit = True  
+
+                elif self.input_text.upper() == "SCAN":
+                    self.scan()
+
+                elif self.input_text.upper() == "CONNECT":
+                    self.connect()
+
+                else:
+                    print("Invalid input. Please use the format")
+
+                if not should_exit and not Client.SESSION_MODE:  
+                    self.socket.close() 
+
+            except (KeyboardInterrupt, EOFError):
+                print()
+                print("Closing server connection ...")
+                if self.socket:
+                    self.socket.close()
+                should_exit = True  
+
+            if should_exit:  
+                if self.socket:
+                    self.socket.close()
+                print("Exiting...")
+                sys.exit(1)
+
+                
+    def connection_send(self):
+        try:
+            self.socket.sendall(self.input_text.encode(Server.MSG_ENCODING))
+        except Exception as msg:
+            print(msg)
+            sys.exit(1)
+
+
+    def connection_receive(self):
+        try:
+            recvd_bytes = self.socket.recv(Client.RECV_BUFFER_SIZE)
+
+            if len(recvd_bytes) == 0:
+                print("Closing server connection ... ")
+                self.socket.close()
+                sys.exit(1)
+
+            print("Received: ", recvd_bytes.decode(Server.MSG_ENCODING))
+
+        except Exception as msg:
+            print(msg)
+            sys.exit(1)
+
+
+    def get_file(self, filename):
+
+        if Client.CONDITIONAL_GET:
+            self.get_file_conditional(filename)
+            return
+
+        if Client.RESUME_DOWNLOADS:
+            self.get_file_resumable(filename)
+            return
+
+        cmd_field = CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+
+
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+
+        filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+
+
+        print("\nCreating packet")
+        print("Command field: ", cmd_field.hex())
+        print("Filename size (as byte length): ", filename_size_field.hex())
+        print("Filename field (in byte form): ", filename_field_bytes.hex())
+        
+
+        pkt = cmd_field + filename_size_field + filename_field_bytes
+
+
+        print("Sending packet to server...")
+        self.socket.sendall(pkt)
+
+
+        print("\nWaiting for server response...\n")
+        status, file_size_bytes = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+        if not status:
+            # print("Closing connection ...")
+            self.socket.close()
+            return
+
+        print("File size field: ", file_size_bytes.hex())
+        
+        if len(file_size_bytes) == 0:
+            self.socket.close()
+            return
+
+        file_size = int.from_bytes(file_size_bytes, byteorder='big') 
+        print("File size (as byte length): ", file_size)
+                                
+
+        status, recvd_bytes_total = recv_bytes(self.socket, file_size)
+
+        if not status:
+            # print("Closing connection ...")            
+            self.socket.close()
+            return
+
+
+        try:
+            print(f"Received {len(recvd_bytes_total)} bytes. Creating file: {filename}")
+
+            with open(filename, 'wb') as f:  
+                f.write(recvd_bytes_total)  
+
+            print("File successfully downloaded and saved.")
+
+        except KeyboardInterrupt:
+            print("Download interrupted by user.")
+            exit(1)
+
+
+    # Guards the first metadata() call, which may come from several
+    # stream or swarm threads at once.
+    metadata_lock = threading.Lock()
+
+    def metadata(self):
+        with Client.metadata_lock:
+            if getattr(self, 'metadata_cache', None) is None:
+                self.metadata_cache = MetadataCache(Client.METADATA_CACHE_FILE)
+        return self.metadata_cache
+
+    def get_file_conditional(self, filename):
+
+        # GET through CGET: the server sends the file only if it differs
+        # from the local copy recorded in the metadata cache. The body
+        # is hashed as it arrives. Returns the number of bytes received,
+        # 0 if the local copy is current, or None on failure.
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+        validator_filename = partial_filename + Client.PARTIAL_VALIDATOR_SUFFIX
+        metadata = self.metadata()
+
+        if Client.RESUME_DOWNLOADS and os.path.exists(partial_filename):
+            # Finish an interrupted download with ranged GETs.
+            remote = self.get_file_resumable(filename)
+            if remote is None:
+                return None
+            metadata.record(filename, remote[0], remote[1], file_digest(filename))
+            return remote[0]
+
+        file_size, mtime_ns, digest = metadata.validator(filename) or (0, 0, bytes(VALIDATOR_DIGEST_LEN))
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+
+        self.socket.sendall(CMD["CGET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+                            + filename_field_bytes
+                            + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                            + mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                            + digest)
+
+        status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return None
+
+        if response[0] == STATUS["NOT_FOUND"]:
+            print("Requested file is not available on the server.")
+            return None
+
+        status, mtime_field = recv_bytes(self.socket, MTIME_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return None
+
+        server_mtime_ns = int.from_bytes(mtime_field, byteorder='big')
+
+        if response[0] == STATUS["NOT_MODIFIED"]:
+            if server_mtime_ns != mtime_ns:
+                metadata.record(filename, file_size, server_mtime_ns, digest)
+            print(f"{filename} is up to date.")
+            return 0
+
+        status, file_size_field = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return None
+
+        file_size = int.from_bytes(file_size_field, byteorder='big')
+        digest = hashlib.sha256()
+
+        save_range_validator(validator_filename, file_size, server_mtime_ns)
+        with open(partial_filename, 'wb') as f:
+            received = recv_file(self.socket, HashingWriter(f, digest), file_size, bytearray(FILE_CHUNK_SIZE))
+
+        if not received:
+            print(f"Download interrupted. {partial_filename} is kept; GET {filename} again to resume.")
+            self.socket.close()
+            return None
+
+        os.replace(partial_filename, filename)
+        remove_range_validator(validator_filename)
+        metadata.record(filename, file_size, server_mtime_ns, digest.digest())
+        print(f"Received {file_size} bytes. Creating file: {filename}")
+        print("File successfully downloaded and saved.")
+        return file_size
+
+    def get_file_resumable(self, filename):
+
+        # Returns the remote file's size and mtime, or None on failure.
+        # The bytes already in <filename>.part are only kept if they came
+        # from the same version of the file: its validator goes with
+        # the ranged GET as If-Range.
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+        validator_filename = partial_filename + Client.PARTIAL_VALIDATOR_SUFFIX
+
+        offset = 0
+        validator = None
+        if os.path.exists(partial_filename):
+            validator = read_range_validator(validator_filename)
+            if validator is not None:
+                offset = os.path.getsize(partial_filename)
+                print(f"Resuming download of {filename} from byte {offset}")
+
+        def started(file_size, mtime_ns):
+            # Saved before the range arrives, so an interrupted download
+            # can be resumed.
+            if (file_size, mtime_ns) != validator:
+                save_range_validator(validator_filename, file_size, mtime_ns)
+
+        with open(partial_filename, 'ab' if offset else 'wb') as f:
+            status, file_size, mtime_ns, range_length = self.get_file_range(filename, offset, 0, f, validator=validator,
+                                                                            on_header=started)
+
+        if status in (STATUS["CHANGED"], STATUS["BAD_RANGE"]):
+            # The file has changed on the server, or the partial file is
+            # longer than it, so it is not a prefix of the remote file.
+            # Start again from the beginning.
+            print("Partial download does not match the remote file, restarting ...")
+            validator = None
+            with open(partial_filename, 'wb') as f:
+                status, file_size, mtime_ns, range_length = self.get_file_range(filename, 0, 0, f, on_header=started)
+
+        if status is None:
+            print(f"Download interrupted. {partial_filename} is kept; GET {filename} again to resume.")
+            return None
+
+        if status == STATUS["NOT_FOUND"]:
+            print("Requested file is not available on the server.")
+            if os.path.getsize(partial_filename) == 0:
+                os.remove(partial_filename)
+                remove_range_validator(validator_filename)
+            return None
+
+        if status != STATUS["OK"]:
+            print("Download failed on the server.")
+            return None
+
+        os.replace(partial_filename, filename)
+        remove_range_validator(validator_filename)
+        print(f"Received {range_length} bytes ({file_size} in total). Creating file: {filename}")
+        print("File successfully downloaded and saved.")
+        return (file_size, mtime_ns)
+
+    def get_file_range(self, filename, offset, length, f, sock=None, validator=None, on_header=None):
+
+        # Send a ranged GET and stream the range into f. Returns the
+        # response status, the remote file size and mtime and the range
+        # length; the status is None if the connection failed, and
+        # CHANGED if the file no longer matches validator, a (size,
+        # mtime) pair. on_header is called with the size and mtime
+        # before the range is received. sock defaults to the session
+        # socket.
+        if sock is None:
+            sock = self.socket
+
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+        validator_size, validator_mtime_ns = validator or (0, 0)
+
+        pkt = (CMD["GETRANGE"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big')
+               + length.to_bytes(LENGTH_FIELD_LEN, byteorder='big')
+               + validator_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+               + validator_mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big'))
+
+        try:
+            sock.sendall(pkt)
+
+            status, status_field = recv_bytes(sock, STATUS_FIELD_LEN)
+
+            if not status:
+                sock.close()
+                return (None, 0, 0, 0)
+
+            response_status = int.from_bytes(status_field, byteorder='big')
+
+            if response_status not in (STATUS["OK"], STATUS["CHANGED"]):
+                return (response_status, 0, 0, 0)
+
+            status, size_fields = recv_bytes(sock, FILESIZE_FIELD_LEN + MTIME_FIELD_LEN + LENGTH_FIELD_LEN)
+
+            if not status:
+                sock.close()
+                return (None, 0, 0, 0)
+
+            file_size = int.from_bytes(size_fields[:FILESIZE_FIELD_LEN], byteorder='big')
+            mtime_ns = int.from_bytes(size_fields[FILESIZE_FIELD_LEN:FILESIZE_FIELD_LEN + MTIME_FIELD_LEN],
+                                      byteorder='big')
+            range_length = int.from_bytes(size_fields[FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:], byteorder='big')
+
+            if response_status == STATUS["CHANGED"]:
+                return (response_status, file_size, mtime_ns, 0)
+
+            if on_header is not None:
+                on_header(file_size, mtime_ns)
+
+            if not recv_file(sock, f, range_length, bytearray(FILE_CHUNK_SIZE)):
+                sock.close()
+                return (None, file_size, mtime_ns, range_length)
+
+            return (response_status, file_size, mtime_ns, range_length)
+
+        except socket.error as e:
+            print(f"Connection error: {e}")
+            sock.close()
+            return (None, 0, 0, 0)
+
+    def get_file_parallel(self, filename, connections=None, chunk_size=None):
+
+        # Parallel download: the first range comes over the session
+        # socket and tells us the file size. The rest of the file is
+        # split into chunk_size ranges, which a pool of connections
+        # fetches concurrently, each writing its ranges in place.
+        connections = connections or Client.PARALLEL_CONNECTIONS
+        chunk_size = chunk_size or Client.PARALLEL_CHUNK_SIZE
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+
+        fd = os.open(partial_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        completed = False
+
+        try:
+            status, file_size, mtime_ns, range_length = self.get_file_range(filename, 0, chunk_size, RangeWriter(fd, 0))
+
+            if status != STATUS["OK"]:
+                print("Requested file is not available on the server." if status == STATUS["NOT_FOUND"]
+                      else "Download failed.")
+                return
+
+            os.ftruncate(fd, file_size)
+
+            ranges = queue.Queue()
+            for offset in range(range_length, file_size, chunk_size):
+                ranges.put((offset, min(chunk_size, file_size - offset)))
+
+            print(f"Downloading {file_size} bytes over {connections} connections "
+                  f"in {ranges.qsize() + 1} ranges of up to {chunk_size} bytes")
+
+            workers = [threading.Thread(target=self.get_ranges_forever, args=(filename, (file_size, mtime_ns), fd, ranges))
+                       for _ in range(min(connections, ranges.qsize()))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            if not ranges.empty():
+                print("Parallel download failed: not every range could be fetched.")
+                return
+
+            completed = True
+
+        finally:
+            os.close(fd)
+
+            # The ranges arrive out of order, so a failed parallel
+            # download cannot be resumed from its length.
+            if not completed:
+                os.remove(partial_filename)
+
+        os.replace(partial_filename, filename)
+        print(f"Received {file_size} bytes. Creating file: {filename}")
+        print("File successfully downloaded and saved.")
+
+    def get_ranges_forever(self, filename, validator, fd, ranges):
+
+        # Worker for get_file_parallel: take ranges off the queue until
+        # it is empty. A range that fails, or comes from a version of
+        # the file other than validator's, is put back for another
+        # worker and this worker gives up its connection.
+        try:
+            sock = self.open_connection()
+        except OSError as e:
+            print(f"Cannot connect to the server: {e}")
+            return
+
+        try:
+            while True:
+                try:
+                    offset, length = ranges.get_nowait()
+                except queue.Empty:
+                    return
+
+                status, _, _, _ = self.get_file_range(filename, offset, length, RangeWriter(fd, offset), sock, validator)
+
+                if status != STATUS["OK"]:
+                    ranges.put((offset, length))
+                    return
+
+        finally:
+            sock.close()
+
+    def remote_list_files(self):
+
+        cmd_field = CMD["LIST"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+
+
+        print("Creating 'list' packet")
+        print("Command field: ", cmd_field.hex())
+        self.socket.sendall(cmd_field)
+        print("Waiting for server response...")
+
+        status, list_size_bytes = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+        if not status:
+            # print("Closing connection ...")
+            self.socket.close()
+            return
+
+        if len(list_size_bytes) == 0:
+            print("No data received, closing connection...")
+            self.socket.close()
+            return
+
+        list_size = int.from_bytes(list_size_bytes, byteorder='big')
+        print("Received file list size: ", list_size)
+        print("\n")
+
+        status, file_list_bytes = recv_bytes(self.socket, list_size)
+
+        if not status:
+            # print("Closing connection ...")
+            self.socket.close()
+            return
+
+        try:
+
+            file_list_str = file_list_bytes.decode(MSG_ENCODING)
+            print(f"Here is the file list from the server folder {Server.REMOTE_FOLDER_LIST}:")
+            print(file_list_str)
+
+        except Exception as e:
+            print("Error:", e)
+
+
+    def remote_list_pages(self, pattern):
+
+        # Page through the remote listing, asking before each new page.
+        cursor = ""
+
+        while True:
+            cursor = self.remote_list_page(pattern, cursor, Client.LIST_PAGE_SIZE)
+
+            if not cursor:
+                break
+
+            if input("-- more (Enter for the next page, q to stop) -- ").strip().lower() == "q":
+                break
+
+    def remote_list_page(self, pattern, cursor, page_size):
+
+        # Request one page of the listing and print each batch of
+        # entries as it arrives. Returns the cursor for the next page,
+        # or "" if this was the last one.
+        pattern_bytes = pattern.encode(MSG_ENCODING)
+        cursor_bytes = cursor.encode(MSG_ENCODING)
+
+        pkt = (CMD["LISTPAGE"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(pattern_bytes).to_bytes(PATTERN_SIZE_FIELD_LEN, byteorder='big')
+               + pattern_bytes
+               + len(cursor_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + cursor_bytes
+               + page_size.to_bytes(PAGE_SIZE_FIELD_LEN, byteorder='big'))
+
+        self.socket.sendall(pkt)
+
+        while True:
+            status, entry_count_field = recv_bytes(self.socket, ENTRY_COUNT_FIELD_LEN)
+
+            if not status:
+                self.socket.close()
+                return ""
+
+            entry_count = int.from_bytes(entry_count_field, byteorder='big')
+
+            if entry_count == 0:
+                break
+
+            for _ in range(entry_count):
+                status, name_size_field = recv_bytes(self.socket, FILENAME_SIZE_FIELD_LEN)
+
+                if status:
+                    status, entry = recv_bytes(self.socket, int.from_bytes(name_size_field, byteorder='big')
+                                               + FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
+
+                if not status:
+                    self.socket.close()
+                    return ""
+
+                name = entry[:-FILESIZE_FIELD_LEN - MTIME_FIELD_LEN].decode(MSG_ENCODING)
+                file_size = int.from_bytes(entry[-FILESIZE_FIELD_LEN - MTIME_FIELD_LEN:-MTIME_FIELD_LEN], byteorder='big')
+                mtime_ns = int.from_bytes(entry[-MTIME_FIELD_LEN:], byteorder='big')
+
+                print(f"{file_size:>14}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime_ns / 10**9))}  {name}")
+
+        status, cursor_size_field = recv_bytes(self.socket, FILENAME_SIZE_FIELD_LEN)
+
+        if status:
+            status, cursor_bytes = recv_bytes(self.socket, int.from_bytes(cursor_size_field, byteorder='big'))
+
+        if not status:
+            self.socket.close()
+            return ""
+
+        return cursor_bytes.decode(MSG_ENCODING)
+
+    def search(self, text, limit=None):
+
+        # Print the files on the server matching a SEARCH query. Returns
+        # the match count and [(name, size, mtime_ns)] for the first
+        # limit matches (SEARCH_LIMIT by default), or None on failure.
+        # The query is checked here first, so a typo is reported
+        # without a round trip.
+        limit = Client.SEARCH_LIMIT if limit is None else limit
+
+        try:
+            parse_query(text)
+        except ValueError as e:
+            print(f"Bad query: {e}")
+            return None
+
+        query_bytes = text.encode(MSG_ENCODING)
+
+        self.socket.sendall(CMD["SEARCH"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + len(query_bytes).to_bytes(QUERY_SIZE_FIELD_LEN, byteorder='big')
+                            + query_bytes
+                            + limit.to_bytes(PAGE_SIZE_FIELD_LEN, byteorder='big'))
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return None
+
+        if status_field[0] != STATUS["OK"]:
+            print("The server could not run the query.")
+            return None
+
+        status, count_fields = recv_bytes(self.socket, MATCH_COUNT_FIELD_LEN + FILESIZE_FIELD_LEN)
+
+        if status:
+            status, body = recv_bytes(self.socket, int.from_bytes(count_fields[MATCH_COUNT_FIELD_LEN:], byteorder='big'))
+
+        if not status:
+            self.socket.close()
+            return None
+
+        match_count = int.from_bytes(count_fields[:MATCH_COUNT_FIELD_LEN], byteorder='big')
+        results = []
+        position = 0
+
+        while position < len(body):
+            name_size = body[position]
+            position += FILENAME_SIZE_FIELD_LEN
+            name = body[position:position + name_size].decode(MSG_ENCODING)
+            position += name_size
+            file_size = int.from_bytes(body[position:position + FILESIZE_FIELD_LEN], byteorder='big')
+            position += FILESIZE_FIELD_LEN
+            mtime_ns = int.from_bytes(body[position:position + MTIME_FIELD_LEN], byteorder='big')
+            position += MTIME_FIELD_LEN
+            results.append((name, file_size, mtime_ns))
+
+        for name, file_size, mtime_ns in results:
+            print(f"{file_size:>14}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime_ns / 10**9))}  {name}")
+
+        print(f"{match_count} matches" + (f", first {len(results)} shown" if len(results) < match_count else ""))
+        return (match_count, results)
+
+    def put_files(self, filename):
+
+        if not os.path.exists(filename):
+            print("File does not exist.")
+            return
+
+        cmd_field = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
+
+        filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+        file_size = os.path.getsize(filename)
+        file_size_field = file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+
+
+        print("Creating 'put' packet")
+        print("Command field: ", cmd_field.hex())
+        print("Filename size (as byte length): ", filename_size_field.hex())
+        print("Filename field (in byte form): ", filename_field_bytes.hex())
+        print("File size (as byte length): ", file_size_field.hex())
+
+        pkt = cmd_field + filename_size_field + filename_field_bytes + file_size_field
+
+        print("Sending 'put' packet to server...")
+        self.socket.sendall(pkt)
+
+        # Stream the file body instead of building it into the packet.
+        with open(filename, 'rb') as f:
+            if file_size:
+                self.socket.sendfile(f, 0, file_size)
+
+        print("Waiting for server response...")
+
+        status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            # print("Closing connection ...")
+            self.socket.close()
+            return
+
+        if int.from_bytes(response, byteorder='big') == STATUS["OK"]:
+            print("File successfully upload to server")
+        else:
+            print("Upload failed on the server.")
+
+    def put_file_dedup(self, filename):
+
+        # Deduplicating upload: send the chunk hashes first and then
+        # only the chunks the server does not already hold.
+        if not os.path.exists(filename):
+            print("File does not exist.")
+            return
+
+        file_size = os.path.getsize(filename)
+
+        digests = []
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(DEDUP_CHUNK_SIZE), b''):
+                digests.append(hashlib.sha256(chunk).digest())
+
+        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
+
+        pkt = (CMD["DPUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+               + len(digests).to_bytes(CHUNK_COUNT_FIELD_LEN, byteorder='big')
+               + b''.join(digests))
+
+        print(f"Sending {len(digests)} chunk hashes to server...")
+        self.socket.sendall(pkt)
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        if int.from_bytes(status_field, byteorder='big') != STATUS["OK"]:
+            print("Server does not accept deduplicated uploads.")
+            return
+
+        status, missing = recv_bytes(self.socket, (len(digests) + 7) // 8)
+
+        if not status:
+            self.socket.close()
+            return
+
+        sent_bytes = 0
+        with open(filename, 'rb') as f:
+            for index in range(len(digests)):
+                if missing[index // 8] & (0x80 >> (index % 8)):
+                    chunk_size = min(DEDUP_CHUNK_SIZE, file_size - index * DEDUP_CHUNK_SIZE)
+                    self.socket.sendfile(f, index * DEDUP_CHUNK_SIZE, chunk_size)
+                    sent_bytes += chunk_size
+
+        print(f"Sent {sent_bytes} of {file_size} bytes; the server already had the rest.")
+
+        status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        if int.from_bytes(response, byteorder='big') == STATUS["OK"]:
+            print("File successfully upload to server")
+        else:
+            print("Upload failed on the server.")
+
+    def get_file_compressed(self, filename, codec_name=None):
+
+        # ZGET: offer the codecs we can decode (or only codec_name) and
+        # let the server pick one. Small or incompressible files come
+        # back with codec "none".
+        if codec_name is not None:
+            codec_mask = 1 << CODEC[codec_name]
+        else:
+            codec_mask = 0
+            for name in Client.COMPRESSION_CODECS:
+                codec_mask |= 1 << CODEC[name]
+        codec_mask &= supported_codecs()
+
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+
+        pkt = (CMD["ZGET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + codec_mask.to_bytes(CODEC_FIELD_LEN, byteorder='big')
+               + Client.COMPRESSION_LEVEL.to_bytes(LEVEL_FIELD_LEN, byteorder='big'))
+
+        self.socket.sendall(pkt)
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        if int.from_bytes(status_field, byteorder='big') == STATUS["NOT_FOUND"]:
+            print("Requested file is not available on the server.")
+            return
+
+        status, header = recv_bytes(self.socket, CODEC_FIELD_LEN + FILESIZE_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        codec = header[0]
+        file_size = int.from_bytes(header[CODEC_FIELD_LEN:], byteorder='big')
+
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+
+        try:
+            with open(partial_filename, 'wb') as f:
+                status = recv_compressed(self.socket, f, codec, file_size)
+        except DECOMPRESSION_ERRORS as e:
+            print(f"Corrupt compressed data: {e}")
+            status = False
+
+        if not status:
+            print("Download failed.")
+            os.remove(partial_filename)
+            self.socket.close()
+            return
+
+        os.replace(partial_filename, filename)
+        print(f"Received {file_size} bytes (codec {codec}). Creating file: {filename}")
+        print("File successfully downloaded and saved.")
+
+    def put_file_compressed(self, filename):
+
+        # ZPUT: compress with the first of COMPRESSION_CODECS we support.
+        # Falls back to a plain PUT for incompressible files or when the
+        # server does not know the codec.
+        if not os.path.exists(filename):
+            print("File does not exist.")
+            return
+
+        codec = choose_codec(supported_codecs(), Client.COMPRESSION_CODECS)
+
+        with open(filename, 'rb') as f:
+            first_chunk = f.read(COMPRESSION_CHUNK_SIZE)
+
+        if codec == CODEC["none"] or not is_compressible(first_chunk):
+            print("File does not compress well, sending it as a plain PUT.")
+            self.put_files(filename)
+            return
+
+        file_size = os.path.getsize(filename)
+        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
+
+        pkt = (CMD["ZPUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + codec.to_bytes(CODEC_FIELD_LEN, byteorder='big')
+               + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+
+        self.socket.sendall(pkt)
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        if int.from_bytes(status_field, byteorder='big') != STATUS["OK"]:
+            print("Server does not accept this codec, sending it as a plain PUT.")
+            self.put_files(filename)
+            return
+
+        with open(filename, 'rb') as f:
+            sent = send_compressed(self.socket, f, codec, Client.COMPRESSION_LEVEL)
+
+        print(f"Sent {file_size} bytes as {sent} compressed bytes.")
+
+        status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return
+
+        if int.from_bytes(response, byteorder='big') == STATUS["OK"]:
+            print("File successfully upload to server")
+        else:
+            print("Upload failed on the server.")
+
+    def get_file_verified(self, filename, algorithm=None):
+
+        # VGET into <filename>.part, renamed once the trailer matches.
+        # A mismatch is retried up to VERIFY_RETRIES times. Returns True
+        # on success.
+        algorithm = DIGEST[algorithm or Client.VERIFY_ALGORITHM]
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+        pkt = (CMD["VGET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + algorithm.to_bytes(DIGEST_FIELD_LEN, byteorder='big'))
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+
+        for attempt in range(1 + Client.VERIFY_RETRIES):
+            self.socket.sendall(pkt)
+
+            status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+            if not status:
+                self.socket.close()
+                return False
+
+            if status_field[0] == STATUS["NOT_FOUND"]:
+                print("Requested file is not available on the server.")
+                return False
+
+            if status_field[0] != STATUS["OK"]:
+                print("The server does not support this digest algorithm.")
+                return False
+
+            status, file_size_field = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+            if not status:
+                self.socket.close()
+                return False
+
+            file_size = int.from_bytes(file_size_field, byteorder='big')
+
+            with open(partial_filename, 'wb') as f:
+                matched = recv_with_digest(self.socket, f, file_size, make_digest(algorithm))
+
+            if matched:
+                os.replace(partial_filename, filename)
+                print(f"Received {file_size} bytes, digest verified. Creating file: {filename}")
+                return True
+
+            os.remove(partial_filename)
+
+            if matched is None:
+                print("Download interrupted.")
+                self.socket.close()
+                return False
+
+            print(f"Digest mismatch on attempt {attempt + 1}.")
+
+        print("Download failed: the file did not arrive intact.")
+        return False
+
+    def put_file_verified(self, filename, algorithm=None):
+
+        # VPUT with a digest trailer. The server discards a file whose
+        # digest does not match; it is sent again up to VERIFY_RETRIES
+        # times. Returns True on success.
+        if not os.path.exists(filename):
+            print("File does not exist.")
+            return False
+
+        algorithm = DIGEST[algorithm or Client.VERIFY_ALGORITHM]
+        file_size = os.path.getsize(filename)
+        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
+        pkt = (CMD["VPUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+               + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+               + filename_field_bytes
+               + algorithm.to_bytes(DIGEST_FIELD_LEN, byteorder='big')
+               + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+
+        for attempt in range(1 + Client.VERIFY_RETRIES):
+            self.socket.sendall(pkt)
+
+            status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+            if not status:
+                self.socket.close()
+                return False
+
+            if status_field[0] != STATUS["OK"]:
+                print("The server does not support this digest algorithm.")
+                return False
+
+            with open(filename, 'rb') as f:
+                send_with_digest(self.socket, f, file_size, make_digest(algorithm))
+
+            status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+            if not status:
+                self.socket.close()
+                return False
+
+            if response[0] == STATUS["OK"]:
+                print("File successfully upload to server, digest verified.")
+                return True
+
+            print(f"The server reported a digest mismatch on attempt {attempt + 1}.")
+
+        print("Upload failed: the file did not arrive intact.")
+        return False
+
+    def get_files(self, patterns):
+
+        # MGET: fetch every file matching patterns over this connection
+        # and save them in the working directory. Returns the number of
+        # files and bytes received.
+        pkt = bytearray(CMD["MGET"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        pkt += len(patterns).to_bytes(ENTRY_COUNT_FIELD_LEN, byteorder='big')
+        for pattern in patterns:
+            pattern_bytes = pattern.encode(MSG_ENCODING)
+            pkt += len(pattern_bytes).to_bytes(PATTERN_SIZE_FIELD_LEN, byteorder='big') + pattern_bytes
+
+        self.socket.sendall(pkt)
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
+
+        if not status:
+            self.socket.close()
+            return (0, 0)
+
+        buffer = bytearray(FILE_CHUNK_SIZE)
+        file_count = 0
+        byte_count = 0
+
+        while True:
+            status, name_size_field = recv_bytes(self.socket, FILENAME_SIZE_FIELD_LEN)
+
+            if not status:
+                break
+
+            if not name_size_field[0]:
+                print(f"Received {file_count} files, {byte_count} bytes in total.")
+                return (file_count, byte_count)
+
+            status, record_header = recv_bytes(self.socket, name_size_field[0] + STATUS_FIELD_LEN)
+
+            if not status:
+                break
+
+            name = record_header[:-STATUS_FIELD_LEN].decode(MSG_ENCODING)
+
+            if record_header[-1] != STATUS["OK"]:
+                print(f"{name}: not available on the server.")
+                continue
+
+            status, file_size_field = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+            if not status:
+                break
+
+            file_size = int.from_bytes(file_size_field, byteorder='big')
+
+            # Only the base name is used, so a record cannot write
+            # outside the working directory.
+            filename = os.path.basename(name)
+            with open(filename, 'wb') as f:
+                status = recv_file(self.socket, f, file_size, buffer)
+
+            if not status:
+                os.remove(filename)
+                break
+
+            file_count += 1
+            byte_count += file_size
+
+        print(f"Download interrupted after {file_count} files.")
+        self.socket.close()
+        return (file_count, byte_count)
+
+    def sync(self, direction, local_dir, remote_dir=""):
+
+        # SYNC GET copies the files under remote_dir, a folder in the
+        # share folder or "" for all of it, that differ from those under
+        # local_dir into local_dir; SYNC PUT copies the other way. See
+        # "Directory sync". Returns (files copied, bytes copied, files
+        # that failed), or None if the trees could not be compared.
+        started = time.perf_counter()
+
+        try:
+            if remote_dir:
+                split_sync_path(remote_dir)
+        except ValueError as e:
+            print(f"Cannot sync: {e}")
+            return None
+
+        remote = self.sync_manifest(remote_dir)
+
+        if remote is None:
+            return None
+
+        try:
+            local = tree_manifest(local_dir, skip={Client.METADATA_CACHE_FILE, Client.DISCOVERY_CACHE_FILE})
+        except FileNotFoundError:
+            if direction == "PUT":
+                print(f"Cannot sync: there is no folder {local_dir}")
+                return None
+            local = {}
+
+        source, destination = (remote, local) if direction == "GET" else (local, remote)
+        copy, compare = sync_plan(source, destination)
+
+        if compare:
+            digests = self.sync_digests(remote_dir, compare)
+
+            if digests is None:
+                return None
+
+            for path, digest in zip(compare, digests):
+                local_path = os.path.join(local_dir, *path.split("/"))
+                try:
+                    same = file_digest(local_path) == digest
+                except OSError:
+                    same = False
+
+                if not same:
+                    copy.append(path)
+                elif direction == "GET":
+                    # Same contents: take the server's mtime, so the
+                    # next SYNC need not read the file again.
+                    try:
+                        os.utime(local_path, ns=(remote[path][1], remote[path][1]))
+                    except OSError:
+                        pass
+
+        if direction == "GET":
+            result = self.sync_get_files(remote_dir, local_dir, copy)
+        else:
+            result = self.sync_put_files(local_dir, remote_dir, copy, local)
+
+        file_count, byte_count, failures = result
+        print(f"SYNC {direction}: {len(source)} files checked, {len(compare)} compared by digest, "
+              f"{file_count} copied ({byte_count} bytes), {failures} failed, "
+              f"in {time.perf_counter() - started:.2f} s")
+        return result
+
+    def sync_manifest(self, remote_dir):
+
+        # SYNCLIST: the server's manifest of remote_dir, empty if there
+        # is no such folder, or None on failure.
+        remote_dir_bytes = remote_dir.encode(MSG_ENCODING)
+
+        self.socket.sendall(CMD["SYNCLIST"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + len(remote_dir_bytes).to_bytes(PATH_SIZE_FIELD_LEN, byteorder='big')
+                            + remote_dir_bytes)
+
+        status, status_field = recv_exactly(self.socket, STATUS_FIELD_LEN,
+                                            deadline=time.monotonic() + Client.SYNC_REPLY_TIMEOUT)
+
+        if not status:
+            self.socket.close()
+            return None
+
+        if status_field[0] == STATUS["NOT_FOUND"]:
+            return {}
+
+        if status_field[0] != STATUS["OK"]:
+            print(f"Cannot sync: the server cannot list {remote_dir!r}.")
+            return None
+
+        status, body_size_field = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+
+        if status:
+            status, body = recv_exactly(self.socket, int.from_bytes(body_size_field, byteorder='big'),
+                                        bytearray(int.from_bytes(body_size_field, byteorder='big')))
+
+        if not status:
+            self.socket.close()
+            return None
 
         try:
+            return parse_manifest(body)
+        except ValueError as e:
+            print(f"Cannot sync: bad manifest from the server, {e}")
+            self.socket.close()
+            return None
 
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.connect((Client.SERVER_HOSTNAME, Server.FILE_SHARING_PORT)) 
-        
-        except Exception as e:
-
-            print(f"Cannot connect to the server: {e}")
-            sys.exit(1)
+    def sync_digests(self, remote_dir, paths):
 
-    def send_service_discovery_request(self):  
+        # SYNCHASH, SYNC_BATCH_FILES paths at a time: the server's
+        # digests of the files, in order, or None on failure.
+        digests = []
 
-        UDP_broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        UDP_broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        UDP_broadcast_socket.bind(("192.168.40.83",30003))
-        UDP_broadcast_socket.settimeout(10)  
-        discovery_message = "SERVICE DISCOVERY"
-        #UDP_broadcast_socket.sendto(discovery_message.encode('utf-8'), ('255.255.255.255', Server.BROADCAST_PORT))
-        print(f"Sent SERVICE DISCOVERY request via UDP broadcast.")
-        
-        try:
+        for start in range(0, len(paths), Client.SYNC_BATCH_FILES):
+            batch = paths[start:start + Client.SYNC_BATCH_FILES]
 
-            while True:
-                data, addr = UDP_broadcast_socket.recvfrom(1024)
-                print(f"Received response from {addr}: {data.decode()}")
-                break  
+            self.socket.sendall(CMD["SYNCHASH"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                + self.sync_path_list(remote_dir, batch))
 
-        except socket.timeout:
-            print("Service discovery timed out. No response received.")
-        
-        finally:
-            UDP_broadcast_socket.close()
+            status, status_field = recv_exactly(self.socket, STATUS_FIELD_LEN,
+                                                deadline=time.monotonic() + Client.SYNC_REPLY_TIMEOUT)
 
-    def get_console_input(self):
-        while True:
-            self.input_text = input("Input: ")
-            self.command_parts = self.input_text.strip().split(' ')
-            if self.input_text != "":
-                break
-    
-    def send_console_input_forever(self):
-        should_exit = False 
+            if status:
+                status, digest_fields = recv_bytes(self.socket, len(batch) * VALIDATOR_DIGEST_LEN)
 
-        while not should_exit:  
+            if not status:
+                self.socket.close()
+                return None
 
-            try:
+            digests.extend(digest_fields[i:i + VALIDATOR_DIGEST_LEN]
+                           for i in range(0, len(digest_fields), VALIDATOR_DIGEST_LEN))
 
-                self.get_console_input()
-                self.connect_to_server() 
+        return digests
 
-                if self.command_parts[0].upper() == "GET" and len(self.command_parts) == 2:
-                    download_filename = self.command_parts[1]
-                    self.get_file(download_filename)
+    def sync_path_list(self, remote_dir, paths):
 
-                elif self.input_text.upper() == "RLIST":
-                    self.remote_list_files()
+        # 4 byte path count | paths, each relative to the share folder
+        pkt = bytearray(len(paths).to_bytes(PATH_COUNT_FIELD_LEN, byteorder='big'))
+        for path in paths:
+            pkt += self.sync_path_field(join_sync_path(remote_dir, path))
+        return pkt
 
-                elif self.input_text.upper() == "LLIST":
-                    self.local_list_files()
+    def sync_path_field(self, path):
+        path_bytes = path.encode(MSG_ENCODING)
+        return len(path_bytes).to_bytes(PATH_SIZE_FIELD_LEN, byteorder='big') + path_bytes
 
-                elif self.command_parts[0].upper() == "PUT" and len(self.command_parts) == 2:
-                    upload_filename = self.command_parts[1]
-                    self.put_files(upload_filename)
+    def sync_get_files(self, remote_dir, local_dir, paths):
 
-                elif self.input_text.upper() == "BYE":
-                    self.bye()  
-                    should_exit = True  
+        # SYNCGET paths in batches from a second thread, which keeps up
+        # to SYNC_PIPELINE_DEPTH batches ahead of the records read here.
+        # Each file goes to a temporary file beside its destination that
+        # is renamed over it once complete. Returns (files copied, bytes
+        # copied, files that failed).
+        batches = [paths[start:start + Client.SYNC_BATCH_FILES]
+                   for start in range(0, len(paths), Client.SYNC_BATCH_FILES)]
+        window = threading.Semaphore(Client.SYNC_PIPELINE_DEPTH)
+        stopped = threading.Event()
 
-                elif self.input_text.upper() == "SCAN":
-                    self.scan()
+        def send_requests():
+            try:
+                for batch in batches:
+                    while not window.acquire(timeout=1):
+                        if stopped.is_set():
+                            return
+                    self.socket.sendall(CMD["SYNCGET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                        + self.sync_path_list(remote_dir, batch))
+            except OSError:
+                pass
+
+        sender = threading.Thread(target=send_requests, daemon=True)
+        sender.start()
+
+        buffer = bytearray(FILE_CHUNK_SIZE)
+        file_count = 0
+        byte_count = 0
+        failures = 0
 
-                elif self.input_text.upper() == "CONNECT":
-                    self.connect()
+        try:
+            for batch in batches:
+                for path in batch:
+                    status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
 
-                else:
-                    print("Invalid input. Please use the format")
+                    if not status:
+                        raise ConnectionError("the connection was lost")
 
-                if not should_exit:  
-                    self.socket.close() 
+                    if status_field[0] != STATUS["OK"]:
+                        print(f"{path}: not available on the server.")
+                        failures += 1
+                        continue
 
-            except (KeyboardInterrupt, EOFError):
-                print()
-                print("Closing server connection ...")
-                if self.socket:
-                    self.socket.close()
-                should_exit = True  
+                    status, fields = recv_bytes(self.socket, FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
 
-            if should_exit:  
-                if self.socket:
-                    self.socket.close()
-                print("Exiting...")
-                sys.exit(1)
+                    if not status:
+                        raise ConnectionError("the connection was lost")
 
-                
-    def connection_send(self):
-        try:
-            self.socket.sendall(self.input_text.encode(Server.MSG_ENCODING))
-        except Exception as msg:
-            print(msg)
-            sys.exit(1)
+                    file_size = int.from_bytes(fields[:FILESIZE_FIELD_LEN], byteorder='big')
+                    mtime_ns = int.from_bytes(fields[FILESIZE_FIELD_LEN:], byteorder='big')
 
+                    if self.sync_recv_file(os.path.join(local_dir, *path.split("/")),
+                                           file_size, mtime_ns, buffer):
+                        file_count += 1
+                        byte_count += file_size
+                    else:
+                        failures += 1
 
-    def connection_receive(self):
-        try:
-            recvd_bytes = self.socket.recv(Client.RECV_BUFFER_SIZE)
+                window.release()
 
-            if len(recvd_bytes) == 0:
-                print("Closing server connection ... ")
-                self.socket.close()
-                sys.exit(1)
+        except ConnectionError as e:
+            print(f"SYNC interrupted: {e}")
+            self.socket.close()
+            failures = len(paths) - file_count
 
-            print("Received: ", recvd_bytes.decode(Server.MSG_ENCODING))
+        finally:
+            stopped.set()
+            sender.join()
 
-        except Exception as msg:
-            print(msg)
-            sys.exit(1)
+        return (file_count, byte_count, failures)
 
+    def sync_recv_file(self, filepath, file_size, mtime_ns, buffer):
 
-    def get_file(self, filename):
+        # Save one SYNCGET record body as filepath. If it cannot be
+        # saved (disk full, no permission, a folder in the way), the
+        # rest of the body is read and discarded and False returned, so
+        # the following records can still be read; ConnectionError if
+        # the connection fails.
+        writer = DrainingWriter(None)
+        temp_path = None
 
-        cmd_field = CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            fd, temp_path = create_temp_file(filepath)
+            writer.f = os.fdopen(fd, 'wb')
+        except OSError as e:
+            writer.error = e
+
+        # Local write errors are kept by writer, so an OSError here is
+        # the connection's.
+        try:
+            received = recv_file(self.socket, writer, file_size, buffer)
+        except OSError:
+            received = False
 
+        if writer.f is not None:
+            try:
+                writer.f.close()
+            except OSError as e:
+                writer.error = writer.error or e
 
-        filename_field_bytes = filename.encode(MSG_ENCODING)
+        if received and writer.error is None:
+            try:
+                os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+                os.replace(temp_path, filepath)
+                return True
+            except OSError as e:
+                writer.error = e
 
-        filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+        if not received:
+            raise ConnectionError("the connection was lost")
+
+        print(f"Cannot save {filepath}: {writer.error}")
+        return False
+
+    def sync_put_files(self, local_dir, remote_dir, paths, manifest):
+
+        # SYNCPUT paths in batches, while a second thread reads the
+        # statuses of the batches already sent, at most
+        # SYNC_PIPELINE_DEPTH behind. Small files are gathered into one
+        # send as in MGET; larger ones go out with sendfile. A file is
+        # sent with its size and mtime at the time it is opened, not
+        # those of the manifest. Returns (files copied, bytes copied,
+        # files that failed).
+        batches = []
+        batch_bytes = 0
+        for path in paths:
+            if (not batches or len(batches[-1]) >= Client.SYNC_BATCH_FILES
+                    or batch_bytes + manifest[path][0] > Client.SYNC_BATCH_BYTES and batches[-1]):
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append(path)
+            batch_bytes += manifest[path][0]
+
+        window = threading.Semaphore(Client.SYNC_PIPELINE_DEPTH)
+        sent = queue.Queue()
+        results = []
+
+        def read_statuses():
+            while (batch := sent.get()) is not None:
+                status, status_fields = recv_exactly(self.socket, len(batch),
+                                                     deadline=time.monotonic() + Client.SYNC_REPLY_TIMEOUT)
+                if not status:
+                    results.append(None)
+                    return
+                results.append([(path, file_size, status_field)
+                                for (path, file_size), status_field in zip(batch, status_fields)])
+                window.release()
+
+        reader = threading.Thread(target=read_statuses, daemon=True)
+        reader.start()
 
+        try:
+            for batch in batches:
+                files = []
+                for path in batch:
+                    try:
+                        f = open(os.path.join(local_dir, *path.split("/")), 'rb')
+                    except OSError as e:
+                        print(f"Cannot read {path}: {e}")
+                        continue
+                    stat = os.fstat(f.fileno())
+                    files.append((path, f, stat.st_size, stat.st_mtime_ns))
+
+                while not window.acquire(timeout=1):
+                    if not reader.is_alive():
+                        raise ConnectionError("the connection was lost")
+
+                try:
+                    self.sync_send_batch(remote_dir, files)
+                finally:
+                    for _, f, _, _ in files:
+                        f.close()
+
+                sent.put([(path, file_size) for path, _, file_size, _ in files])
+
+        except OSError as e:
+            print(f"SYNC interrupted: {e}")
+            self.socket.close()
 
-        print("\nCreating packet")
-        print("Command field: ", cmd_field.hex())
-        print("Filename size (as byte length): ", filename_size_field.hex())
-        print("Filename field (in byte form): ", filename_field_bytes.hex())
-        
+        sent.put(None)
+        reader.join()
 
-        pkt = cmd_field + filename_size_field + filename_field_bytes
+        file_count = 0
+        byte_count = 0
 
+        for batch in results:
+            if batch is None:
+                break
+            for path, file_size, status_field in batch:
+                if status_field == STATUS["OK"]:
+                    file_count += 1
+                    byte_count += file_size
+                else:
+                    print(f"{path}: the server could not save it.")
+
+        return (file_count, byte_count, len(paths) - file_count)
+
+    def sync_send_batch(self, remote_dir, files):
+
+        # One SYNCPUT request for files, [(path, file, size, mtime)].
+        pending = bytearray(CMD["SYNCPUT"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        pending += len(files).to_bytes(PATH_COUNT_FIELD_LEN, byteorder='big')
+
+        for path, f, file_size, mtime_ns in files:
+            pending += self.sync_path_field(join_sync_path(remote_dir, path))
+            pending += file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+            pending += mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+
+            if file_size <= MGET_PREFETCH_SIZE:
+                body = f.read(file_size)
+                if len(body) != file_size:
+                    raise OSError(f"{path} changed while it was being sent")
+                pending += body
+                if len(pending) >= MGET_SEND_BUFFER_SIZE:
+                    send_buffer(self.socket, pending)
+                    pending = bytearray()
+            else:
+                send_buffer(self.socket, pending)
+                pending = bytearray()
+                if self.socket.sendfile(f, 0, file_size) != file_size:
+                    raise OSError(f"{path} changed while it was being sent")
+
+        send_buffer(self.socket, pending)
+
+    def put_file_delta(self, filename):
+
+        # Delta upload: fetch the signatures of the server's copy and
+        # send only the parts of filename that are not in it. Falls back
+        # to a plain PUT if the server has no copy or the delta does not
+        # rebuild the file. Returns the number of bytes sent.
+        if not os.path.exists(filename):
+            print("File does not exist.")
+            return None
 
-        print("Sending packet to server...")
-        self.socket.sendall(pkt)
+        file_size = os.path.getsize(filename)
+        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
 
+        self.socket.sendall(CMD["RPUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+                            + filename_field_bytes
+                            + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
 
-        print("\nWaiting for server response...\n")
-        status, file_size_bytes = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
 
         if not status:
-            # print("Closing connection ...")
             self.socket.close()
-            return
+            return None
 
-        print("File size field: ", file_size_bytes.hex())
-        
-        if len(file_size_bytes) == 0:
+        if status_field[0] == STATUS["NOT_FOUND"]:
+            print("The server has no copy to patch, sending the whole file.")
+            self.put_files(filename)
+            return file_size
+
+        status, header = recv_bytes(self.socket, BLOCK_SIZE_FIELD_LEN + CHUNK_COUNT_FIELD_LEN)
+
+        if not status:
             self.socket.close()
-            return
+            return None
 
-        file_size = int.from_bytes(file_size_bytes, byteorder='big') 
-        print("File size (as byte length): ", file_size)
-                                
+        block_size = int.from_bytes(header[:BLOCK_SIZE_FIELD_LEN], byteorder='big')
+        block_count = int.from_bytes(header[BLOCK_SIZE_FIELD_LEN:], byteorder='big')
 
-        status, recvd_bytes_total = recv_bytes(self.socket, file_size)
+        status, signatures = recv_exactly(self.socket, block_count * (WEAK_CHECKSUM_LEN + STRONG_HASH_LEN),
+                                          bytearray(block_count * (WEAK_CHECKSUM_LEN + STRONG_HASH_LEN)))
 
         if not status:
-            # print("Closing connection ...")            
             self.socket.close()
-            return
+            return None
 
+        signature_index = parse_signatures(signatures)
+        digest = hashlib.sha256()
+        pending = bytearray()
+        sent = 0
 
-        try:
-            print(f"Received {len(recvd_bytes_total)} bytes. Creating file: {filename}")
+        with open(filename, 'rb') as f:
+            # mmap gives the window random access to the whole file
+            # without reading it into memory. It cannot map an empty file.
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b''
 
-            with open(filename, 'wb') as f:  
-                f.write(recvd_bytes_total)  
+            try:
+                for instruction in compute_delta(data, block_size, signature_index):
+                    if instruction[0] == "COPY":
+                        _, first, count = instruction
+                        pending += DELTA_OP["COPY"].to_bytes(DELTA_OP_FIELD_LEN, byteorder='big')
+                        pending += first.to_bytes(BLOCK_INDEX_FIELD_LEN, byteorder='big')
+                        pending += count.to_bytes(BLOCK_INDEX_FIELD_LEN, byteorder='big')
+                    else:
+                        literal = instruction[1]
+                        pending += DELTA_OP["DATA"].to_bytes(DELTA_OP_FIELD_LEN, byteorder='big')
+                        pending += len(literal).to_bytes(LITERAL_SIZE_FIELD_LEN, byteorder='big')
+                        pending += literal
+
+                    if len(pending) >= DELTA_LITERAL_SIZE:
+                        self.socket.sendall(pending)
+                        sent += len(pending)
+                        pending = bytearray()
+
+                for start in range(0, file_size, FILE_CHUNK_SIZE):
+                    digest.update(data[start:start + FILE_CHUNK_SIZE])
 
-            print("File successfully downloaded and saved.")
+            finally:
+                if file_size:
+                    data.close()
 
-        except KeyboardInterrupt:
-            print("Download interrupted by user.")
-            exit(1)
+        pending += DELTA_OP["END"].to_bytes(DELTA_OP_FIELD_LEN, byteorder='big') + digest.digest()
+        self.socket.sendall(pending)
+        sent += len(pending)
 
+        status, response = recv_bytes(self.socket, STATUS_FIELD_LEN)
 
-    def remote_list_files(self):
+        if not status:
+            self.socket.close()
+            return None
 
-        cmd_field = CMD["LIST"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        if response[0] != STATUS["OK"]:
+            print("The delta did not rebuild the file, sending the whole file.")
+            self.put_files(filename)
+            return sent + file_size
 
+        print(f"File successfully upload to server: sent {sent} bytes for a {file_size} byte file.")
+        return sent
 
-        print("Creating 'list' packet")
-        print("Command field: ", cmd_field.hex())
-        self.socket.sendall(cmd_field)
-        print("Waiting for server response...")
+    def set_limits(self, global_rate, client_rate):
 
-        status, list_size_bytes = recv_bytes(self.socket, FILESIZE_FIELD_LEN)
+        # LIMIT: set the server's bandwidth limits in bytes per second.
+        self.socket.sendall(CMD["LIMIT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + global_rate.to_bytes(RATE_FIELD_LEN, byteorder='big')
+                            + client_rate.to_bytes(RATE_FIELD_LEN, byteorder='big'))
+
+        status, status_field = recv_bytes(self.socket, STATUS_FIELD_LEN)
 
         if not status:
-            # print("Closing connection ...")
             self.socket.close()
-            return
+            return False
 
-        if len(list_size_bytes) == 0:
-            print("No data received, closing connection...")
-            self.socket.close()
-            return
+        if status_field[0] != STATUS["OK"]:
+            print("The server refused to change its limits.")
+            return False
 
-        list_size = int.from_bytes(list_size_bytes, byteorder='big')
-        print("Received file list size: ", list_size)
-        print("\n")
+        print(f"Server limits set to {global_rate} B/s overall and {client_rate} B/s per client.")
+        return True
 
-        status, file_list_bytes = recv_bytes(self.socket, list_size)
+    def open_mux(self):
 
-        if not status:
-            # print("Closing connection ...")
-            self.socket.close()
-            return
+        # A second connection to the server, switched to multiplexed
+        # framing with MUX. Returns a MuxConnection whose reader runs on
+        # a background thread; each command then gets a StreamClient.
+        sock = self.open_connection()
+        sock.sendall(CMD["MUX"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
 
-        try:
+        status, status_field = recv_bytes(sock, STATUS_FIELD_LEN)
 
-            file_list_str = file_list_bytes.decode(MSG_ENCODING)
-            print(f"Here is the file list from the server folder {Server.REMOTE_FOLDER_LIST}:")
-            print(file_list_str)
+        if not status or status_field[0] != STATUS["OK"]:
+            sock.close()
+            raise ConnectionError("the server refused a multiplexed session")
 
-        except Exception as e:
-            print("Error:", e)
+        mux = MuxConnection(sock)
+        threading.Thread(target=mux.run, args=(Server.SESSION_IDLE_TIMEOUT,), daemon=True).start()
+        return mux
 
+    def run_multiplexed(self, commands):
 
-    def put_files(self, filename):
+        # Run GET, PUT and RLIST commands at the same time, each on its
+        # own stream of one multiplexed connection, which is kept for
+        # later calls.
+        runners = {"GET": (2, lambda client, args: client.get_file(args[0])),
+                   "PUT": (2, lambda client, args: client.put_files(args[0])),
+                   "RLIST": (1, lambda client, args: client.remote_list_files())}
 
-        if not os.path.exists(filename):
-            print("File does not exist.")
-            return
+        for command in commands:
+            if command[0].upper() not in runners or len(command) != runners[command[0].upper()][0]:
+                print("Usage: MUX <command> [; <command> ...] with GET <file>, PUT <file> or RLIST.")
+                return
 
-        with open(filename, 'r', encoding='utf-8') as f:
-            file_content = f.read()
+        if getattr(self, 'mux', None) is None or self.mux.closed:
+            try:
+                self.mux = self.open_mux()
+            except OSError as e:
+                print(f"Cannot open a multiplexed session: {e}")
+                return
 
-        cmd_field = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
-        filename_field_bytes = os.path.basename(filename).encode(MSG_ENCODING)
+        metadata = self.metadata()
 
-        filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
-        file_content_bytes = file_content.encode(MSG_ENCODING)
-        file_size_field = len(file_content_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+        def run(command):
+            client = StreamClient(self.mux, metadata)
+            try:
+                runners[command[0].upper()][1](client, command[1:])
+            except OSError as e:
+                print(f"{' '.join(command)} failed: {e}")
+            finally:
+                client.socket.close()
 
+        threads = [threading.Thread(target=run, args=(command,)) for command in commands]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        print("Creating 'put' packet")
-        print("Command field: ", cmd_field.hex())
-        print("Filename size (as byte length): ", filename_size_field.hex())
-        print("Filename field (in byte form): ", filename_field_bytes.hex())
-        print("File size (as byte length): ", file_size_field.hex())
+    def server_stats(self):
 
-        pkt = cmd_field + filename_size_field + filename_field_bytes + file_size_field + file_content_bytes
+        self.socket.sendall(CMD["STATS"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
 
-        print("Sending 'put' packet to server...")
-        self.socket.sendall(pkt)
+        status, header = recv_bytes(self.socket, STATUS_FIELD_LEN + STATS_SIZE_FIELD_LEN)
 
-        print("Waiting for server response...")
-        print("File successfully upload to server")
+        if not status:
+            self.socket.close()
+            return None
 
-        status, response = recv_bytes(self.socket, Client.RECV_BUFFER_SIZE)
+        stats_size = int.from_bytes(header[STATUS_FIELD_LEN:], byteorder='big')
+        status, stats_bytes = recv_bytes(self.socket, stats_size)
 
         if not status:
-            # print("Closing connection ...")
             self.socket.close()
-            return
+            return None
 
-        print("Response from server: ", response.decode(MSG_ENCODING))
+        stats = json.loads(stats_bytes.decode(MSG_ENCODING))
+        print(json.dumps(stats, indent=2))
+        return stats
 
     def local_list_files(self):
 
@@ -668,23 +6388,256 @@ class Client:
             print("An error occurred in connection:", e)
 
 
-    def message_receive(self):
+    def discover_servers(self, timeout=None):
+
+        # Broadcast SERVICE DISCOVERY on a UDP socket of its own and
+        # collect every reply that arrives within timeout seconds
+        # (SCAN_TIMEOUT by default). Returns [((host, port), service
+        # name, rtt)], nearest first, leaving out servers that do not
+        # accept a connection. The broadcast itself is no measure of
+        # distance: a reply may have waited on a busy server.
+        timeout = Client.SCAN_TIMEOUT if timeout is None else timeout
+        servers = {}
+
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
         try:
-            # recvfrom returns bytes received and the identity of the
-            # sender.
-            recvd_bytes, address = self.socket.recvfrom(1024)
-            # print("Received Message Bytes: ", recvd_bytes)
-            print(f"{recvd_bytes.decode(Server.MSG_ENCODING)} found at {address}" )
-        except socket.timeout:
-            print("No service found")
-        except Exception as msg:
-            print(msg)
-            sys.exit(1)
+            start = time.monotonic()
+            udp_socket.sendto(Client.MESSAGE_ENCODED, Client.ADDRESS_PORT)
+
+            while (remaining := start + timeout - time.monotonic()) > 0:
+                udp_socket.settimeout(remaining)
+                try:
+                    data, (host, _) = udp_socket.recvfrom(Client.RECV_BUFFER_SIZE)
+                except socket.timeout:
+                    break
+
+                reply = parse_discovery_response(data, Server.FILE_SHARING_PORT)
+                if reply is not None:
+                    servers.setdefault((host, reply[1]), reply[0])
+
+        except OSError as e:
+            print(f"Service discovery failed: {e}")
+
+        finally:
+            udp_socket.close()
+
+        if not servers:
+            return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            rtts = list(executor.map(self.probe_rtt, servers))
+
+        return sorted(((address, name, rtt) for (address, name), rtt in zip(servers.items(), rtts)
+                       if rtt is not None), key=lambda server: server[2])
+
+    def probe_rtt(self, address):
+
+        # The quickest of DISCOVERY_PROBES TCP connection setups, each a
+        # round trip to the server, or None if it cannot be reached.
+        rtt = None
+        for _ in range(Client.DISCOVERY_PROBES):
+            start = time.perf_counter()
+            try:
+                socket.create_connection(address, timeout=SOCKET_TIMEOUT).close()
+            except OSError:
+                return None
+            elapsed = time.perf_counter() - start
+            rtt = elapsed if rtt is None else min(rtt, elapsed)
+        return rtt
 
     def scan(self):
+
         print("Broadcasting to {} ...".format(Client.ADDRESS_PORT))
-        self.socket.sendto(Client.MESSAGE_ENCODED, Client.ADDRESS_PORT)
-        self.message_receive()
+        self.send_service_discovery_request()
+
+        if not self.servers:
+            print("No service found")
+
+        for (host, port), name, rtt in self.servers:
+            print(f"{name} found at {host}:{port} ({rtt * 1000:.1f} ms)")
+
+    def request_chunks(self, sock, filename, chunk_size):
+
+        # Send CHUNKS and return the file size and the chunk digests, or
+        # None if the server does not have the file or failed.
+        filename_field_bytes = filename.encode(MSG_ENCODING)
+
+        sock.sendall(CMD["CHUNKS"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                     + len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+                     + filename_field_bytes
+                     + chunk_size.to_bytes(CHUNK_SIZE_FIELD_LEN, byteorder='big'))
+
+        # The server reads the whole file before it answers.
+        status, status_field = recv_exactly(sock, STATUS_FIELD_LEN,
+                                            deadline=time.monotonic() + Client.SWARM_DIGEST_TIMEOUT)
+
+        if not status or status_field[0] != STATUS["OK"]:
+            return None
+
+        status, size_fields = recv_bytes(sock, FILESIZE_FIELD_LEN + CHUNK_COUNT_FIELD_LEN)
+
+        if not status:
+            return None
+
+        file_size = int.from_bytes(size_fields[:FILESIZE_FIELD_LEN], byteorder='big')
+        chunk_count = int.from_bytes(size_fields[FILESIZE_FIELD_LEN:], byteorder='big')
+
+        status, digest_fields = recv_bytes(sock, chunk_count * CHUNK_DIGEST_LEN)
+
+        if not status:
+            return None
+
+        return (file_size, [digest_fields[i:i + CHUNK_DIGEST_LEN]
+                            for i in range(0, len(digest_fields), CHUNK_DIGEST_LEN)])
+
+    def open_swarm_peer(self, address, filename, chunk_size):
+
+        # Connect to one server and ask it for the file's chunk digests.
+        # Returns a SwarmPeer, or None if the server cannot take part.
+        try:
+            sock = self.open_connection(address)
+        except OSError as e:
+            print(f"Cannot connect to {address[0]}:{address[1]}: {e}")
+            return None
+
+        try:
+            chunks = self.request_chunks(sock, filename, chunk_size)
+        except OSError:
+            chunks = None
+
+        if chunks is None:
+            sock.close()
+            return None
+
+        return SwarmPeer(address, sock, *chunks)
+
+    def get_file_swarm(self, filename, servers=None, chunk_size=None):
+
+        # SWARM: download filename from every server in servers, a list
+        # of (host, port), which defaults to known_servers(). See
+        # SwarmSchedule. Returns True if the file was downloaded.
+        chunk_size = chunk_size or Client.SWARM_CHUNK_SIZE
+
+        if servers is None:
+            servers = [address for address, _, _ in self.known_servers()]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(servers))) as executor:
+            peers = [peer for peer in executor.map(lambda address: self.open_swarm_peer(address, filename, chunk_size),
+                                                   servers)
+                     if peer is not None]
+
+        if not peers:
+            print("No server has the requested file.")
+            return False
+
+        # Fetch the version most servers agree on; on a tie, that of the
+        # server listed first.
+        versions = collections.Counter((peer.file_size, tuple(peer.digests)) for peer in peers)
+        (file_size, digests), _ = versions.most_common(1)[0]
+
+        partial_filename = filename + Client.PARTIAL_SUFFIX
+        fd = os.open(partial_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        completed = False
+        start = time.perf_counter()
+
+        try:
+            os.ftruncate(fd, file_size)
+            schedule = SwarmSchedule(file_size, chunk_size, list(digests), fd, len(peers))
+
+            print(f"Downloading {file_size} bytes in {len(digests)} chunks from {len(peers)} servers")
+
+            workers = [threading.Thread(target=self.fetch_swarm_chunks, args=(filename, schedule, peer))
+                       for peer in peers]
+            for worker in workers:
+                worker.start()
+
+            completed = schedule.wait()
+
+            # Abandon endgame duplicates still in flight on slower peers.
+            for peer in peers:
+                try:
+                    peer.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for worker in workers:
+                worker.join()
+
+        finally:
+            os.close(fd)
+            for peer in peers:
+                peer.sock.close()
+            if not completed:
+                os.remove(partial_filename)
+
+        elapsed = time.perf_counter() - start
+
+        for peer in peers:
+            rate = peer.bytes / peer.seconds / 1e6 if peer.seconds else 0.0
+            print(f"  {peer.address[0]}:{peer.address[1]}: {peer.chunks} chunks, "
+                  f"{peer.bytes} bytes at {rate:.1f} MB/s" + (f", dropped: {peer.error}" if peer.error else ""))
+
+        if not completed:
+            print("Swarm download failed: no server left could supply every chunk.")
+            return False
+
+        os.replace(partial_filename, filename)
+        if Client.CONDITIONAL_GET:
+            self.metadata().record(filename, file_size, 0, file_digest(filename))
+        print(f"Received {file_size} bytes in {elapsed:.2f} s. Creating file: {filename}")
+        print("File successfully downloaded and saved.")
+        return True
+
+    def fetch_swarm_chunks(self, filename, schedule, peer):
+
+        # Worker for get_file_swarm: fetch chunks over peer's connection
+        # until the schedule has none left for it, or the peer fails.
+        buffer = bytearray(schedule.chunk_size)
+
+        try:
+            while (index := schedule.next_chunk(peer)) is not None:
+                offset, length = schedule.chunk_range(index)
+                writer = ChunkBuffer(buffer)
+                chunk_start = time.perf_counter()
+
+                status, _, _, _ = self.get_file_range(filename, offset, length, writer, peer.sock)
+
+                if status != STATUS["OK"] or writer.count != length:
+                    # Once the download is complete, this is a duplicate
+                    # cut off by get_file_swarm.
+                    if not schedule.complete():
+                        peer.error = "transfer failed"
+                    schedule.chunk_failed(index)
+                    return
+
+                if hashlib.sha256(writer.view[:length]).digest() != schedule.digests[index]:
+                    peer.error = f"chunk {index} did not match its digest"
+                    schedule.chunk_failed(index)
+                    return
+
+                peer.seconds += time.perf_counter() - chunk_start
+                peer.chunks += 1
+                peer.bytes += length
+
+                try:
+                    schedule.chunk_done(index, writer.view[:length])
+                except OSError as e:
+                    peer.error = f"cannot write chunk {index}: {e}"
+                    schedule.chunk_failed(index)
+                    return
+
+        finally:
+            schedule.peer_left()
+
+class StreamClient(Client):
+
+    # A Client whose socket is a new stream of a multiplexed session, for
+    # one command. It shares the metadata cache of the Client that
+    # opened the session.
+    def __init__(self, mux, metadata_cache=None):
+        self.socket = mux.open_stream()
+        self.metadata_cache = metadata_cache
 
 ########################################################################
 # Process command line arguments if run directly.
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+########################################################################
+# asyncio version of the Lab3 file sharing service.
+#
+# Speaks the same LIST/GET/PUT/BYE protocol as Server and Client in
+# lab3.py, plus the ranged and conditional GETs that Client uses for
+# resumable and cached downloads, and answers SERVICE DISCOVERY on the broadcast port. Every
+# session is a coroutine instead of a thread, so one process can hold
+# tens of thousands of idle connections. Configuration is shared with
+# lab3.Server (REMOTE_FOLDER_LIST, FILE_SHARING_PORT, ...).
+#
+#   python lab3_asyncio.py -r server
+#   python lab3_asyncio.py -r client
+########################################################################
+
+import asyncio
+import argparse
+import socket
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from lab3 import Server, Client
+from lab3 import CMD, STATUS, CMD_FIELD_LEN, FILENAME_SIZE_FIELD_LEN, FILESIZE_FIELD_LEN, STATUS_FIELD_LEN
+from lab3 import OFFSET_FIELD_LEN, LENGTH_FIELD_LEN, MTIME_FIELD_LEN, VALIDATOR_DIGEST_LEN
+from lab3 import DigestCache, check_validator, check_range, discovery_response
+from lab3 import DurabilityScheduler, create_temp_file, is_temp_file, is_share_name, sweep_temp_files
+from lab3 import MSG_ENCODING, SOCKET_TIMEOUT, FILE_CHUNK_SIZE
+
+########################################################################
+
+def raise_open_file_limit():
+
+    # Every session holds a file descriptor, and the default soft limit
+    # is often 1024. Raise it as far as the hard limit allows.
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def read_exactly(reader, n, timeout=SOCKET_TIMEOUT):
+
+    # readexactly with the same per-read timeout as the thread server.
+    # Raises asyncio.IncompleteReadError, TimeoutError or
+    # ConnectionError if the bytes do not arrive. asyncio.timeout
+    # (Python 3.11) avoids the extra task wait_for creates per read.
+    if hasattr(asyncio, 'timeout'):
+        async with asyncio.timeout(timeout):
+            return await reader.readexactly(n)
+    return await asyncio.wait_for(reader.readexactly(n), timeout)
+
+async def read_filename(reader):
+    filename_size = int.from_bytes(await read_exactly(reader, FILENAME_SIZE_FIELD_LEN), byteorder='big')
+    if not filename_size:
+        raise ValueError("empty filename")
+    return (await read_exactly(reader, filename_size)).decode(MSG_ENCODING)
+
+def filename_field(filename):
+    filename_bytes = filename.encode(MSG_ENCODING)
+    return len(filename_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big') + filename_bytes
+
+# What a failed read looks like on a session.
+READ_ERRORS = (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError)
+
+########################################################################
+# Service discovery
+########################################################################
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, response):
+        self.response = response
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.decode(MSG_ENCODING, errors='replace') == "SERVICE DISCOVERY":
+            self.transport.sendto(self.response, addr)
+
+########################################################################
+# Server
+########################################################################
+
+class AsyncServer:
+
+    def __init__(self):
+        self.sessions = 0
+
+        removed = sweep_temp_files(Server.REMOTE_FOLDER_LIST)
+        if removed:
+            print(f"Removed {removed} temporary files left by interrupted uploads.")
+
+        self.digest_cache = DigestCache()
+        self.durability = DurabilityScheduler(Server.DURABILITY, Server.DURABILITY_BATCH_MS / 1000)
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+
+        raise_open_file_limit()
+        loop = asyncio.get_running_loop()
+
+        if Server.BROADCAST_PORT:
+            await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(discovery_response(Server.broadcast_msg, Server.FILE_SHARING_PORT)),
+                local_addr=('0.0.0.0', Server.BROADCAST_PORT))
+            print(f"Listening for service discovery messages on SDP port {Server.BROADCAST_PORT}.")
+
+        server = await asyncio.start_server(self.handle_client, '', Server.FILE_SHARING_PORT,
+                                            reuse_address=True, backlog=Server.LISTEN_BACKLOG)
+        print(f"Listening for file sharing connections on port {Server.FILE_SHARING_PORT}.")
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+
+        # One coroutine per session, with the same rules as
+        # Server.handle_tcp_client: it ends on BYE, EOF, a failed
+        # command or SESSION_IDLE_TIMEOUT seconds without a command.
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sessions += 1
+
+        # The admission status, always OK: there is no queue to fill.
+        writer.write(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+
+        try:
+            while True:
+                try:
+                    cmd_field = await read_exactly(reader, CMD_FIELD_LEN, Server.SESSION_IDLE_TIMEOUT)
+                except READ_ERRORS:
+                    break
+
+                try:
+                    if not await self.handle_command(reader, writer, cmd_field[0]):
+                        break
+                except READ_ERRORS + (OSError,):
+                    break
+
+        finally:
+            self.sessions -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def handle_command(self, reader, writer, cmd):
+
+        # Returns True if the connection can carry another command.
+        if cmd == CMD["LIST"]:
+            return await self.handle_list(writer)
+
+        elif cmd == CMD["GET"]:
+            return await self.handle_get(reader, writer)
+
+        elif cmd == CMD["PUT"]:
+            return await self.handle_put(reader, writer)
+
+        elif cmd == CMD["GETRANGE"]:
+            return await self.handle_get_range(reader, writer)
+
+        elif cmd == CMD["CGET"]:
+            return await self.handle_conditional_get(reader, writer)
+
+        elif cmd == CMD["BYE"]:
+            writer.write("Connection closed".encode(MSG_ENCODING))
+            await writer.drain()
+            return False
+
+        else:
+            print("Unknown command")
+            return False
+
+    async def handle_list(self, writer):
+        names = [name for name in os.listdir(Server.REMOTE_FOLDER_LIST) if not is_temp_file(name)]
+        file_list_bytes = '\n'.join(names).encode(MSG_ENCODING)
+        writer.write(len(file_list_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big') + file_list_bytes)
+        await writer.drain()
+        return True
+
+    def open_share_file(self, filename):
+
+        # As Server.open_share_file_stat, only plain names in the share
+        # folder are served, and not the temporary files of uploads in
+        # progress.
+        if is_temp_file(filename) or not is_share_name(filename):
+            raise FileNotFoundError(filename)
+        return open(os.path.join(Server.REMOTE_FOLDER_LIST, filename), 'rb')
+
+    async def handle_get(self, reader, writer):
+
+        filename = await read_filename(reader)
+
+        # As with the thread server, a missing file is reported by
+        # closing the connection.
+        try:
+            f = self.open_share_file(filename)
+        except FileNotFoundError:
+            print(Server.FILE_NOT_FOUND_MSG)
+            return False
+
+        with f:
+            file_size = os.fstat(f.fileno()).st_size
+            writer.write(file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+            await self.send_body(writer, f, 0, file_size)
+
+        return True
+
+    async def handle_get_range(self, reader, writer):
+
+        # Same request and response as Server.handle_get_range.
+        filename = await read_filename(reader)
+        range_fields = await read_exactly(reader, OFFSET_FIELD_LEN + LENGTH_FIELD_LEN + FILESIZE_FIELD_LEN + MTIME_FIELD_LEN)
+        offset = int.from_bytes(range_fields[:OFFSET_FIELD_LEN], byteorder='big')
+        length = int.from_bytes(range_fields[OFFSET_FIELD_LEN:OFFSET_FIELD_LEN + LENGTH_FIELD_LEN], byteorder='big')
+        validator = range_fields[OFFSET_FIELD_LEN + LENGTH_FIELD_LEN:]
+
+        try:
+            f = self.open_share_file(filename)
+        except FileNotFoundError:
+            writer.write(STATUS["NOT_FOUND"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+            await writer.drain()
+            return True
+
+        with f:
+            stat = os.fstat(f.fileno())
+            file_size = stat.st_size
+            response = check_range(validator, offset, file_size, stat.st_mtime_ns)
+
+            if response == "BAD_RANGE":
+                writer.write(STATUS["BAD_RANGE"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+                await writer.drain()
+                return True
+
+            range_length = 0
+            if response == "OK":
+                range_length = file_size - offset
+                if length:
+                    range_length = min(length, range_length)
+
+            writer.write(STATUS[response].to_bytes(STATUS_FIELD_LEN, byteorder='big')
+                         + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+                         + stat.st_mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+                         + range_length.to_bytes(LENGTH_FIELD_LEN, byteorder='big'))
+
+            await self.send_body(writer, f, offset, range_length)
+
+        return True
+
+    async def handle_conditional_get(self, reader, writer):
+
+        # Same request and response as Server.handle_conditional_get.
+        # Hashing the file, when size and mtime do not settle it, is
+        # done in an executor.
+        filename = await read_filename(reader)
+        validator = await read_exactly(reader, FILESIZE_FIELD_LEN + MTIME_FIELD_LEN + VALIDATOR_DIGEST_LEN)
+
+        try:
+            f = self.open_share_file(filename)
+        except FileNotFoundError:
+            writer.write(STATUS["NOT_FOUND"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+            await writer.drain()
+            return True
+
+        with f:
+            stat = os.fstat(f.fileno())
+            matched = check_validator(validator, stat.st_size, stat.st_mtime_ns)
+            if matched is None:
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    None, self.digest_cache.digest, filename, f, stat.st_size, stat.st_mtime_ns)
+                matched = digest == validator[FILESIZE_FIELD_LEN + MTIME_FIELD_LEN:]
+
+            mtime_field = stat.st_mtime_ns.to_bytes(MTIME_FIELD_LEN, byteorder='big')
+
+            if matched:
+                writer.write(STATUS["NOT_MODIFIED"].to_bytes(STATUS_FIELD_LEN, byteorder='big') + mtime_field)
+                await writer.drain()
+                return True
+
+            writer.write(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big') + mtime_field
+                         + stat.st_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+            await self.send_body(writer, f, 0, stat.st_size)
+
+        return True
+
+    async def send_body(self, writer, f, offset, count):
+
+        # loop.sendfile flushes what is already buffered and then uses
+        # os.sendfile on the transport's socket. Its setup costs more
+        # than a plain write for bodies of up to a chunk.
+        if count > FILE_CHUNK_SIZE:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+            return
+
+        f.seek(offset)
+        writer.write(f.read(count))
+        await writer.drain()
+
+    async def handle_put(self, reader, writer):
+
+        filename = await read_filename(reader)
+        file_size = int.from_bytes(await read_exactly(reader, FILESIZE_FIELD_LEN), byteorder='big')
+        filepath = os.path.join(Server.REMOTE_FOLDER_LIST, filename)
+
+        # As in Server.recv_file, the upload goes to a temporary file
+        # that replaces filepath once it is complete and committed.
+        # Writes of FILE_CHUNK_SIZE go to the page cache, so they are
+        # done on the event loop; the commit may wait for the disk, so it
+        # runs in an executor.
+        temp_path = None
+        try:
+            fd, temp_path = create_temp_file(filepath)
+            with os.fdopen(fd, 'wb') as f:
+                remaining = file_size
+                while remaining:
+                    chunk = await read_exactly(reader, min(FILE_CHUNK_SIZE, remaining))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+                await asyncio.get_running_loop().run_in_executor(None, self.durability.commit,
+                                                                 f, temp_path, filepath)
+
+        except READ_ERRORS + (OSError,):
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            print("Failed to retrieve the file data to be uploaded, closing connection ...")
+            return False
+
+        writer.write(STATUS["OK"].to_bytes(STATUS_FIELD_LEN, byteorder='big'))
+        await writer.drain()
+        return True
+
+########################################################################
+# Client
+########################################################################
+
+class AsyncClient:
+
+    # One session with the server. The methods raise the errors in
+    # READ_ERRORS, or OSError, if the session fails.
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host=None, port=None):
+        self.reader, self.writer = await asyncio.open_connection(host or Client.SERVER_HOSTNAME,
+                                                                 port or Server.FILE_SHARING_PORT)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Every session starts with an admission status, BUSY from a
+        # thread server whose worker pool is full.
+        if (await read_exactly(self.reader, STATUS_FIELD_LEN))[0] != STATUS["OK"]:
+            raise ConnectionError("the server is busy, try again later")
+
+    async def list_files(self):
+        self.writer.write(CMD["LIST"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        list_size = int.from_bytes(await read_exactly(self.reader, FILESIZE_FIELD_LEN), byteorder='big')
+        file_list_bytes = await read_exactly(self.reader, list_size)
+        return file_list_bytes.decode(MSG_ENCODING).split('\n') if list_size else []
+
+    async def get_file(self, filename, filepath=None):
+
+        # Download filename to filepath (default: the same name in the
+        # working directory). Returns the file size.
+        self.writer.write(CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big') + filename_field(filename))
+        file_size = int.from_bytes(await read_exactly(self.reader, FILESIZE_FIELD_LEN), byteorder='big')
+
+        with open(filepath or filename, 'wb') as f:
+            remaining = file_size
+            while remaining:
+                chunk = await read_exactly(self.reader, min(FILE_CHUNK_SIZE, remaining))
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        return file_size
+
+    async def put_file(self, filename):
+
+        # Upload filename. Returns True if the server stored it.
+        file_size = os.path.getsize(filename)
+        self.writer.write(CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                          + filename_field(os.path.basename(filename))
+                          + file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+
+        with open(filename, 'rb') as f:
+            if file_size:
+                await asyncio.get_running_loop().sendfile(self.writer.transport, f, 0, file_size)
+
+        return (await read_exactly(self.reader, STATUS_FIELD_LEN))[0] == STATUS["OK"]
+
+    async def bye(self):
+        self.writer.write(CMD["BYE"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        await self.close()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def console(self):
+
+        # Same commands as Client for LIST/GET/PUT/BYE. input() runs in
+        # an executor so the event loop keeps running.
+        loop = asyncio.get_running_loop()
+        await self.connect()
+
+        while True:
+            try:
+                input_text = (await loop.run_in_executor(None, input, "Input: ")).strip()
+            except EOFError:
+                input_text = "BYE"
+
+            command_parts = input_text.split(' ')
+
+            try:
+                if input_text.upper() == "RLIST":
+                    print('\n'.join(await self.list_files()))
+
+                elif command_parts[0].upper() == "GET" and len(command_parts) == 2:
+                    try:
+                        file_size = await self.get_file(command_parts[1])
+                        print(f"Received {file_size} bytes. Creating file: {command_parts[1]}")
+                    except asyncio.IncompleteReadError as e:
+                        # A plain GET reports a missing file by closing
+                        # the connection before the size field.
+                        if e.partial:
+                            raise
+                        print("Requested file is not available on the server.")
+                        await self.close()
+                        await self.connect()
+
+                elif command_parts[0].upper() == "PUT" and len(command_parts) == 2:
+                    if not os.path.exists(command_parts[1]):
+                        print("File does not exist.")
+                    elif await self.put_file(command_parts[1]):
+                        print("File successfully upload to server")
+                    else:
+                        print("Upload failed on the server.")
+
+                elif input_text.upper() == "BYE":
+                    await self.bye()
+                    print("Exiting...")
+                    return
+
+                elif input_text:
+                    print("Invalid input. Please use RLIST, GET <file>, PUT <file> or BYE.")
+
+            except READ_ERRORS + (OSError,) as e:
+                print(f"Connection failed: {e!r}, reconnecting ...")
+                await self.close()
+                await self.connect()
+
+########################################################################
+# Process command line arguments if run directly.
+########################################################################
+
+if __name__ == '__main__':
+    roles = {'client': lambda: asyncio.run(AsyncClient().console()), 'server': AsyncServer}
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-r', '--role',
+                        choices=roles,
+                        help='server or client role',
+                        required=True, type=str)
+
+    args = parser.parse_args()
+    roles[args.role]()
+
+########################################################################
@@ -0,0 +1,1783 @@
+#!/usr/bin/env python3
+
+########################################################################
+# Benchmarks for the Lab3 file sharing service.
+#
+# Each benchmark starts the lab3 Server in a child process on loopback,
+# pointed at a temporary share folder, and drives it from this process
+# so that the server's peak RSS can be read back from /proc.
+#
+#   python lab3_benchmark.py get --size-mb 512
+#   python lab3_benchmark.py load --workers 8 --json before.json
+#   python lab3_benchmark.py load --workers 8 --baseline before.json
+########################################################################
+
+import socket
+import argparse
+import subprocess
+import tempfile
+import time
+import threading
+import contextlib
+import io
+import ast
+import concurrent.futures
+import json
+import random
+import sys
+import os
+
+import lab3
+import lab3_asyncio
+from lab3 import CMD, CMD_FIELD_LEN, FILENAME_SIZE_FIELD_LEN, FILESIZE_FIELD_LEN, MSG_ENCODING
+from lab3 import SOCKET_TIMEOUT, recv_exactly, recv_bytes, parse_size
+
+########################################################################
+
+BENCHMARK_PORT = 30101
+DRAIN_BUFFER_SIZE = 1 << 20
+MB = 1 << 20
+
+# Benchmarks choose their server; a discovery cache left in the working
+# directory by an earlier SCAN must not redirect them.
+lab3.Client.USE_DISCOVERY_CACHE = False
+
+########################################################################
+# Server process management
+########################################################################
+
+def serve(args):
+
+    # Runs inside the child process: configure the Server class and
+    # hand control to it.
+    lab3.Server.REMOTE_FOLDER_LIST = args.share_dir
+    lab3.Server.FILE_SHARING_PORT = args.port
+    lab3.Server.BROADCAST_PORT = 0
+
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        setattr(lab3.Server, name, ast.literal_eval(value))
+
+    if args.implementation == "asyncio":
+        lab3_asyncio.AsyncServer()
+    else:
+        lab3.Server()
+
+def start_server(share_dir, port=BENCHMARK_PORT, implementation="thread", **settings):
+
+    command = [sys.executable, os.path.abspath(__file__), 'serve',
+               '--share-dir', share_dir, '--port', str(port), '--implementation', implementation]
+    for name, value in settings.items():
+        command += ['--set', f"{name}={value!r}"]
+
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    # Wait for the listen socket to come up.
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError("Benchmark server did not start.")
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+def proc_status_field(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def peak_rss_kb(pid):
+
+    # VmHWM is the resident set high-water mark of the process.
+    return proc_status_field(pid, "VmHWM")
+
+########################################################################
+# Helpers
+########################################################################
+
+def make_text_file(path, size):
+
+    # ASCII content so that the original text-mode GET path can serve
+    # it too.
+    line = b"The quick brown fox jumps over the lazy dog 0123456789.\n"
+    block = line * (MB // len(line) + 1)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:min(remaining, MB)])
+            remaining -= min(remaining, MB)
+
+def drain(sock, bytecount_target, buffer):
+
+    view = memoryview(buffer)
+    byte_recv_count = 0
+    while byte_recv_count < bytecount_target:
+        n = sock.recv_into(view, min(len(view), bytecount_target - byte_recv_count))
+        if not n:
+            raise ConnectionError("Server closed the connection early.")
+        byte_recv_count += n
+    return byte_recv_count
+
+def drain_bytes(sock, bytecount_target):
+    buffer = bytearray(bytecount_target)
+    drain(sock, bytecount_target, buffer)
+    return bytes(buffer)
+
+def connect(port=BENCHMARK_PORT, timeout=None):
+
+    # A session with the benchmark server, past its admission status.
+    # Raises ConnectionError if the server is busy.
+    sock = socket.create_connection(('localhost', port), timeout=timeout)
+    try:
+        if drain_bytes(sock, 1)[0] != lab3.STATUS["OK"]:
+            raise ConnectionError("the server is busy")
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+def get_request(filename):
+    filename_bytes = filename.encode(MSG_ENCODING)
+    return (CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+            + len(filename_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+            + filename_bytes)
+
+def timed_get(filename, buffer, port=BENCHMARK_PORT):
+
+    start = time.perf_counter()
+    with connect(port) as sock:
+        sock.sendall(get_request(filename))
+        file_size = int.from_bytes(drain_bytes(sock, FILESIZE_FIELD_LEN), byteorder='big')
+        drain(sock, file_size, buffer)
+    return file_size, time.perf_counter() - start
+
+def print_table(header, rows):
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+########################################################################
+# GET: text path vs sendfile path
+########################################################################
+
+def benchmark_get(args):
+
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        make_text_file(os.path.join(share_dir, "bench.bin"), args.size_mb * MB)
+
+        for label, zero_copy in (("text", False), ("sendfile", True)):
+            server = start_server(share_dir, GET_ZERO_COPY=zero_copy)
+            try:
+                rates = []
+                for _ in range(args.repeat):
+                    file_size, elapsed = timed_get("bench.bin", buffer)
+                    rates.append(file_size / MB / elapsed)
+                rss = peak_rss_kb(server.pid)
+            finally:
+                stop_server(server)
+
+            rows.append([label, f"{max(rates):.1f}", f"{sum(rates) / len(rates):.1f}",
+                         "n/a" if rss is None else f"{rss / 1024:.1f}"])
+
+    print(f"GET of a {args.size_mb} MB file, {args.repeat} runs per path")
+    print_table(["path", "best MB/s", "mean MB/s", "server peak RSS MB"], rows)
+
+########################################################################
+# recv helpers: original recv_bytes vs recv_exactly
+########################################################################
+
+def legacy_recv_bytes(sock, bytecount_target):
+
+    # The helper as it was copied between the lab scripts, kept here
+    # as the baseline.
+    sock.settimeout(SOCKET_TIMEOUT)
+
+    try:
+        byte_recv_count = 0
+        recv_bytes = b''
+
+        while byte_recv_count < bytecount_target:
+            new_bytes = sock.recv(bytecount_target-byte_recv_count)
+
+            if not new_bytes:
+                return (False, b'')
+
+            byte_recv_count += len(new_bytes)
+            recv_bytes += new_bytes
+
+        sock.settimeout(None)
+        return (True, recv_bytes)
+
+    except socket.timeout:
+        sock.settimeout(None)
+        return (False, b'')
+
+def time_reads(reader, size, iterations):
+
+    # Read size bytes iterations times over a socketpair, with a
+    # sender thread keeping the other end full.
+    sender_socket, receiver_socket = socket.socketpair()
+    receiver_socket.settimeout(SOCKET_TIMEOUT)
+    payload = b'x' * size
+
+    def send_all():
+        for _ in range(iterations):
+            sender_socket.sendall(payload)
+
+    sender = threading.Thread(target=send_all, daemon=True)
+    sender.start()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        status, _ = reader(receiver_socket, size)
+        assert status
+    elapsed = time.perf_counter() - start
+
+    sender.join()
+    sender_socket.close()
+    receiver_socket.close()
+    return elapsed / iterations
+
+def benchmark_recv(args):
+
+    readers = [
+        ("recv_bytes (original)", legacy_recv_bytes),
+        ("recv_bytes (on recv_exactly)", recv_bytes),
+        ("recv_exactly (pooled)", recv_exactly),
+    ]
+
+    rows = []
+    for size in args.sizes:
+        iterations = max(1, min(10000, (64 * MB) // size))
+
+        caller_buffer = bytearray(size)
+        size_readers = readers + [
+            ("recv_exactly (caller buffer)",
+             lambda sock, n: recv_exactly(sock, n, buffer=caller_buffer))]
+
+        for label, reader in size_readers:
+            per_read = time_reads(reader, size, iterations)
+            rows.append([format_size(size), label, iterations,
+                         f"{per_read * 1e6:.1f}", f"{size / MB / per_read:.1f}"])
+
+    print_table(["size", "helper", "reads", "us/read", "MB/s"], rows)
+
+########################################################################
+# Small GETs: a connection per command vs one session
+########################################################################
+
+def get_over(sock, request, buffer):
+    sock.sendall(request)
+    file_size = int.from_bytes(drain_bytes(sock, FILESIZE_FIELD_LEN), byteorder='big')
+    drain(sock, file_size, buffer)
+
+def benchmark_session(args):
+
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    request = get_request("small.txt")
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        make_text_file(os.path.join(share_dir, "small.txt"), args.file_size)
+        server = start_server(share_dir)
+
+        try:
+            start = time.perf_counter()
+            for _ in range(args.count):
+                with connect() as sock:
+                    get_over(sock, request, buffer)
+            rows.append(["connection per GET", args.count, time.perf_counter() - start])
+
+            start = time.perf_counter()
+            with connect() as sock:
+                for _ in range(args.count):
+                    get_over(sock, request, buffer)
+            rows.append(["one session", args.count, time.perf_counter() - start])
+
+        finally:
+            stop_server(server)
+
+    print(f"{args.count} GETs of a {args.file_size} byte file")
+    print_table(["mode", "GETs", "seconds", "GETs/s", "us/GET"],
+                [[label, count, f"{elapsed:.2f}", f"{count / elapsed:.0f}", f"{elapsed / count * 1e6:.0f}"]
+                 for label, count, elapsed in rows])
+
+########################################################################
+# Parallel ranged GET over a high-latency link
+########################################################################
+
+class LatencyProxy:
+
+    # Forwards connections to the benchmark server, holding every chunk
+    # for delay seconds and moving at most window bytes per chunk. Each
+    # connection then behaves like a window-limited TCP stream on a
+    # long link, topping out at about window / delay bytes per second.
+    # With a link token bucket, all connections also share one link of
+    # that rate, served in the order chunks arrive.
+
+    def __init__(self, listen_port, target_port, delay, window, link=None):
+        self.target_port = target_port
+        self.delay = delay
+        self.window = window
+        self.link = link
+
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(('localhost', listen_port))
+        self.listen_socket.listen(64)
+
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+
+    def accept_forever(self):
+        while True:
+            try:
+                client_socket, _ = self.listen_socket.accept()
+            except OSError:
+                return
+            server_socket = socket.create_connection(('localhost', self.target_port))
+            for source, destination in ((client_socket, server_socket), (server_socket, client_socket)):
+                threading.Thread(target=self.pump, args=(source, destination), daemon=True).start()
+
+    def pump(self, source, destination):
+        try:
+            while True:
+                data = source.recv(self.window)
+                if not data:
+                    break
+                if self.link is not None:
+                    time.sleep(self.link.take(len(data)))
+                time.sleep(self.delay)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.listen_socket.close()
+
+class BenchmarkClient(lab3.Client):
+
+    # A lab3 Client without the console loop.
+    def __init__(self):
+        self.connect_to_server()
+
+def benchmark_parallel(args):
+
+    proxy_port = BENCHMARK_PORT + 1
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    lab3.Server.FILE_SHARING_PORT = proxy_port
+    lab3.Client.PARALLEL_CHUNK_SIZE = args.chunk_mb * MB
+
+    rows = []
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        make_text_file(os.path.join(share_dir, "bench.bin"), args.size_mb * MB)
+        server = start_server(share_dir)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for connections in [1] + args.connections:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    client = BenchmarkClient()
+                    start = time.perf_counter()
+                    if connections == 1:
+                        client.get_file("bench.bin")
+                    else:
+                        client.get_file_parallel("bench.bin", connections)
+                    elapsed = time.perf_counter() - start
+                    client.socket.close()
+
+                assert os.path.getsize("bench.bin") == args.size_mb * MB
+                os.remove("bench.bin")
+                rows.append(["GET" if connections == 1 else "PGET", connections,
+                             f"{elapsed:.2f}", f"{args.size_mb / elapsed:.1f}"])
+        finally:
+            os.chdir(cwd)
+            proxy.close()
+            stop_server(server)
+
+    print(f"{args.size_mb} MB file through a proxy adding {args.delay_ms} ms per "
+          f"{args.window_kb} KB window, {args.chunk_mb} MB ranges")
+    print_table(["command", "connections", "seconds", "MB/s"], rows)
+
+########################################################################
+# Compressed GET over fast and slow links
+########################################################################
+
+def make_log_file(path, size):
+
+    # CSV-like access log: repetitive, but with enough random fields
+    # that it does not compress absurdly well.
+    rng = random.Random(4)
+    with open(path, 'w') as f:
+        written = 0
+        while written < size:
+            line = (f"{written},10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)},GET,"
+                    f"/api/v1/items/{rng.randint(1, 99999)},{rng.choice((200, 200, 200, 304, 404))},"
+                    f"{rng.random():.6f}\n")
+            f.write(line)
+            written += len(line)
+
+def benchmark_compression(args):
+
+    proxy_port = BENCHMARK_PORT + 1
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    lab3.Client.COMPRESSION_LEVEL = args.level
+
+    codecs = ["none", "zlib"] + (["lzma"] if lab3.lzma is not None else [])
+    rows = []
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        make_log_file(os.path.join(share_dir, "log.csv"), args.size_mb * MB)
+        with open(os.path.join(share_dir, "random.bin"), 'wb') as f:
+            f.write(os.urandom(args.size_mb * MB))
+
+        server = start_server(share_dir)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for link, port in (("loopback", BENCHMARK_PORT), ("slow link", proxy_port)):
+                lab3.Server.FILE_SHARING_PORT = port
+                for filename in ("log.csv", "random.bin"):
+                    for command in ["GET"] + [f"ZGET {codec}" for codec in codecs]:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            client = BenchmarkClient()
+                            start = time.perf_counter()
+                            if command == "GET":
+                                client.get_file(filename)
+                            else:
+                                client.get_file_compressed(filename, command.split()[1])
+                            elapsed = time.perf_counter() - start
+                            client.socket.close()
+
+                        file_size = os.path.getsize(filename)
+                        os.remove(filename)
+                        rows.append([link, filename, command, f"{elapsed:.2f}",
+                                     f"{file_size / MB / elapsed:.1f}"])
+        finally:
+            os.chdir(cwd)
+            proxy.close()
+            stop_server(server)
+
+    print(f"{args.size_mb} MB files, level {args.level}; the slow link adds "
+          f"{args.delay_ms} ms per {args.window_kb} KB "
+          f"(about {args.window_kb / args.delay_ms:.1f} MB/s)")
+    print("ZGET falls back to codec none for random.bin, which does not compress.")
+    print_table(["link", "file", "command", "seconds", "MB/s"], rows)
+
+########################################################################
+# Thread per connection vs a bounded worker pool under a burst
+########################################################################
+
+def burst_client(request, count, results):
+
+    # One client of the burst: connect, pass admission, then count GETs
+    # over the session.
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    start = time.perf_counter()
+    try:
+        with socket.create_connection(('localhost', BENCHMARK_PORT), timeout=30) as sock:
+            if drain_bytes(sock, 1)[0] != lab3.STATUS["OK"]:
+                results.append(("busy", time.perf_counter() - start))
+                return
+            for _ in range(count):
+                get_over(sock, request, buffer)
+        results.append(("ok", time.perf_counter() - start))
+    except (OSError, ConnectionError):
+        results.append(("failed", time.perf_counter() - start))
+
+def server_stats():
+    with connect() as sock:
+        sock.sendall(CMD["STATS"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        header = drain_bytes(sock, 1 + lab3.STATS_SIZE_FIELD_LEN)
+        return json.loads(drain_bytes(sock, int.from_bytes(header[1:], byteorder='big')))
+
+def benchmark_pool(args):
+
+    request = get_request("small.txt")
+    rows = []
+    stats = {}
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        make_text_file(os.path.join(share_dir, "small.txt"), args.file_size)
+
+        for executor in ("thread", "pool"):
+            server = start_server(share_dir, EXECUTOR=executor, POOL_WORKERS=args.workers,
+                                  POOL_QUEUE_SIZE=args.queue_size)
+
+            # Sample the server's thread count while the burst runs.
+            peak_threads = [0]
+            done = threading.Event()
+
+            def sample_threads():
+                while not done.is_set():
+                    peak_threads[0] = max(peak_threads[0], proc_status_field(server.pid, "Threads") or 0)
+                    time.sleep(0.01)
+
+            sampler = threading.Thread(target=sample_threads)
+            sampler.start()
+
+            try:
+                results = []
+                clients = [threading.Thread(target=burst_client, args=(request, args.requests, results))
+                           for _ in range(args.clients)]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.perf_counter() - start
+
+                stats[executor] = server_stats()["pool"]
+            finally:
+                done.set()
+                sampler.join()
+                rss = peak_rss_kb(server.pid)
+                stop_server(server)
+
+            served = [latency for outcome, latency in results if outcome == "ok"]
+            served.sort()
+            rows.append([executor, len(served),
+                         sum(1 for outcome, _ in results if outcome == "busy"),
+                         sum(1 for outcome, _ in results if outcome == "failed"),
+                         f"{len(served) * args.requests / elapsed:.0f}",
+                         f"{served[len(served) // 2] * 1000:.0f}" if served else "-",
+                         f"{served[int(len(served) * 0.95)] * 1000:.0f}" if served else "-",
+                         peak_threads[0], rss])
+
+    print(f"{args.clients} clients at once, {args.requests} GETs of {args.file_size} bytes each; "
+          f"pool of {args.workers} workers with a queue of {args.queue_size}")
+    print_table(["executor", "served", "busy", "failed", "GETs/s", "p50 ms", "p95 ms", "threads", "peak RSS KB"],
+                rows)
+    print()
+    print("Pool statistics:", json.dumps(stats["pool"]))
+
+########################################################################
+# Thread-per-connection server vs the asyncio server
+########################################################################
+
+def benchmark_asyncio(args):
+
+    lab3_asyncio.raise_open_file_limit()
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    request = get_request("small.txt")
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        make_text_file(os.path.join(share_dir, "small.txt"), args.file_size)
+
+        for implementation in ("thread", "asyncio"):
+            server = start_server(share_dir, implementation=implementation, SESSION_IDLE_TIMEOUT=3600)
+            idle = []
+
+            try:
+                # Hold idle sessions open. A GET on the last one shows
+                # that the server has accepted all of them.
+                start = time.perf_counter()
+                for _ in range(args.idle):
+                    idle.append(connect())
+                get_over(idle[-1], request, buffer)
+                open_elapsed = time.perf_counter() - start
+
+                threads = proc_status_field(server.pid, "Threads")
+                rss = proc_status_field(server.pid, "VmRSS")
+
+                # Latency of a live session next to the idle ones.
+                with connect() as sock:
+                    start = time.perf_counter()
+                    for _ in range(args.requests):
+                        get_over(sock, request, buffer)
+                    get_elapsed = time.perf_counter() - start
+
+                for sock in idle:
+                    sock.close()
+                idle = []
+
+                # Many active sessions at once.
+                results = []
+                clients = [threading.Thread(target=burst_client, args=(request, args.requests, False, results))
+                           for _ in range(args.clients)]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                burst_elapsed = time.perf_counter() - start
+                served = sum(1 for outcome, _ in results if outcome == "ok")
+
+            finally:
+                for sock in idle:
+                    sock.close()
+                peak_rss = peak_rss_kb(server.pid)
+                stop_server(server)
+
+            rows.append([implementation, f"{open_elapsed:.2f}", threads, rss // 1024,
+                         f"{get_elapsed / args.requests * 1e6:.0f}",
+                         f"{served * args.requests / burst_elapsed:.0f}", peak_rss // 1024])
+
+    print(f"{args.idle} idle sessions, then {args.clients} clients doing {args.requests} GETs "
+          f"of {args.file_size} bytes each")
+    print_table(["server", "open s", "threads", "idle RSS MB", "us/GET", "burst GETs/s", "peak RSS MB"], rows)
+
+########################################################################
+# Delta PUT vs full PUT for modified files
+########################################################################
+
+def benchmark_delta(args):
+
+    # With --delay-ms the uploads go through a LatencyProxy, which
+    # limits them to about window / delay bytes per second.
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Server.FILE_SHARING_PORT = BENCHMARK_PORT + 1 if args.delay_ms else BENCHMARK_PORT
+    size = args.size_mb * MB
+    original = os.urandom(size)
+
+    def edited(kind):
+        if kind == "append 4 KB":
+            return original + os.urandom(4096)
+        if kind == "insert 8 B mid-file":
+            return original[:size // 2] + b"inserted" + original[size // 2:]
+        if kind == "flip 10 scattered bytes":
+            data = bytearray(original)
+            for position in range(0, size, size // 10):
+                data[position] ^= 0xff
+            return bytes(data)
+        return os.urandom(size)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        server = start_server(share_dir)
+        proxy = None
+        if args.delay_ms:
+            proxy = LatencyProxy(BENCHMARK_PORT + 1, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for kind in ("append 4 KB", "insert 8 B mid-file", "flip 10 scattered bytes", "rewrite everything"):
+                with open("bench.bin", 'wb') as f:
+                    f.write(edited(kind))
+                new_size = os.path.getsize("bench.bin")
+
+                for command in ("PUT", "RPUT"):
+                    with open(os.path.join(share_dir, "bench.bin"), 'wb') as f:
+                        f.write(original)
+
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        client = BenchmarkClient()
+                        start = time.perf_counter()
+                        if command == "PUT":
+                            client.put_files("bench.bin")
+                            sent = new_size
+                        else:
+                            sent = client.put_file_delta("bench.bin")
+                        elapsed = time.perf_counter() - start
+                        client.socket.close()
+
+                    with open(os.path.join(share_dir, "bench.bin"), 'rb') as f, open("bench.bin", 'rb') as g:
+                        assert f.read() == g.read()
+
+                    rows.append([kind, command, format_size(sent), f"{elapsed:.2f}"])
+        finally:
+            os.chdir(cwd)
+            if proxy is not None:
+                proxy.close()
+            stop_server(server)
+
+    print(f"Re-uploading an edited copy of a {args.size_mb} MB file"
+          + (f" through a proxy adding {args.delay_ms} ms per {args.window_kb} KB" if args.delay_ms else ""))
+    print_table(["edit", "command", "sent", "seconds"], rows)
+
+########################################################################
+# Many small files: GET per file vs MGET
+########################################################################
+
+def benchmark_mget(args):
+
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    lab3.Server.FILE_SHARING_PORT = BENCHMARK_PORT
+    names = [f"file{i:05}.txt" for i in range(args.files)]
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        for name in names:
+            make_text_file(os.path.join(share_dir, name), args.file_size)
+        server = start_server(share_dir)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for mode in ("GET, connection per file", "GET, one session", "MGET file*"):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    client = BenchmarkClient()
+                    start = time.perf_counter()
+                    if mode.startswith("MGET"):
+                        client.get_files(["file*"])
+                    else:
+                        for name in names:
+                            if mode == "GET, connection per file":
+                                client.socket.close()
+                                client.connect_to_server()
+                            client.get_file(name)
+                    elapsed = time.perf_counter() - start
+                    client.socket.close()
+
+                for name in names:
+                    assert os.path.getsize(name) == args.file_size
+                    os.remove(name)
+                rows.append([mode, f"{elapsed:.2f}", f"{args.files / elapsed:.0f}"])
+        finally:
+            os.chdir(cwd)
+            stop_server(server)
+
+    print(f"{args.files} files of {args.file_size} bytes")
+    print_table(["mode", "seconds", "files/s"], rows)
+
+########################################################################
+# Skewed GET workload with and without the file cache
+########################################################################
+
+def skewed_gets(requests, count, seed, results):
+    rng = random.Random(seed)
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    names = [name for name, _ in requests]
+    weights = [weight for _, weight in requests]
+    with connect() as sock:
+        start = time.perf_counter()
+        for name in rng.choices(names, weights, k=count):
+            get_over(sock, get_request(name), buffer)
+        results.append(time.perf_counter() - start)
+
+def benchmark_cache(args):
+
+    # Zipf-like popularity: the file of rank r is requested in
+    # proportion to 1 / r. The hottest files are a mix of small ones and
+    # a few large ones.
+    sizes = [args.large_kb * 1024 if rank % 10 == 3 else args.small_kb * 1024 for rank in range(args.files)]
+    requests = [(f"file{rank:05}.bin", 1 / (rank + 1)) for rank in range(args.files)]
+    total_bytes = sum(size * weight for size, (_, weight) in zip(sizes, requests)) / sum(w for _, w in requests)
+    rows = []
+    stats = None
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        for (name, _), size in zip(requests, sizes):
+            with open(os.path.join(share_dir, name), 'wb') as f:
+                f.write(os.urandom(size))
+
+        for cache in (False, True):
+            server = start_server(share_dir, FILE_CACHE=cache, FILE_CACHE_SIZE=args.cache_mb * MB)
+            try:
+                results = []
+                clients = [threading.Thread(target=skewed_gets, args=(requests, args.requests, seed, results))
+                           for seed in range(args.clients)]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.perf_counter() - start
+
+                if cache:
+                    stats = server_stats()["file_cache"]
+            finally:
+                stop_server(server)
+
+            gets = args.clients * args.requests
+            rows.append(["on" if cache else "off", f"{elapsed:.2f}", f"{gets / elapsed:.0f}",
+                         f"{gets * total_bytes / MB / elapsed:.0f}"])
+
+    print(f"{args.clients} clients x {args.requests} GETs over {args.files} files "
+          f"({args.small_kb} KB, every 10th {args.large_kb} KB), {args.cache_mb} MB cache")
+    print_table(["cache", "seconds", "GETs/s", "MB/s"], rows)
+    print()
+    print("Cache statistics:", json.dumps(stats))
+
+########################################################################
+# Integrity: GET/PUT vs VGET/VPUT with a streamed digest trailer
+########################################################################
+
+def hash_file(path, algorithm):
+
+    # The separate pass VGET replaces: read the file back and digest it.
+    # The file is flushed and dropped from the page cache first where
+    # the platform allows, since a large download would not still be
+    # cached by the time it is checked.
+    digest = lab3.make_digest(lab3.DIGEST[algorithm])
+    buffer = bytearray(lab3.VERIFY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        if hasattr(os, "posix_fadvise"):
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while count := f.readinto(buffer):
+            digest.update(view[:count])
+    return digest.digest()
+
+def benchmark_verify(args):
+
+    proxy_port = BENCHMARK_PORT + 1
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    algorithms = ["crc32", "blake2b"] + (["crc32c"] if lab3.crc32c is not None else [])
+    file_size = args.size_mb * MB
+    modes = [("GET", None), ("PUT", None)]
+    for algorithm in algorithms:
+        modes += [(f"GET, then re-read ({algorithm})", algorithm),
+                  (f"VGET {algorithm}", algorithm),
+                  (f"VPUT {algorithm}", algorithm)]
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        with open(os.path.join(share_dir, "data.bin"), 'wb') as f:
+            f.write(os.urandom(file_size))
+        server = start_server(share_dir)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for link, port in (("loopback", BENCHMARK_PORT), ("slow link", proxy_port)):
+                lab3.Server.FILE_SHARING_PORT = port
+                for mode, algorithm in modes:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        client = BenchmarkClient()
+                        start = time.perf_counter()
+                        if mode == "PUT":
+                            client.put_files("data.bin")
+                        elif mode.startswith("VPUT"):
+                            client.put_file_verified("data.bin", algorithm)
+                        elif mode.startswith("VGET"):
+                            client.get_file_verified("data.bin", algorithm)
+                        else:
+                            client.get_file("data.bin")
+                            if algorithm is not None:
+                                hash_file("data.bin", algorithm)
+                        elapsed = time.perf_counter() - start
+                        client.socket.close()
+
+                    assert os.path.getsize("data.bin") == file_size
+                    rows.append([link, mode, f"{elapsed:.2f}", f"{file_size / MB / elapsed:.0f}"])
+        finally:
+            os.chdir(cwd)
+            proxy.close()
+            stop_server(server)
+
+    print(f"{args.size_mb} MB file; the slow link adds {args.delay_ms} ms per {args.window_kb} KB "
+          f"(about {args.window_kb / args.delay_ms:.1f} MB/s)")
+    print_table(["link", "mode", "seconds", "MB/s"], rows)
+
+########################################################################
+# Small GET latency under bulk load, with and without rate limits
+########################################################################
+
+def bulk_gets(filename, port, stop, totals):
+
+    # Download filename over and over on one session until stop is set.
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    received = 0
+    with connect(port) as sock:
+        while not stop.is_set():
+            sock.sendall(get_request(filename))
+            file_size = int.from_bytes(drain_bytes(sock, FILESIZE_FIELD_LEN), byteorder='big')
+            received += drain(sock, file_size, buffer)
+    totals.append(received)
+
+def probe_gets(filename, port, count, interval):
+
+    # Latencies of count small GETs on one session, interval apart.
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    latencies = []
+    with connect(port) as sock:
+        for _ in range(count):
+            start = time.perf_counter()
+            sock.sendall(get_request(filename))
+            file_size = int.from_bytes(drain_bytes(sock, FILESIZE_FIELD_LEN), byteorder='big')
+            drain(sock, file_size, buffer)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(interval)
+    return sorted(latencies)
+
+def benchmark_shaping(args):
+
+    # The proxy stands in for the server's uplink: one FIFO link of
+    # --link-mb MB/s shared by every connection, with a deep queue. The
+    # server either sends as fast as it can, filling that queue, or is
+    # limited at run time to just under the link rate so that the queue
+    # builds up in the server, where transfers take turns.
+    proxy_port = BENCHMARK_PORT + 1
+    link_rate = args.link_mb * MB
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Server.FILE_SHARING_PORT = BENCHMARK_PORT
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        make_text_file(os.path.join(share_dir, "bulk.txt"), args.bulk_mb * MB)
+        make_text_file(os.path.join(share_dir, "small.txt"), args.small_kb * 1024)
+        server = start_server(share_dir)
+        link = lab3.TokenBucket(link_rate, 64 * 1024)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, 0, MB, link)
+
+        try:
+            for label, bulk_clients, limit in (("idle", 0, 0),
+                                               ("bulk load, no limit", args.bulk_clients, 0),
+                                               ("bulk load, limit 90% of link", args.bulk_clients,
+                                                int(link_rate * 0.9))):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    admin = BenchmarkClient()
+                    admin.set_limits(limit, 0)
+                    admin.socket.close()
+
+                stop = threading.Event()
+                totals = []
+                bulk = [threading.Thread(target=bulk_gets, args=("bulk.txt", proxy_port, stop, totals))
+                        for _ in range(bulk_clients)]
+                start = time.perf_counter()
+                for thread in bulk:
+                    thread.start()
+                time.sleep(1 if bulk_clients else 0)
+
+                latencies = probe_gets("small.txt", proxy_port, args.probes, 0.05)
+
+                stop.set()
+                for thread in bulk:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+
+                rows.append([label, f"{percentile(latencies, 0.5) * 1000:.1f}",
+                             f"{percentile(latencies, 0.95) * 1000:.1f}",
+                             f"{latencies[-1] * 1000:.1f}",
+                             f"{sum(totals) / MB / elapsed:.1f}" if bulk_clients else "-"])
+        finally:
+            proxy.close()
+            stop_server(server)
+
+    print(f"{args.bulk_clients} clients downloading {args.bulk_mb} MB in a loop over a shared "
+          f"{args.link_mb} MB/s link; {args.probes} GETs of {args.small_kb} KB")
+    print_table(["load", "p50 ms", "p95 ms", "max ms", "bulk MB/s"], rows)
+
+########################################################################
+# Repeated GETs of an unchanged tree, with and without CGET
+########################################################################
+
+def benchmark_conditional(args):
+
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Server.FILE_SHARING_PORT = BENCHMARK_PORT
+    names = [f"file{i:05}.bin" for i in range(args.files)]
+    file_size = args.file_kb * 1024
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        for name in names:
+            with open(os.path.join(share_dir, name), 'wb') as f:
+                f.write(os.urandom(file_size))
+        server = start_server(share_dir)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for mode in ("GET", "CGET, no local copies", "CGET, unchanged", "CGET, touched on server"):
+                if mode == "CGET, touched on server":
+                    for name in names:
+                        os.utime(os.path.join(share_dir, name))
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    client = BenchmarkClient()
+                    received = 0
+                    start = time.perf_counter()
+                    for name in names:
+                        if mode == "GET":
+                            client.get_file_resumable(name)
+                            received += file_size
+                        else:
+                            received += client.get_file_conditional(name)
+                    elapsed = time.perf_counter() - start
+                    client.socket.close()
+
+                if mode == "GET":
+                    # Start the CGET runs from an empty download folder.
+                    for name in names:
+                        os.remove(name)
+                rows.append([mode, f"{elapsed:.2f}", f"{args.files / elapsed:.0f}", f"{received / MB:.1f}"])
+        finally:
+            os.chdir(cwd)
+            stop_server(server)
+
+    print(f"{args.files} files of {args.file_kb} KB over one session")
+    print_table(["mode", "seconds", "files/s", "MB received"], rows)
+
+########################################################################
+# A LIST queued behind a large GET, on a session and multiplexed
+########################################################################
+
+def benchmark_mux(args):
+
+    proxy_port = BENCHMARK_PORT + 1
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        make_text_file(os.path.join(share_dir, "bulk.txt"), args.size_mb * MB)
+        server = start_server(share_dir)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for link, port in (("loopback", BENCHMARK_PORT), ("slow link", proxy_port)):
+                lab3.Server.FILE_SHARING_PORT = port
+                for mode in ("session", "MUX"):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        client = BenchmarkClient()
+                        if mode == "MUX":
+                            mux = client.open_mux()
+                            get_client, list_client = lab3.StreamClient(mux), lab3.StreamClient(mux)
+                        else:
+                            get_client = list_client = client
+
+                        # The LIST is issued 50 ms into the GET. On a
+                        # session it can only go out once the GET is done.
+                        start = time.perf_counter()
+                        get_done = []
+                        get_thread = threading.Thread(
+                            target=lambda: (get_client.get_file("bulk.txt"),
+                                            get_done.append(time.perf_counter() - start)))
+                        get_thread.start()
+                        time.sleep(0.05)
+                        list_start = time.perf_counter()
+                        if mode == "session":
+                            get_thread.join()
+                        list_client.remote_list_files()
+                        list_latency = time.perf_counter() - list_start
+                        get_thread.join()
+
+                        if mode == "MUX":
+                            get_client.socket.close()
+                            list_client.socket.close()
+                            mux.close()
+                        client.socket.close()
+
+                    assert os.path.getsize("bulk.txt") == args.size_mb * MB
+                    os.remove("bulk.txt")
+                    rows.append([link, mode, f"{get_done[0]:.2f}", f"{args.size_mb / get_done[0]:.1f}",
+                                 f"{list_latency * 1000:.1f}"])
+        finally:
+            os.chdir(cwd)
+            proxy.close()
+            stop_server(server)
+
+    print(f"{args.size_mb} MB GET with a LIST issued 50 ms into it; the slow link adds "
+          f"{args.delay_ms} ms per {args.window_kb} KB (about {args.window_kb / args.delay_ms:.1f} MB/s)")
+    print_table(["link", "mode", "GET seconds", "GET MB/s", "LIST ms"], rows)
+
+########################################################################
+# One file from several servers of different speeds, GET vs SWARM
+########################################################################
+
+def benchmark_swarm(args):
+
+    # Each server sits behind its own proxy, a link of one of the
+    # --links-mb rates. The first SWARM waits for the servers to digest
+    # the file for CHUNKS; the second finds the digests cached. The
+    # last gives the fastest server a stale copy whose second half
+    # differs, so it can only supply the first.
+    rates = [int(rate) * MB for rate in args.links_mb.split(',')]
+    server_ports = [BENCHMARK_PORT + 10 * i for i in range(len(rates))]
+    proxy_ports = [port + 1 for port in server_ports]
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Client.CONDITIONAL_GET = False
+    file_size = args.size_mb * MB
+    rows = []
+
+    with contextlib.ExitStack() as stack:
+        share_dirs = [stack.enter_context(tempfile.TemporaryDirectory()) for _ in rates]
+        client_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        make_text_file(os.path.join(share_dirs[0], "bench.bin"), file_size)
+        with open(os.path.join(share_dirs[0], "bench.bin"), 'rb') as f:
+            content = f.read()
+        for share_dir in share_dirs[1:]:
+            with open(os.path.join(share_dir, "bench.bin"), 'wb') as f:
+                f.write(content)
+
+        servers = [start_server(share_dir, port) for share_dir, port in zip(share_dirs, server_ports)]
+        proxies = [LatencyProxy(proxy_port, server_port, args.delay_ms / 1000, 256 * 1024,
+                                lab3.TokenBucket(rate, 64 * 1024))
+                   for proxy_port, server_port, rate in zip(proxy_ports, server_ports, rates)]
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for mode in ("GET, fastest server", "SWARM, digests computed", "SWARM, digests cached",
+                         "SWARM, fastest server stale"):
+                if mode == "SWARM, fastest server stale":
+                    with open(os.path.join(share_dirs[0], "bench.bin"), 'r+b') as f:
+                        f.seek(file_size // 2)
+                        f.write(content[file_size // 2:].swapcase())
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lab3.Server.FILE_SHARING_PORT = proxy_ports[0]
+                    client = BenchmarkClient()
+                    start = time.perf_counter()
+                    if mode.startswith("GET"):
+                        client.get_file("bench.bin")
+                    else:
+                        client.get_file_swarm("bench.bin", [('localhost', port) for port in proxy_ports],
+                                              args.chunk_mb * MB)
+                    elapsed = time.perf_counter() - start
+                    client.socket.close()
+
+                with open("bench.bin", 'rb') as f:
+                    assert f.read() == content
+                os.remove("bench.bin")
+                rows.append([mode, f"{elapsed:.2f}", f"{args.size_mb / elapsed:.1f}"])
+        finally:
+            os.chdir(cwd)
+            for proxy in proxies:
+                proxy.close()
+            for server in servers:
+                stop_server(server)
+
+    print(f"{args.size_mb} MB file on {len(rates)} servers behind links of {args.links_mb} MB/s, "
+          f"{args.chunk_mb} MB chunks")
+    print_table(["mode", "seconds", "MB/s"], rows)
+
+########################################################################
+# Client start-up, scanning vs the discovery cache
+########################################################################
+
+def benchmark_discovery(args):
+
+    # Time from a new client to a connected session: scanning first, as
+    # a client without a fresh discovery cache has to, or going
+    # straight to the nearest server in the cache a scan left behind.
+    discovery_port = BENCHMARK_PORT + 50
+    server_ports = [BENCHMARK_PORT + 10 * i for i in range(args.servers)]
+    lab3.Client.ADDRESS_PORT = (lab3.Client.BROADCAST_ADDRESS, discovery_port)
+    lab3.Client.USE_DISCOVERY_CACHE = True
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        servers = [start_server(share_dir, port, BROADCAST_PORT=discovery_port) for port in server_ports]
+        cwd = os.getcwd()
+        os.chdir(client_dir)
+
+        try:
+            for mode in ("SCAN, then connect", "discovery cache"):
+                times = []
+                for _ in range(args.runs):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter()
+                        client = lab3.Client.__new__(lab3.Client)
+                        if mode.startswith("SCAN"):
+                            client.send_service_discovery_request()
+                        client.connect_to_server()
+                        times.append(time.perf_counter() - start)
+                        client.socket.close()
+
+                host, port = client.server_address
+                rows.append([mode, f"{percentile(sorted(times), 0.5) * 1000:.1f}", f"{host}:{port}"])
+        finally:
+            os.chdir(cwd)
+            for server in servers:
+                stop_server(server)
+
+    print(f"{args.runs} client start-ups with {args.servers} servers answering discovery, "
+          f"SCAN_TIMEOUT {lab3.Client.SCAN_TIMEOUT} s")
+    print_table(["mode", "p50 ms", "connected to"], rows)
+
+########################################################################
+# Finding files: SEARCH vs the whole listing filtered on the client
+########################################################################
+
+def listed_entries(sock):
+
+    # Every (name, size) in the share folder, by one unpaged LISTPAGE.
+    sock.sendall(CMD["LISTPAGE"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                 + (0).to_bytes(lab3.PATTERN_SIZE_FIELD_LEN, byteorder='big')
+                 + (0).to_bytes(FILENAME_SIZE_FIELD_LEN + lab3.PAGE_SIZE_FIELD_LEN, byteorder='big'))
+    entries = []
+    while entry_count := int.from_bytes(recv_bytes(sock, lab3.ENTRY_COUNT_FIELD_LEN)[1], byteorder='big'):
+        for _ in range(entry_count):
+            name_size = recv_bytes(sock, FILENAME_SIZE_FIELD_LEN)[1][0]
+            entry = recv_bytes(sock, name_size + FILESIZE_FIELD_LEN + lab3.MTIME_FIELD_LEN)[1]
+            entries.append((entry[:name_size].decode(MSG_ENCODING),
+                            int.from_bytes(entry[name_size:name_size + FILESIZE_FIELD_LEN], byteorder='big')))
+    recv_bytes(sock, FILENAME_SIZE_FIELD_LEN)
+    return entries
+
+def search_count(sock, text):
+
+    # Run a SEARCH and return its match count, draining the entries.
+    query_bytes = text.encode(MSG_ENCODING)
+    sock.sendall(CMD["SEARCH"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                 + len(query_bytes).to_bytes(lab3.QUERY_SIZE_FIELD_LEN, byteorder='big')
+                 + query_bytes
+                 + (0).to_bytes(lab3.PAGE_SIZE_FIELD_LEN, byteorder='big'))
+    fields = recv_bytes(sock, lab3.STATUS_FIELD_LEN + lab3.MATCH_COUNT_FIELD_LEN + FILESIZE_FIELD_LEN)[1]
+    drain_bytes(sock, int.from_bytes(fields[-FILESIZE_FIELD_LEN:], byteorder='big'))
+    return int.from_bytes(fields[lab3.STATUS_FIELD_LEN:-FILESIZE_FIELD_LEN], byteorder='big')
+
+def benchmark_search(args):
+
+    # A share folder of --files sparse files with sizes spread evenly on
+    # a log scale from 1 KB to 4 GB. Each query is timed end to end on one session: SEARCH with
+    # the catalog, SEARCH scanning the folder (CATALOG = False), and
+    # the whole listing fetched with LISTPAGE and filtered here.
+    rng = random.Random(args.seed)
+    words = ["report", "log", "data", "image", "backup", "notes"]
+    extensions = ["csv", "txt", "bin", "jpg", "tar"]
+    queries = {"prefix:log_1": lambda name, size: name.startswith("log_1"),
+               "_123": lambda name, size: "_123" in name,
+               "size>1G": lambda name, size: size > 1 << 30,
+               "ext:csv size>3G": lambda name, size: name.endswith(".csv") and size > 3 << 30}
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        for i in range(args.files):
+            with open(os.path.join(share_dir, f"{rng.choice(words)}_{i}.{rng.choice(extensions)}"), 'wb') as f:
+                f.truncate(int(2 ** rng.uniform(10, 32)))
+
+        for mode, port, settings in (("SEARCH, catalog", BENCHMARK_PORT, {}),
+                                     ("SEARCH, folder scan", BENCHMARK_PORT + 1, {"CATALOG": False}),
+                                     ("LISTPAGE + client filter", BENCHMARK_PORT, {})):
+            server = start_server(share_dir, port, **settings)
+            try:
+                sock = connect(port)
+                for text, matches in queries.items():
+                    times = []
+                    for _ in range(args.runs):
+                        start = time.perf_counter()
+                        if mode.startswith("SEARCH"):
+                            count = search_count(sock, text)
+                        else:
+                            count = sum(1 for name, size in listed_entries(sock) if matches(name, size))
+                        times.append(time.perf_counter() - start)
+                    rows.append([mode, text, count, f"{percentile(sorted(times), 0.5) * 1000:.2f}"])
+                sock.close()
+            finally:
+                stop_server(server)
+
+    print(f"{args.files} files, p50 of {args.runs} queries over one loopback session")
+    print_table(["mode", "query", "matches", "p50 ms"], rows)
+
+########################################################################
+# Directory sync of a large tree with few changes
+########################################################################
+
+def make_tree(root, count, file_size, rng):
+
+    # count files of random bytes, up to 2 * file_size each, 100 to a
+    # folder. Returns their SYNC paths.
+    paths = []
+    for i in range(count):
+        path = f"d{i // 10000:02}/e{i // 100 % 100:02}/f{i:06}.bin"
+        write_tree_file(root, path, rng.randrange(2 * file_size + 1))
+        paths.append(path)
+    return paths
+
+def write_tree_file(root, path, size):
+    filepath = os.path.join(root, *path.split("/"))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as f:
+        f.write(os.urandom(size))
+
+def benchmark_sync(args):
+
+    # A tree of --files files on the client, synced over a link with
+    # --delay-ms of latency. The first two rows copy one folder of 100
+    # files, a round trip per file and then pipelined; the rest sync
+    # the whole tree in both directions, from scratch, after a few
+    # changes, and with nothing to do.
+    proxy_port = BENCHMARK_PORT + 1
+    lab3.Client.SERVER_HOSTNAME = 'localhost'
+    lab3.Server.FILE_SHARING_PORT = proxy_port
+    rng = random.Random(args.seed)
+    file_size = args.file_kb * 1024
+    rows = []
+
+    with tempfile.TemporaryDirectory() as share_dir, tempfile.TemporaryDirectory() as client_dir:
+        tree = os.path.join(client_dir, "tree")
+        start = time.perf_counter()
+        paths = make_tree(tree, args.files, file_size, rng)
+        print(f"Created {args.files} files in {time.perf_counter() - start:.1f} s")
+
+        server = start_server(share_dir)
+        proxy = LatencyProxy(proxy_port, BENCHMARK_PORT, args.delay_ms / 1000, args.window_kb * 1024)
+
+        def run(label, direction, local_dir, remote_dir, batch_files=lab3.Client.SYNC_BATCH_FILES,
+                depth=lab3.Client.SYNC_PIPELINE_DEPTH):
+            lab3.Client.SYNC_BATCH_FILES = batch_files
+            lab3.Client.SYNC_PIPELINE_DEPTH = depth
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                file_count, byte_count, failures = client.sync(direction, local_dir, remote_dir)
+                elapsed = time.perf_counter() - start
+            assert not failures
+            rows.append([label, file_count, f"{byte_count / MB:.1f}", f"{elapsed:.2f}",
+                         f"{file_count / elapsed:.0f}"])
+
+        def change(root, count):
+            for path in rng.sample(paths, count):
+                write_tree_file(root, path, rng.randrange(2 * file_size + 1) + 1)
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                client = BenchmarkClient()
+
+            folder = os.path.join(tree, "d00", "e00")
+            run("PUT d00/e00, a file per round trip", "PUT", folder, "serial", batch_files=1, depth=1)
+            run("PUT d00/e00, pipelined", "PUT", folder, "pipelined")
+
+            run("PUT, empty server", "PUT", tree, "tree")
+            run("PUT, unchanged", "PUT", tree, "tree")
+            change(tree, args.changes)
+            for path in rng.sample(paths, args.touches):
+                os.utime(os.path.join(tree, *path.split("/")))
+            run(f"PUT, {args.changes} changed, {args.touches} touched", "PUT", tree, "tree")
+
+            copy = os.path.join(client_dir, "copy")
+            run("GET, empty folder", "GET", copy, "tree")
+            change(os.path.join(share_dir, "tree"), args.changes)
+            run(f"GET, {args.changes} changed on the server", "GET", copy, "tree")
+            run("GET, unchanged", "GET", copy, "tree")
+
+            client.socket.close()
+        finally:
+            proxy.close()
+            stop_server(server)
+
+        assert lab3.tree_manifest(copy) == lab3.tree_manifest(os.path.join(share_dir, "tree"))
+
+    print(f"{args.files} files of up to {2 * args.file_kb} KB; the link adds {args.delay_ms} ms "
+          f"per {args.window_kb} KB")
+    print_table(["run", "files copied", "MB", "seconds", "files/s"], rows)
+
+########################################################################
+# Small-file PUT throughput at each durability level
+########################################################################
+
+def put_client(client, count, payload, latencies):
+
+    # One session PUTting count new files of payload.
+    with connect() as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for i in range(count):
+            name = f"put-{client}-{i}.bin".encode(MSG_ENCODING)
+            start = time.perf_counter()
+            sock.sendall(CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                         + len(name).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big') + name
+                         + len(payload).to_bytes(FILESIZE_FIELD_LEN, byteorder='big') + payload)
+            if drain_bytes(sock, 1)[0] != lab3.STATUS["OK"]:
+                raise ConnectionError("PUT failed")
+            latencies.append(time.perf_counter() - start)
+
+def benchmark_durability(args):
+
+    # --clients sessions each PUT --puts new files at once, against a
+    # fresh share folder for every durability level.
+    payload = os.urandom(args.file_kb * 1024)
+    levels = [("none", 0), ("file", 0), ("batch", 0)] + [("batch", ms) for ms in args.batch_ms]
+    rows = []
+
+    for level, batch_ms in levels:
+        with tempfile.TemporaryDirectory(dir=args.dir) as share_dir:
+            server = start_server(share_dir, DURABILITY=level, DURABILITY_BATCH_MS=batch_ms)
+            try:
+                latencies = []
+                start = time.perf_counter()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=args.clients) as executor:
+                    for future in [executor.submit(put_client, client, args.puts, payload, latencies)
+                                   for client in range(args.clients)]:
+                        future.result()
+                elapsed = time.perf_counter() - start
+                durability = server_stats()["durability"]
+            finally:
+                stop_server(server)
+
+        latencies.sort()
+        label = f"batch, {batch_ms} ms" if level == "batch" else level
+        rows.append([label, f"{len(latencies) / elapsed:.0f}", f"{percentile(latencies, 0.5) * 1000:.2f}",
+                     f"{percentile(latencies, 0.99) * 1000:.2f}", durability["batches"],
+                     durability["largest_batch"]])
+
+    print(f"{args.clients} clients x {args.puts} PUTs of {args.file_kb} KB new files")
+    print_table(["durability", "PUT/s", "p50 ms", "p99 ms", "commits", "largest batch"], rows)
+
+########################################################################
+# Load test: concurrent LIST/GET/PUT workers with a JSON report
+########################################################################
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def proc_cpu_seconds(pid):
+
+    # utime + stime of a process, from /proc/<pid>/stat.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def load_worker(worker, port, sizes, mix, duration, seed):
+
+    # Runs in a worker process: one session, issuing operations picked
+    # from mix until duration has passed. Returns latencies, byte and
+    # error counts keyed by "OP size", and the wall-clock span it ran.
+    rng = random.Random(seed)
+    buffer = bytearray(DRAIN_BUFFER_SIZE)
+    payloads = {size: os.urandom(size) for size in sizes} if "PUT" in mix else {}
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    latencies = {}
+    byte_counts = {}
+    errors = {}
+    sock = None
+    started = time.time()
+    deadline = time.perf_counter() + duration
+
+    while time.perf_counter() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        size = rng.choice(sizes)
+        key = "LIST" if operation == "LIST" else f"{operation} {format_size(size)}"
+
+        start = time.perf_counter()
+        try:
+            if sock is None:
+                sock = connect(port, timeout=30)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if operation == "LIST":
+                sock.sendall(CMD["LIST"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+                moved = int.from_bytes(drain_bytes(sock, FILESIZE_FIELD_LEN), byteorder='big')
+                drain(sock, moved, buffer)
+
+            elif operation == "GET":
+                moved = size
+                get_over(sock, get_request(f"load-{format_size(size).replace(' ', '')}.bin"), buffer)
+
+            else:
+                name = f"put-{worker}-{rng.randrange(4)}.bin".encode(MSG_ENCODING)
+                sock.sendall(CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                             + len(name).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big') + name
+                             + size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big'))
+                sock.sendall(payloads[size])
+                if drain_bytes(sock, 1)[0] != lab3.STATUS["OK"]:
+                    raise ConnectionError("PUT failed")
+                moved = size
+
+        except (OSError, ConnectionError):
+            errors[key] = errors.get(key, 0) + 1
+            if sock is not None:
+                sock.close()
+                sock = None
+            continue
+
+        latencies.setdefault(key, []).append(time.perf_counter() - start)
+        byte_counts[key] = byte_counts.get(key, 0) + moved
+
+    if sock is not None:
+        sock.close()
+
+    return latencies, byte_counts, errors, (started, time.time())
+
+def benchmark_load(args):
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    mix = {}
+    for entry in args.mix.split(","):
+        operation, weight = entry.split("=")
+        mix[operation.upper()] = float(weight)
+
+    settings = {}
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        settings[name] = ast.literal_eval(value)
+
+    with tempfile.TemporaryDirectory() as share_dir:
+        for size in sizes:
+            with open(os.path.join(share_dir, f"load-{format_size(size).replace(' ', '')}.bin"), 'wb') as f:
+                f.write(os.urandom(size))
+
+        server = start_server(share_dir, implementation=args.implementation, **settings)
+        cpu_before = proc_cpu_seconds(server.pid)
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [executor.submit(load_worker, worker, BENCHMARK_PORT, sizes, mix,
+                                           args.duration, args.seed + worker)
+                           for worker in range(args.workers)]
+                outcomes = [future.result() for future in futures]
+
+            cpu_after = proc_cpu_seconds(server.pid)
+            rss = proc_status_field(server.pid, "VmRSS")
+            peak_rss = peak_rss_kb(server.pid)
+        finally:
+            stop_server(server)
+
+    # Rates are over the span in which workers were running, which
+    # leaves out process start-up.
+    elapsed = max(span[1] for *_, span in outcomes) - min(span[0] for *_, span in outcomes)
+
+    latencies, byte_counts, errors = {}, {}, {}
+    for worker_latencies, worker_bytes, worker_errors, _ in outcomes:
+        for key, values in worker_latencies.items():
+            latencies.setdefault(key, []).extend(values)
+        for key, count in worker_bytes.items():
+            byte_counts[key] = byte_counts.get(key, 0) + count
+        for key, count in worker_errors.items():
+            errors[key] = errors.get(key, 0) + count
+
+    def summary(values, moved, failed):
+        values = sorted(values)
+        return {"requests": len(values),
+                "errors": failed,
+                "requests_per_s": round(len(values) / elapsed, 1),
+                "mb_per_s": round(moved / MB / elapsed, 2),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3) if values else 0.0}
+
+    keys = [f"{operation} {format_size(size)}" if operation != "LIST" else "LIST"
+            for operation in mix for size in sizes]
+    results = {key: summary(latencies.get(key, []), byte_counts.get(key, 0), errors.get(key, 0))
+               for key in dict.fromkeys(keys) if key in latencies or key in errors}
+    results["total"] = summary([value for values in latencies.values() for value in values],
+                               sum(byte_counts.values()), sum(errors.values()))
+
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {"implementation": args.implementation, "workers": args.workers,
+                         "duration_s": args.duration, "sizes": sizes, "mix": mix, "settings": settings},
+              "elapsed_s": round(elapsed, 3),
+              "results": results,
+              "server": {"cpu_s": round(cpu_seconds, 2) if cpu_seconds is not None else None,
+                         "cpu_percent": round(100 * cpu_seconds / elapsed, 1) if cpu_seconds is not None else None,
+                         "rss_kb": rss,
+                         "peak_rss_kb": peak_rss}}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    header = ["operation", "requests", "errors", "req/s", "MB/s", "p50 ms", "p95 ms", "p99 ms"]
+    if baseline is not None:
+        header.append("req/s vs baseline")
+
+    rows = []
+    for key, result in results.items():
+        row = [key, result["requests"], result["errors"], result["requests_per_s"], result["mb_per_s"],
+               result["p50_ms"], result["p95_ms"], result["p99_ms"]]
+        if baseline is not None:
+            old = baseline.get(key, {}).get("requests_per_s")
+            row.append(f"{result['requests_per_s'] / old:.2f}x" if old else "-")
+        rows.append(row)
+
+    print(f"{args.workers} workers for {args.duration} s against the {args.implementation} server, "
+          f"mix {args.mix}")
+    print_table(header, rows)
+    print(f"Server CPU {report['server']['cpu_s']} s ({report['server']['cpu_percent']}%), "
+          f"RSS {rss} KB, peak RSS {peak_rss} KB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+def format_size(size):
+    if size >= MB:
+        return f"{size // MB} MB"
+    if size >= 1024:
+        return f"{size // 1024} KB"
+    return f"{size} B"
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='run a benchmark server (internal)')
+    serve_parser.add_argument('--share-dir', required=True)
+    serve_parser.add_argument('--port', type=int, default=BENCHMARK_PORT)
+    serve_parser.add_argument('--implementation', choices=['thread', 'asyncio'], default='thread')
+    serve_parser.add_argument('--set', action='append', default=[],
+                              help='override a Server attribute, NAME=VALUE')
+    serve_parser.set_defaults(func=serve)
+
+    get_parser = subparsers.add_parser('get', help='text GET vs sendfile GET')
+    get_parser.add_argument('--size-mb', type=int, default=256)
+    get_parser.add_argument('--repeat', type=int, default=3)
+    get_parser.set_defaults(func=benchmark_get)
+
+    recv_parser = subparsers.add_parser('recv', help='recv_bytes vs recv_exactly')
+    recv_parser.add_argument('--sizes', type=int, nargs='+',
+                             default=[1024, MB, 100 * MB],
+                             help='read sizes in bytes')
+    recv_parser.set_defaults(func=benchmark_recv)
+
+    session_parser = subparsers.add_parser('session', help='small GETs with and without a session')
+    session_parser.add_argument('--count', type=int, default=10000)
+    session_parser.add_argument('--file-size', type=int, default=1024)
+    session_parser.set_defaults(func=benchmark_session)
+
+    parallel_parser = subparsers.add_parser('parallel', help='GET vs PGET over a high-latency link')
+    parallel_parser.add_argument('--size-mb', type=int, default=64)
+    parallel_parser.add_argument('--chunk-mb', type=int, default=4)
+    parallel_parser.add_argument('--connections', type=int, nargs='+', default=[2, 4, 8])
+    parallel_parser.add_argument('--delay-ms', type=float, default=20)
+    parallel_parser.add_argument('--window-kb', type=int, default=256)
+    parallel_parser.set_defaults(func=benchmark_parallel)
+
+    compression_parser = subparsers.add_parser('compression', help='GET vs ZGET on fast and slow links')
+    compression_parser.add_argument('--size-mb', type=int, default=32)
+    compression_parser.add_argument('--level', type=int, default=1)
+    compression_parser.add_argument('--delay-ms', type=float, default=10)
+    compression_parser.add_argument('--window-kb', type=int, default=64)
+    compression_parser.set_defaults(func=benchmark_compression)
+
+    pool_parser = subparsers.add_parser('pool', help='thread per connection vs a bounded worker pool')
+    pool_parser.add_argument('--clients', type=int, default=300)
+    pool_parser.add_argument('--requests', type=int, default=50)
+    pool_parser.add_argument('--file-size', type=int, default=1024)
+    pool_parser.add_argument('--workers', type=int, default=16)
+    pool_parser.add_argument('--queue-size', type=int, default=64)
+    pool_parser.set_defaults(func=benchmark_pool)
+
+    asyncio_parser = subparsers.add_parser('asyncio', help='thread-per-connection server vs the asyncio server')
+    asyncio_parser.add_argument('--idle', type=int, default=10000)
+    asyncio_parser.add_argument('--clients', type=int, default=200)
+    asyncio_parser.add_argument('--requests', type=int, default=100)
+    asyncio_parser.add_argument('--file-size', type=int, default=1024)
+    asyncio_parser.set_defaults(func=benchmark_asyncio)
+
+    delta_parser = subparsers.add_parser('delta', help='PUT vs delta PUT of an edited file')
+    delta_parser.add_argument('--size-mb', type=int, default=64)
+    delta_parser.add_argument('--delay-ms', type=float, default=0)
+    delta_parser.add_argument('--window-kb', type=int, default=64)
+    delta_parser.set_defaults(func=benchmark_delta)
+
+    mget_parser = subparsers.add_parser('mget', help='GET per file vs one MGET for many small files')
+    mget_parser.add_argument('--files', type=int, default=5000)
+    mget_parser.add_argument('--file-size', type=int, default=4096)
+    mget_parser.set_defaults(func=benchmark_mget)
+
+    cache_parser = subparsers.add_parser('cache', help='skewed GETs with and without the file cache')
+    cache_parser.add_argument('--files', type=int, default=1000)
+    cache_parser.add_argument('--small-kb', type=int, default=16)
+    cache_parser.add_argument('--large-kb', type=int, default=1024)
+    cache_parser.add_argument('--cache-mb', type=int, default=64)
+    cache_parser.add_argument('--clients', type=int, default=4)
+    cache_parser.add_argument('--requests', type=int, default=5000)
+    cache_parser.set_defaults(func=benchmark_cache)
+
+    verify_parser = subparsers.add_parser('verify', help='GET/PUT vs VGET/VPUT with a digest trailer')
+    verify_parser.add_argument('--size-mb', type=int, default=64)
+    verify_parser.add_argument('--delay-ms', type=float, default=2)
+    verify_parser.add_argument('--window-kb', type=int, default=256)
+    verify_parser.set_defaults(func=benchmark_verify)
+
+    shaping_parser = subparsers.add_parser('shaping', help='small GET latency under bulk load, with and without a rate limit')
+    shaping_parser.add_argument('--link-mb', type=int, default=20)
+    shaping_parser.add_argument('--bulk-mb', type=int, default=16)
+    shaping_parser.add_argument('--bulk-clients', type=int, default=4)
+    shaping_parser.add_argument('--small-kb', type=int, default=4)
+    shaping_parser.add_argument('--probes', type=int, default=40)
+    shaping_parser.set_defaults(func=benchmark_shaping)
+
+    conditional_parser = subparsers.add_parser('conditional', help='repeated GETs of an unchanged tree, GET vs CGET')
+    conditional_parser.add_argument('--files', type=int, default=500)
+    conditional_parser.add_argument('--file-kb', type=int, default=256)
+    conditional_parser.set_defaults(func=benchmark_conditional)
+
+    mux_parser = subparsers.add_parser('mux', help='LIST latency behind a large GET, session vs MUX')
+    mux_parser.add_argument('--size-mb', type=int, default=64)
+    mux_parser.add_argument('--delay-ms', type=float, default=5)
+    mux_parser.add_argument('--window-kb', type=int, default=256)
+    mux_parser.set_defaults(func=benchmark_mux)
+
+    swarm_parser = subparsers.add_parser('swarm', help='GET from the fastest server vs SWARM from all of them')
+    swarm_parser.add_argument('--size-mb', type=int, default=128)
+    swarm_parser.add_argument('--links-mb', default="40,20,10", help='link rate of each server, MB/s')
+    swarm_parser.add_argument('--delay-ms', type=float, default=2)
+    swarm_parser.add_argument('--chunk-mb', type=int, default=4)
+    swarm_parser.set_defaults(func=benchmark_swarm)
+
+    discovery_parser = subparsers.add_parser('discovery', help='client start-up with a scan vs the discovery cache')
+    discovery_parser.add_argument('--servers', type=int, default=3)
+    discovery_parser.add_argument('--runs', type=int, default=5)
+    discovery_parser.set_defaults(func=benchmark_discovery)
+
+    search_parser = subparsers.add_parser('search', help='SEARCH with and without the catalog vs filtering a listing')
+    search_parser.add_argument('--files', type=int, default=20000)
+    search_parser.add_argument('--runs', type=int, default=20)
+    search_parser.add_argument('--seed', type=int, default=1)
+    search_parser.set_defaults(func=benchmark_search)
+
+    sync_parser = subparsers.add_parser('sync', help='SYNC of a large tree, from scratch and after a few changes')
+    sync_parser.add_argument('--files', type=int, default=100000)
+    sync_parser.add_argument('--file-kb', type=int, default=2)
+    sync_parser.add_argument('--changes', type=int, default=20)
+    sync_parser.add_argument('--touches', type=int, default=100)
+    sync_parser.add_argument('--delay-ms', type=float, default=2)
+    sync_parser.add_argument('--window-kb', type=int, default=256)
+    sync_parser.add_argument('--seed', type=int, default=1)
+    sync_parser.set_defaults(func=benchmark_sync)
+
+    durability_parser = subparsers.add_parser('durability', help='small-file PUT throughput at each durability level')
+    durability_parser.add_argument('--clients', type=int, default=16)
+    durability_parser.add_argument('--puts', type=int, default=200)
+    durability_parser.add_argument('--file-kb', type=int, default=4)
+    durability_parser.add_argument('--batch-ms', type=lambda text: [int(ms) for ms in text.split(",")], default=[2],
+                                   help='extra batch delays to try, e.g. 1,5')
+    durability_parser.add_argument('--dir', help='where to create the share folder, to test another disk')
+    durability_parser.set_defaults(func=benchmark_durability)
+
+    load_parser = subparsers.add_parser('load', help='concurrent LIST/GET/PUT load with a JSON report')
+    load_parser.add_argument('--workers', type=int, default=8, help='client processes')
+    load_parser.add_argument('--duration', type=float, default=10, help='seconds')
+    load_parser.add_argument('--sizes', default="1K,64K,1M,16M", help='file sizes, e.g. 4K,1M')
+    load_parser.add_argument('--mix', default="GET=8,LIST=1,PUT=1", help='operation weights')
+    load_parser.add_argument('--implementation', choices=['thread', 'asyncio'], default='thread')
+    load_parser.add_argument('--set', action='append', default=[],
+                             help='override a Server attribute, NAME=VALUE')
+    load_parser.add_argument('--seed', type=int, default=1)
+    load_parser.add_argument('--json', help='write the report to this file')
+    load_parser.add_argument('--baseline', help='compare with an earlier JSON report')
+    load_parser.set_defaults(func=benchmark_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+########################################################################